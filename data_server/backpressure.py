@@ -0,0 +1,101 @@
+"""
+Load shedding for the data server. When the db pool is saturated, new requests for work are rejected early with
+503 and a Retry-After header, instead of piling up as threads that wait for a connection (and then time out all at
+once). Workers (worker.py) back off with jittered exponential backoff and honour Retry-After, see Backoff below.
+
+The server is considered overloaded if
+  - at least max_waiting threads are already waiting for a pooled connection, or
+  - the recent pool wait time (an exponentially decaying average of the waits at checkout) is above wait_threshold.
+
+The average decays with the time since the last checkout, so that a server that sheds all new work doesn't stay
+overloaded forever just because no connection was checked out in the meantime.
+"""
+import random
+import threading
+import time
+
+class LoadShedder:
+    def __init__(self, wait_threshold=1., max_waiting=None, retry_after=5, max_retry_after=60, half_life=5.):
+        self.wait_threshold = wait_threshold
+        self.max_waiting = max_waiting
+        self.retry_after_seconds = retry_after
+        self.max_retry_after = max_retry_after
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        self.mean_wait = 0.
+        self.observed_at = time.monotonic()
+
+    def _decayed(self, now):
+        return self.mean_wait * 0.5 ** ((now - self.observed_at) / self.half_life)
+
+    # Callback for every pool checkout, with the seconds it waited for a connection
+    def observe_wait(self, seconds):
+        now = time.monotonic()
+        with self.lock:
+            # weigh new waits like one half life of history, so that a burst of slow checkouts shows up quickly
+            self.mean_wait = 0.5 * self._decayed(now) + 0.5 * seconds
+            self.observed_at = now
+
+    def recent_wait(self):
+        with self.lock:
+            return self._decayed(time.monotonic())
+
+    def overloaded(self, waiting=0):
+        """Returns the reason why the server is overloaded (for the 503 response and metrics) or None."""
+        if self.max_waiting is not None and waiting >= self.max_waiting:
+            return 'pool_exhausted'
+        if self.wait_threshold is not None and self.recent_wait() > self.wait_threshold:
+            return 'pool_wait'
+        return None
+
+    def retry_after(self):
+        """Seconds for the Retry-After header, longer the further the pool wait is above the threshold."""
+        factor = 1.
+        if self.wait_threshold:
+            factor = max(1., self.recent_wait() / self.wait_threshold)
+        return int(min(self.max_retry_after, max(1, round(self.retry_after_seconds * factor))))
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (only the delta-seconds form, HTTP dates are ignored) or None."""
+    try:
+        return max(0., float(value))
+    except (TypeError, ValueError):
+        return None
+
+class Backoff:
+    """
+    Jittered exponential backoff for clients: the n-th consecutive failure waits a random time in [0, base * 2^n]
+    ("full jitter", capped at max_delay), so that many workers that failed at the same moment don't retry in lockstep.
+    A Retry-After from the server is a lower bound, plus up to `jitter` of it on top for the same reason.
+
+    Usage:
+        backoff = Backoff()
+        while True:
+            resp = requests.get(...)
+            if resp.status_code == 503:
+                backoff.sleep(resp.headers.get('Retry-After'))
+                continue
+            backoff.reset()
+    """
+    def __init__(self, base=1., max_delay=300., jitter=0.5):
+        self.base = base
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.failures = 0
+
+    def delay(self, retry_after=None):
+        delay = random.uniform(0., min(self.max_delay, self.base * 2 ** self.failures))
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            delay = max(delay, retry_after * (1. + random.uniform(0., self.jitter)))
+        self.failures += 1
+        return delay
+
+    def sleep(self, retry_after=None):
+        delay = self.delay(retry_after)
+        print(f'Backing off for {delay:.1f}s (failure {self.failures} in a row)')
+        time.sleep(delay)
+        return delay
+
+    def reset(self):
+        self.failures = 0
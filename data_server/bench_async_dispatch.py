@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Compares the dispatch latencies (p50/p99) and requests per second of server.py (gunicorn) and server_async.py
+(uvicorn) with many concurrent simulated workers.
+
+Every simulated worker runs the worker.py cycle without transcribing: get_work -> register_wip -> upload_result
+with a fake vtt file (--upload-ratio of the cycles) or cancel_work (the rest), optionally with a pause in
+between. Cancelled work goes back into the queue, so with the default --upload-ratio 0 the benchmark can be
+repeated on the same data. Uploads mark episodes as done and write vtt files into vtt_dir, use a copy of the db.
+
+Start both servers on the same db, e.g.
+
+    gunicorn -c gunicorn.conf.py --workers=8 --threads=128 --bind 127.0.0.1:6000 --worker-class=gthread server:app
+    uvicorn server_async:app --host 127.0.0.1 --port 6001 --workers 8
+
+and run them one after the other with the same load:
+
+    python3 bench_async_dispatch.py --workers 1000 --duration 60 http://127.0.0.1:6000 http://127.0.0.1:6001
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+from utils import load_config
+
+api_version = '/apiv1'
+fake_vtt = b'WEBVTT\n\n00:00.000 --> 00:05.000\nbenchmark transcript\n'
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100. * (len(values) - 1))))]
+
+class DispatchStats:
+    """Latencies and status codes per endpoint, and the number of register_wip collisions."""
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.collisions = 0
+        self.errors = 0
+        self.cycles = 0
+
+    def add(self, endpoint, seconds, status):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] += 1
+
+    # Adds the counts of another DispatchStats, e.g. of another client process
+    def merge(self, other):
+        for endpoint, latencies in other.latencies.items():
+            self.latencies[endpoint].extend(latencies)
+            self.statuses[endpoint].update(other.statuses[endpoint])
+        self.collisions += other.collisions
+        self.errors += other.errors
+        self.cycles += other.cycles
+
+    def requests(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    def report(self, elapsed, title=''):
+        print()
+        print(f'=== {title} ===' if title else '===')
+        print(f'{self.requests()} requests in {elapsed:.1f}s: {self.requests() / elapsed:.1f} req/s, '
+              f'{self.cycles / elapsed:.1f} cycles/s, {self.collisions} register collisions, {self.errors} client errors')
+        print(f'{"endpoint":<16} {"count":>8} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}  status codes')
+        for endpoint, latencies in sorted(self.latencies.items()):
+            # status codes are ints, requests that failed on the client side are counted as 'error'
+            statuses = ', '.join(f'{status}: {count}' for status, count
+                                 in sorted(self.statuses[endpoint].items(), key=lambda item: str(item[0])))
+            print(f'{endpoint:<16} {len(latencies):>8} {percentile(latencies, 50) * 1000.:>9.1f} '
+                  f'{percentile(latencies, 90) * 1000.:>9.1f} {percentile(latencies, 99) * 1000.:>9.1f} '
+                  f'{max(latencies) * 1000.:>9.1f}  {statuses}')
+
+    def summary(self, elapsed):
+        return {endpoint: {'count': len(latencies), 'p50': percentile(latencies, 50), 'p99': percentile(latencies, 99)}
+                for endpoint, latencies in self.latencies.items()} | {'rps': self.requests() / elapsed}
+
+async def timed_request(client, stats, endpoint, method, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        stats.errors += 1
+        stats.add(endpoint, time.perf_counter() - start, 'error')
+        return None
+    stats.add(endpoint, time.perf_counter() - start, response.status_code)
+    return response
+
+# One simulated worker, it runs cycles until the deadline
+async def simulated_worker(client, stats, server, api_key, language, deadline, upload_ratio, pause):
+    worker_id = f'bench-{random.getrandbits(48):012x}'
+    while time.time() < deadline:
+        response = await timed_request(client, stats, 'get_work', 'GET',
+                                       f'{server}{api_version}/get_work/{language}/{api_key}')
+        if response is None or response.status_code != 200:
+            # queue empty or server overloaded, back off a little
+            await asyncio.sleep(pause + random.random())
+            continue
+        wid = response.json()['wid']
+
+        response = await timed_request(client, stats, 'register_wip', 'GET',
+                                       f'{server}{api_version}/register_wip/{wid}/{api_key}',
+                                       params={'worker_id': worker_id})
+        if response is None or response.status_code != 200:
+            continue
+        if not response.json().get('success'):
+            # another worker got the same episode between get_work and register_wip
+            stats.collisions += 1
+            continue
+
+        if pause > 0:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * pause)
+
+        if random.random() < upload_ratio:
+            await timed_request(client, stats, 'upload_result', 'POST',
+                                f'{server}{api_version}/upload_result/{wid}/{api_key}',
+                                files={'file': (f'{wid}.vtt', fake_vtt)}, data={'model': 'bench'})
+        else:
+            await timed_request(client, stats, 'cancel_work', 'GET',
+                                f'{server}{api_version}/cancel_work/{wid}/{api_key}')
+        stats.cycles += 1
+
+async def run_workers(server, api_key, language, workers, duration, upload_ratio=0., pause=0., timeout=60.):
+    """Runs `workers` simulated workers against `server` for `duration` seconds, returns (stats, elapsed seconds)."""
+    stats = DispatchStats()
+    limits = httpx.Limits(max_connections=workers, max_keepalive_connections=workers)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        start = time.time()
+        deadline = start + duration
+        await asyncio.gather(*[simulated_worker(client, stats, server, api_key, language, deadline, upload_ratio, pause)
+                               for _ in range(workers)])
+    return stats, time.time() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare dispatch latency and throughput of data servers.')
+    parser.add_argument('servers', nargs='+', help='Base urls of the servers, e.g. http://127.0.0.1:6000')
+    parser.add_argument('--workers', type=int, default=1000, help='Number of concurrent simulated workers')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds per server')
+    parser.add_argument('--language', default='de', help='Language to request work for')
+    parser.add_argument('--upload-ratio', type=float, default=0., help='Fraction of cycles that upload instead of cancel')
+    parser.add_argument('--pause', type=float, default=0., help='Mean seconds a worker "transcribes" between register and upload/cancel')
+    parser.add_argument('--api-key', default=None, help='Defaults to secret_api_key from config.yaml')
+    args = parser.parse_args()
+
+    api_key = args.api_key or load_config()["secret_api_key"]
+
+    results = {}
+    for server in args.servers:
+        stats, elapsed = asyncio.run(run_workers(server, api_key, args.language, args.workers, args.duration,
+                                                 args.upload_ratio, args.pause))
+        stats.report(elapsed, f'{server}, {args.workers} workers')
+        results[server] = stats.summary(elapsed)
+
+    if len(results) > 1:
+        print()
+        print('=== comparison (p50 / p99 ms) ===')
+        endpoints = sorted({endpoint for summary in results.values() for endpoint in summary if endpoint != 'rps'})
+        print(f'{"server":<32} {"req/s":>9}  ' + '  '.join(f'{endpoint:>20}' for endpoint in endpoints))
+        for server, summary in results.items():
+            cells = []
+            for endpoint in endpoints:
+                if endpoint in summary:
+                    cells.append(f'{summary[endpoint]["p50"] * 1000.:>9.1f} / {summary[endpoint]["p99"] * 1000.:>8.1f}')
+                else:
+                    cells.append(f'{"-":>20}')
+            print(f'{server:<32} {summary["rps"]:>9.1f}  ' + '  '.join(cells))
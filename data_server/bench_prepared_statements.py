@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Measures how much planning time the prepared statements in server.py save on the author sampling queries of get_work,
+on the work_queue of the configured database (the queries only read).
+
+For every query it reports:
+  - the planning and execution time from EXPLAIN (ANALYZE) of the plain SQL
+  - the planning and execution time from EXPLAIN (ANALYZE) EXECUTE of the prepared statement, after it ran often
+    enough for postgres to settle on a generic or custom plan
+  - the client side mean latency of --iterations plain executions vs. EXECUTE by name (PreparedStatements)
+
+Example:
+    python3 bench_prepared_statements.py --language de --iterations 500
+"""
+import argparse
+import re
+import time
+
+from prepared_statements import PreparedStatements
+from utils import load_config, connect_to_db
+
+queue_table = 'work_queue'
+
+# The same queries as sample_work in server.py
+queries = [
+    ('get_work.author_count', f"""
+    SELECT COUNT(DISTINCT author_id)
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = %s
+""", lambda state: (state['language'],)),
+    ('get_work.author_sample', f"""
+    SELECT DISTINCT author_id
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = %s
+    OFFSET floor(random() * %s)
+    LIMIT 1
+""", lambda state: (state['language'], state['author_count'])),
+    ('get_work.episode_count', f"""
+    SELECT COUNT(*)
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = %s AND author_id = %s
+""", lambda state: (state['language'], state['author_id'])),
+    ('get_work.episode_sample', f"""
+    SELECT p.podcast_episode_id, p.episode_title, p.authors, p.language, p.episode_audio_url, p.cache_audio_url,
+           p.cache_audio_file, p.transcript_file, p.duration
+    FROM {queue_table} q JOIN podcasts p ON p.podcast_episode_id = q.episode_id
+    WHERE q.status = 'pending' AND q.language = %s AND q.author_id = %s
+    OFFSET floor(random() * %s)
+    LIMIT 1
+""", lambda state: (state['language'], state['author_id'], state['episode_count'])),
+]
+
+timing_re = re.compile(r'(Planning|Execution) Time: ([0-9.]+) ms')
+
+def explain_times(cursor, sql, params=None):
+    cursor.execute('EXPLAIN (ANALYZE) ' + sql, params)
+    times = dict(timing_re.search(row[0]).groups() for row in cursor.fetchall() if timing_re.search(row[0]))
+    return float(times.get('Planning', 'nan')), float(times.get('Execution', 'nan'))
+
+def mean_latency_ms(run, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    return (time.perf_counter() - start) / iterations * 1000.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare planning time and latency of plain and prepared get_work queries.')
+    parser.add_argument('--language', default='de', help='Language to sample from')
+    parser.add_argument('--iterations', type=int, default=200, help='Executions per query and mode')
+    args = parser.parse_args()
+
+    config = load_config()
+    conn, cursor = connect_to_db(database=config["database"], user=config["user"], password=config["password"],
+                                 host=config["host"], port=config["port"])
+
+    cursor.execute(f"SELECT count(*) FROM {queue_table} WHERE status = 'pending' AND language = %s", (args.language,))
+    print(f'Pending episodes for {args.language}:', cursor.fetchone()[0])
+
+    # Parameters for the later queries come from the earlier ones, like in sample_work
+    state = {'language': args.language}
+    cursor.execute(queries[0][1], queries[0][2](state))
+    state['author_count'] = cursor.fetchone()[0]
+    if state['author_count'] == 0:
+        raise SystemExit(f'No pending work for language {args.language}')
+    cursor.execute(queries[1][1], queries[1][2](state))
+    state['author_id'] = cursor.fetchone()[0]
+    cursor.execute(queries[2][1], queries[2][2](state))
+    state['episode_count'] = cursor.fetchone()[0]
+
+    prepared = PreparedStatements()
+    for name, sql, _ in queries:
+        prepared.register(name, sql)
+
+    print()
+    print(f'{"query":<26} {"plain plan ms":>14} {"plain exec ms":>14} {"prep. plan ms":>14} {"prep. exec ms":>14}'
+          f' {"plain mean ms":>14} {"prep. mean ms":>14} {"saved":>7}')
+    for name, sql, make_params in queries:
+        params = make_params(state)
+
+        plain_ms = mean_latency_ms(lambda: (cursor.execute(sql, params), cursor.fetchall()), args.iterations)
+        prepared_ms = mean_latency_ms(lambda: (prepared.execute(cursor, name, params), cursor.fetchall()), args.iterations)
+
+        plain_plan, plain_exec = explain_times(cursor, sql, params)
+        execute_sql, values = prepared.execute_sql(name, params)
+        prepared_plan, prepared_exec = explain_times(cursor, execute_sql, values)
+
+        print(f'{name:<26} {plain_plan:>14.3f} {plain_exec:>14.3f} {prepared_plan:>14.3f} {prepared_exec:>14.3f}'
+              f' {plain_ms:>14.3f} {prepared_ms:>14.3f} {(1. - prepared_ms / plain_ms) * 100.:>6.1f}%')
+
+    cursor.close()
+    conn.close()
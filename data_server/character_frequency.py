@@ -6,6 +6,7 @@ import os
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataset_filters import *
+from vtt_storage import find_vtt_files
 
 def process_file(file):
     ignore = ['-->','WEBVTT']
@@ -20,7 +21,8 @@ def process_file(file):
     return character_counter
 
 def compute_character_frequencies(vtt_dir):
-    files = glob.glob(f'{vtt_dir}/*.vtt')
+    # recursive, vtt_dir can be sharded into hash-prefix subdirectories (see vtt_storage.py)
+    files = find_vtt_files(vtt_dir)
     total_counter = Counter()
 
     with ProcessPoolExecutor(max_workers=8) as executor:
@@ -7,9 +7,11 @@ import json
 import yaml
 import requests
 import time
+from datetime import datetime, timedelta
 from urllib.parse import urljoin
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from compression import accept_encoding_headers
 
 def load_schema(cursor):
     schema_file = "schema.psql"
@@ -59,6 +61,138 @@ def download_file(url, destination):
     print(f"Failed to download file from {url} after {max_retries} attempts.")
     return False
 
+def clone_entry(entry, cursor, conn, local_cache_destinations, include_files_without_transcripts, simulate):
+    """Downloads the media and VTT file of one remote entry and inserts it locally. Returns False if we ran out of disk space."""
+    print('entry:',entry)
+
+    cache_audio_file = entry['cache_audio_file']
+    transcript_file = entry['transcript_file']
+
+    if not include_files_without_transcripts:
+        if not transcript_file:
+            print('Not cloning media file without transcript:', cache_audio_file)
+            return True
+
+    # Determine the destination path with sufficient free space
+    dest_path = None
+    for destination in local_cache_destinations:
+        if get_free_space(destination) > 4:  # Check if there's more than 4GB free
+            dest_path = destination
+            break
+
+    if not dest_path:
+        print("No destination with sufficient free space available. Aborting.")
+        return False
+
+    local_audio_path = os.path.join(dest_path, os.path.basename(cache_audio_file))
+    local_vtt_path = os.path.join(dest_path, 'vtts', os.path.basename(cache_audio_file) + '.vtt')
+
+    print(f"Destination for audio file: {local_audio_path}")
+    print(f"Destination for VTT file: {local_vtt_path}")
+
+    # Download the cache media file and VTT file
+    cache_audio_url = entry['cache_audio_url']
+    vtt_url = entry['transcript_file_url']
+
+    if download_file(cache_audio_url, local_audio_path) and download_file(vtt_url, local_vtt_path):
+        # Update the entry's file paths
+        entry['cache_audio_file'] = local_audio_path
+        entry['transcript_file'] = local_vtt_path
+
+        # Insert the updated entry into the local database
+        sql = '''
+            INSERT INTO podcasts (
+                podcast_title, episode_title, published_date, retrieval_time, authors, language,
+                description, keywords, episode_url, episode_audio_url, cache_audio_url,
+                cache_audio_file, transcript_file, duration, type, episode_json, model
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        '''
+
+        data = (
+            entry['podcast_title'],
+            entry['episode_title'],
+            entry['published_date'],
+            entry['retrieval_time'],
+            entry['authors'],
+            entry['language'],
+            entry['description'],
+            entry['keywords'],
+            entry['episode_url'],
+            entry['episode_audio_url'],
+            entry['cache_audio_url'],
+            entry['cache_audio_file'],
+            entry['transcript_file'],
+            entry['duration'],
+            entry.get('type', 'N/A'),
+            json.dumps(entry.get('episode_json', {})),
+            entry.get('model', 'N/A')
+        )
+
+        print(f"Executing SQL: {cursor.mogrify(sql, data).decode('utf-8')}")
+
+        if not simulate:
+            cursor.execute(sql, data)
+            conn.commit()
+            print("Committed entry to the database.")
+        else:
+            print("Simulation: Would commit entry to the database.")
+    else:
+        print("Failed to download files for entry. Skipping.")
+    return True
+
+def entry_exists(cursor, entry):
+    """Checks if a remote entry has already been cloned (clone_entry keeps the remote cache_audio_url)."""
+    cursor.execute("SELECT 1 FROM podcasts WHERE cache_audio_url = %s", (entry['cache_audio_url'],))
+    return cursor.fetchone() is not None
+
+def load_sync_position(since_file, overlap_minutes):
+    """
+    Returns the (since, after_id) position to continue an incremental sync from. We start overlap_minutes before the last
+    synced row to also catch rows of transactions that committed late on the server, entries that we already have are skipped.
+    """
+    if not os.path.exists(since_file):
+        return '-infinity', 0
+    with open(since_file, 'r') as f:
+        position = json.load(f)
+    # written by older versions when the first sync found nothing
+    if position['since'] == '-infinity':
+        return '-infinity', 0
+    since = datetime.fromisoformat(position['since']) - timedelta(minutes=overlap_minutes)
+    return since.isoformat(), 0
+
+def save_sync_position(since_file, since, after_id):
+    with open(since_file, 'w') as f:
+        json.dump({'since': since, 'after_id': after_id}, f)
+
+def sync_incremental(session, remote_api_url, api_access_key, since_file, overlap_minutes, page_size,
+                     cursor, conn, local_cache_destinations, include_files_without_transcripts, simulate):
+    """Clones the entries that changed since the last run, page by page with the keyset-paginated get_episode_changes."""
+    since, after_id = load_sync_position(since_file, overlap_minutes)
+    changes_url = urljoin(remote_api_url.rstrip('/') + '/', f"get_episode_changes/{api_access_key}")
+    print(f"Fetching changes since {since} from {changes_url}")
+
+    while True:
+        response = session.get(changes_url, params={'since': since, 'after_id': after_id, 'limit': page_size}, timeout=30)
+        response.raise_for_status()
+        page = response.json()
+        print(f"Fetched {len(page['episodes'])} changed entries.")
+
+        for entry in page['episodes']:
+            if entry_exists(cursor, entry):
+                print('Already cloned, skipping:', entry['cache_audio_url'])
+                continue
+            if not clone_entry(entry, cursor, conn, local_cache_destinations, include_files_without_transcripts, simulate):
+                return
+
+        since, after_id = page['next']['since'], page['next']['after_id']
+        # an empty page doesn't move the position (it is still -infinity on the first run)
+        if page['episodes'] and not simulate:
+            save_sync_position(since_file, since, after_id)
+
+        if not page['has_more']:
+            break
+
+
 def main():
     # Load config.yaml
     with open(os.path.join(os.path.dirname(__file__), '../config.yaml'), 'r') as config_file:
@@ -86,6 +220,10 @@ def main():
     parser.add_argument("--db-port", default=default_db_port, help="Database port")
     parser.add_argument("--simulate", action="store_true", help="Simulate the process without committing to the database")
     parser.add_argument("--include-files-without-transcripts", action="store_true", help="Include files even if transcripts are missing")
+    parser.add_argument("--stream", action="store_true", help="Fetch the episode list as a stream (NDJSON) and start cloning right away")
+    parser.add_argument("--since-file", default="", help="Incremental sync: only clone entries that changed since the position stored in this file (created if missing)")
+    parser.add_argument("--sync-overlap-minutes", default=10, type=int, help="Incremental sync: start this many minutes before the stored position")
+    parser.add_argument("--page-size", default=1000, type=int, help="Incremental sync: entries per request")
 
     args = parser.parse_args()
 
@@ -130,106 +268,50 @@ def main():
     adapter = HTTPAdapter(max_retries=retries)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
+    # Episode lists are large and compress well, the server compresses them if we ask for it
+    session.headers.update(accept_encoding_headers)
+
+    if args.since_file:
+        sync_incremental(session, remote_api_url, api_access_key, args.since_file, args.sync_overlap_minutes, args.page_size,
+                         cursor, conn, local_cache_destinations, include_files_without_transcripts, simulate)
+        cursor.close()
+        conn.close()
+        print("Database connection closed.")
+        return
 
     # Fetch entries from the remote server
-    endpoint = f"get_every_episode_list/{api_access_key}"
+    if args.stream:
+        endpoint = f"get_every_episode_list_stream/{api_access_key}"
+    else:
+        endpoint = f"get_every_episode_list/{api_access_key}"
     remote_fetch_api_url = urljoin(remote_api_url.rstrip('/') + '/', endpoint)
 
     print(f"Fetching entries from {remote_fetch_api_url}")
 
     try:
-        response = session.get(remote_fetch_api_url, timeout=30)
+        response = session.get(remote_fetch_api_url, timeout=30, stream=args.stream)
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"Failed to fetch entries: {e}")
         return
 
-    try:
-        entries = response.json()
-    except json.JSONDecodeError:
-        print("Error: Response is not valid JSON.")
-        print("Raw response was:", response.text[:500])
-        return
+    if args.stream:
+        # One JSON object per line, entries are cloned while the rest of the list is still downloading
+        entries = (json.loads(line) for line in response.iter_lines() if line)
+    else:
+        try:
+            entries = response.json()
+        except json.JSONDecodeError:
+            print("Error: Response is not valid JSON.")
+            print("Raw response was:", response.text[:500])
+            return
 
-    print(f"Fetched {len(entries)} entries from the remote server.")
+        print(f"Fetched {len(entries)} entries from the remote server.")
 
     for entry in entries:
-        print('entry:',entry)
-
-        cache_audio_file = entry['cache_audio_file']
-        transcript_file = entry['transcript_file']
-
-        if not include_files_without_transcripts:
-            if not transcript_file or transcript_file == '' or transcript_file == 'in_progress':
-                print('Not cloning media file without transcript:', cache_audio_file)
-                continue
-
-        # Determine the destination path with sufficient free space
-        dest_path = None
-        for destination in local_cache_destinations:
-            if get_free_space(destination) > 4:  # Check if there's more than 4GB free
-                dest_path = destination
-                break
-
-        if not dest_path:
-            print("No destination with sufficient free space available. Aborting.")
+        if not clone_entry(entry, cursor, conn, local_cache_destinations, include_files_without_transcripts, simulate):
             break
 
-        local_audio_path = os.path.join(dest_path, os.path.basename(cache_audio_file))
-        local_vtt_path = os.path.join(dest_path, 'vtts', os.path.basename(cache_audio_file) + '.vtt')
-
-        print(f"Destination for audio file: {local_audio_path}")
-        print(f"Destination for VTT file: {local_vtt_path}")
-
-        # Download the cache media file and VTT file
-        cache_audio_url = entry['cache_audio_url']
-        vtt_url = entry['transcript_file_url']
-
-        if download_file(cache_audio_url, local_audio_path) and download_file(vtt_url, local_vtt_path):
-            # Update the entry's file paths
-            entry['cache_audio_file'] = local_audio_path
-            entry['transcript_file'] = local_vtt_path
-
-            # Insert the updated entry into the local database
-            sql = '''
-                INSERT INTO podcasts (
-                    podcast_title, episode_title, published_date, retrieval_time, authors, language,
-                    description, keywords, episode_url, episode_audio_url, cache_audio_url,
-                    cache_audio_file, transcript_file, duration, type, episode_json, model
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            '''
-
-            data = (
-                entry['podcast_title'],
-                entry['episode_title'],
-                entry['published_date'],
-                entry['retrieval_time'],
-                entry['authors'],
-                entry['language'],
-                entry['description'],
-                entry['keywords'],
-                entry['episode_url'],
-                entry['episode_audio_url'],
-                entry['cache_audio_url'],
-                entry['cache_audio_file'],
-                entry['transcript_file'],
-                entry['duration'],
-                entry.get('type', 'N/A'),
-                json.dumps(entry.get('episode_json', {})),
-                entry.get('model', 'N/A')
-            )
-
-            print(f"Executing SQL: {cursor.mogrify(sql, data).decode('utf-8')}")
-
-            if not simulate:
-                cursor.execute(sql, data)
-                conn.commit()
-                print("Committed entry to the database.")
-            else:
-                print("Simulation: Would commit entry to the database.")
-        else:
-            print("Failed to download files for entry. Skipping.")
-
     cursor.close()
     conn.close()
     print("Database connection closed.")
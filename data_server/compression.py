@@ -0,0 +1,258 @@
+"""
+gzip and zstd compression of request and response bodies (Content-Encoding), for the data server and its clients.
+
+Server side: DecompressRequestMiddleware (WSGI, server.py) and AsgiDecompressRequestMiddleware (ASGI,
+server_async.py) decompress request bodies (e.g. the multipart vtt uploads of worker.py) before the routes parse them, compress_response() compresses JSON / NDJSON responses with the best encoding that the
+client accepts, streamed responses chunk by chunk.
+
+Client side: post_compressed() sends a compressed POST body, accept_encoding_headers lets requests ask for compressed
+responses (requests / urllib3 decompress them transparently).
+
+zstandard is optional, without it only gzip is offered and accepted.
+"""
+import asyncio
+import gzip
+import io
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# In order of preference
+supported_encodings = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+compressible_mimetypes = ('application/json', 'application/x-ndjson', 'text/')
+
+default_levels = {'gzip': 6, 'zstd': 3}
+
+class DecompressionError(ValueError):
+    pass
+
+def compress(data, encoding, level=None):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level or default_levels['gzip'], mtime=0)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level or default_levels['zstd']).compress(data)
+    raise ValueError(f'Unsupported content encoding: {encoding}')
+
+def decompress(data, encoding, max_size):
+    """Decompresses data, raises DecompressionError if it is invalid or larger than max_size bytes (zip bombs)."""
+    try:
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+            result = decompressor.decompress(data, max_size + 1)
+            if not decompressor.eof and len(result) <= max_size:
+                raise DecompressionError(f'Invalid {encoding} data: truncated')
+        elif encoding == 'zstd' and zstandard is not None:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                result = reader.read(max_size + 1)
+        else:
+            raise DecompressionError(f'Unsupported content encoding: {encoding}')
+    except (zlib.error, EOFError) as e:
+        raise DecompressionError(f'Invalid {encoding} data: {e}')
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise DecompressionError(f'Invalid {encoding} data: {e}')
+        raise
+
+    if len(result) > max_size:
+        raise DecompressionError(f'Decompressed body is larger than {max_size} bytes')
+    return result
+
+# Picks the encoding for a response from an Accept-Encoding header, e.g. "gzip, deflate, zstd;q=0.5". Encodings with
+# q=0 are refused, otherwise the server's preference (supported_encodings) wins. Returns None for no compression.
+def negotiate(accept_encoding):
+    accepted = {}
+    for token in (accept_encoding or '').split(','):
+        name, _, params = token.strip().partition(';')
+        q = 1.
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.
+        accepted[name.strip().lower()] = q
+
+    for encoding in supported_encodings:
+        if accepted.get(encoding, accepted.get('*', 0.)) > 0.:
+            return encoding
+    return None
+
+def stream_compress(chunks, encoding, level=None):
+    """Compresses an iterable of str / bytes chunks, flushing after every chunk so that clients can process it right away."""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level or default_levels['gzip'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        flush_block = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    else:
+        compressor = zstandard.ZstdCompressor(level=level or default_levels['zstd']).compressobj()
+        flush_block = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk) + flush_block()
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_response(response, accept_encoding, min_size=1024, level=None):
+    """Compresses a flask response in place, if its type is compressible and the client accepts one of our encodings."""
+    if 'Content-Encoding' in response.headers or response.status_code in (204, 304) or response.direct_passthrough \
+            or not (response.mimetype or '').startswith(compressible_mimetypes):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(accept_encoding)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = stream_compress(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def decompress_request(encoding, body, max_size):
+    """
+    Request body with Content-Encoding `encoding` for both middlewares. Returns (body, None) or (None, (status, error))
+    with status 415 for encodings we don't support and 400 for invalid or too large bodies.
+    """
+    if encoding not in supported_encodings:
+        return None, (415, f'Unsupported content encoding: {encoding}')
+    try:
+        return decompress(body, encoding, max_size), None
+    except DecompressionError as e:
+        return None, (400, str(e))
+
+def error_body(message):
+    return json.dumps({'success': False, 'error': message}).encode('utf-8')
+
+class DecompressRequestMiddleware:
+    """
+    WSGI middleware that decompresses request bodies with Content-Encoding gzip or zstd, so that the flask routes
+    (request.files, request.form, request.json) see the plain body. Decompressed bodies are limited to max_size bytes.
+    """
+    def __init__(self, app, max_size=256 * 1024 * 1024):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            content_length = environ.get('CONTENT_LENGTH')
+            stream = environ['wsgi.input']
+            body = stream.read(int(content_length)) if content_length else stream.read()
+            body, error = decompress_request(encoding, body, self.max_size)
+            if error is not None:
+                status, message = error
+                return self.error(start_response, '415 Unsupported Media Type' if status == 415 else '400 Bad Request', message)
+
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+
+        return self.app(environ, start_response)
+
+    def error(self, start_response, status, message):
+        body = error_body(message)
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+
+class AsgiDecompressRequestMiddleware:
+    """
+    The same for ASGI apps (server_async.py): the compressed body is read completely, decompressed in a thread (so
+    that large uploads don't block the event loop) and passed on as one message without Content-Encoding.
+    """
+    def __init__(self, app, max_size=256 * 1024 * 1024):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        encoding = ''
+        for name, value in scope['headers']:
+            if name == b'content-encoding':
+                encoding = value.decode('latin-1').strip().lower()
+        if not encoding or encoding == 'identity':
+            return await self.app(scope, receive, send)
+
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        body, error = await asyncio.get_running_loop().run_in_executor(
+            None, decompress_request, encoding, b''.join(chunks), self.max_size)
+        if error is not None:
+            status, message = error
+            body = error_body(message)
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        headers = [(name, value) for name, value in scope['headers'] if name not in (b'content-encoding', b'content-length')]
+        headers.append((b'content-length', str(len(body)).encode()))
+        received = False
+
+        async def receive_plain():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+
+        await self.app(dict(scope, headers=headers), receive_plain, send)
+
+# Accept-Encoding for requests clients. urllib3 only decodes zstd responses if it has zstd support (urllib3 2 with
+# zstandard installed), so zstd is only asked for in that case.
+def client_accept_encoding():
+    try:
+        from urllib3.util.request import ACCEPT_ENCODING
+    except ImportError:
+        ACCEPT_ENCODING = 'gzip'
+    return 'zstd, gzip' if 'zstd' in ACCEPT_ENCODING and zstandard is not None else 'gzip'
+
+accept_encoding_headers = {'Accept-Encoding': client_accept_encoding()}
+
+def post_compressed(url, encoding='gzip', min_size=1024, session=None, **kwargs):
+    """
+    Like requests.post(url, data=..., files=..., json=...), but the body is compressed with encoding (gzip, zstd or
+    None for no compression) if it has at least min_size bytes. Other keyword arguments (timeout etc.) go to send().
+    """
+    import requests
+
+    request_kwargs = {key: kwargs.pop(key) for key in ('params', 'data', 'files', 'json', 'headers', 'auth') if key in kwargs}
+    request_kwargs['headers'] = {**accept_encoding_headers, **request_kwargs.get('headers', {})}
+
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+    try:
+        prepared = session.prepare_request(requests.Request('POST', url, **request_kwargs))
+        body = prepared.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if encoding and encoding != 'identity' and body and len(body) >= min_size:
+            prepared.body = compress(body, encoding)
+            prepared.headers['Content-Encoding'] = encoding
+            prepared.headers['Content-Length'] = str(len(prepared.body))
+        return session.send(prepared, **kwargs)
+    finally:
+        if own_session:
+            session.close()
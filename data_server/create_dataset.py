@@ -12,6 +12,7 @@ import json
 
 from dataset_filters import *
 from utils import *
+from compression import accept_encoding_headers
 
 # You can also use sox, but fileformats are more limited.
 sox_str = '%s sox %s -t wav -r 16k -b 16 -e signed -c 1 - |\n'
@@ -439,16 +440,22 @@ def process_podcast_wrapper(server_api_url, api_secret_key, elem_title, language
         print('Warning: error in ', elem_title, 'ignoring entire podcast...')
         traceback.print_exc()
 
+# Columns of get_episode_list that process_podcast and the exporters use
+episode_list_fields = 'episode_title,authors,language,duration,cache_audio_file,transcript_file,transcript_file_url'
+
 # Process all episodes of a particular podcast
 def process_podcast(server_api_url, api_secret_key, title, language, audio_dataset_location='', replace_audio_dataset_location='',
                     change_audio_fileending='', file_format='vtt', max_num_segments=15, max_time_segment=None, min_time_episode=3.0):
 
     request_url = f"{server_api_url}/get_episode_list/{api_secret_key}"
-    data = {'podcast_title': title}
+    # Only the columns we need, and language, duration and corrupted transcripts are already filtered by the server
+    data = {'podcast_title': title, 'fields': episode_list_fields, 'min_duration': min_time_episode, 'exclude_corrupted': 1}
+    if language != '*':
+        data['language'] = language
 
     print('server_api_url:', request_url, 'for', data)
 
-    response = requests.post(request_url, data=data, timeout=120)
+    response = requests.post(request_url, data=data, timeout=120, headers=accept_encoding_headers)
     episode_list = response.json()
 
     episodes = []
@@ -476,8 +483,10 @@ def process_podcast(server_api_url, api_secret_key, title, language, audio_datas
                 print('Warning, ignoring empty episode url.')
                 continue
 
+            # the server already filters by min_duration, this only matters with servers that ignore it
             if episode['duration']<min_time_episode:
-                print("Warning, ignoring short episode with {episode['duration']}s duration. Required min_duration={min_time_episode}s!")
+                print(f"Warning, ignoring short episode with {episode['duration']}s duration. Required min_duration={min_time_episode}s!")
+                continue
 
             if not language == '*':
                 if not episode['language'] == language:
@@ -534,7 +543,7 @@ def process(server_api_url, api_secret_key, dev_n=10, test_n=10, test_dev_episod
                                      export_format='kaldi', tsv_dataset_name='custom'):
 
     request_url = f"{server_api_url}/get_podcast_list/{language}/{api_secret_key}"
-    response = requests.get(request_url)
+    response = requests.get(request_url, headers=accept_encoding_headers)
     podcast_list = response.json()
 
     print('Number of podcasts:', len(podcast_list))
@@ -1,8 +1,13 @@
 import threading
+import time
 from contextlib import contextmanager
-from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 import psycopg2
 
+class PoolTimeout(PoolError):
+    """Raised when no pooled connection became free within the checkout timeout."""
+    pass
+
 class _ThreadLocalState(threading.local):
     def __init__(self):
         self.conn = None
@@ -13,14 +18,60 @@ class PooledConnectionProxy:
     """
     Mimics a psycopg2 connection enough for your code:
     - .cursor() returns a per-thread cursor proxy
+    - .release() hands the thread's connection back to the pool (call it at request teardown)
     - .close() and pool cleanup handled at app teardown
     - .transaction() context manager for multi-statement writes
+
+    ThreadedConnectionPool raises immediately when all connections are in use. We put a
+    semaphore in front of it, so that a thread waits up to `timeout` seconds for a free
+    connection instead and only then gets a PoolTimeout.
+
+    Optional callbacks for monitoring: on_checkout(wait_seconds) is called after a connection
+    was checked out and on_checkin() after it was given back. `waiting` is the number of threads
+    that currently wait for a free connection (used for load shedding, see backpressure.py).
     """
     def __init__(self, **kwargs):
         minconn = int(kwargs.pop("minconn", 1))
         maxconn = int(kwargs.pop("maxconn", 10))
+        self.timeout = float(kwargs.pop("timeout", 10.))
+        self.on_checkout = kwargs.pop("on_checkout", None)
+        self.on_checkin = kwargs.pop("on_checkin", None)
+        self.maxconn = maxconn
         self.pool = ThreadedConnectionPool(minconn=minconn, maxconn=maxconn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
         self._tls = _ThreadLocalState()
+        self._waiting_lock = threading.Lock()
+        self.waiting = 0
+
+    def _getconn(self):
+        start = time.perf_counter()
+        # fast path without counting, if a connection is free right away
+        if not self._slots.acquire(blocking=False):
+            with self._waiting_lock:
+                self.waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.timeout)
+            finally:
+                with self._waiting_lock:
+                    self.waiting -= 1
+            if not acquired:
+                raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        if self.on_checkout is not None:
+            self.on_checkout(time.perf_counter() - start)
+        return conn
+
+    def _putconn(self, conn):
+        try:
+            self.pool.putconn(conn, close=conn.closed)
+        finally:
+            self._slots.release()
+            if self.on_checkin is not None:
+                self.on_checkin()
 
     def _ensure_conn_cur(self, readonly=True):
         # If we're inside an explicit transaction, reuse the txn connection.
@@ -30,8 +81,12 @@ class PooledConnectionProxy:
             return self._tls.conn, self._tls.cur
 
         # Otherwise: get/refresh a thread-local autocommit connection.
-        if self._tls.conn is None or self._tls.conn.closed:
-            conn = self.pool.getconn()
+        if self._tls.conn is not None and self._tls.conn.closed:
+            self._putconn(self._tls.conn)
+            self._tls.conn = None
+
+        if self._tls.conn is None:
+            conn = self._getconn()
             conn.autocommit = True  # read-only, single-statement mode
             self._tls.conn = conn
             self._tls.cur = None
@@ -62,6 +117,31 @@ class PooledConnectionProxy:
 
         return CursorProxy()
 
+    def commit(self):
+        """
+        Compatibility shim for code written against a plain psycopg2 connection
+        (e.g. TrainingSession). Connections handed out by cursor() are in autocommit
+        mode and transaction() commits on exit, so there is nothing to do here.
+        """
+        pass
+
+    def release(self):
+        """
+        Return the thread-local autocommit connection to the pool. The server calls this
+        at the end of every request, so that a connection is only held while a request
+        actually runs and not for the lifetime of a gunicorn thread.
+        """
+        if self._tls.in_txn or self._tls.conn is None:
+            return
+        conn, cur = self._tls.conn, self._tls.cur
+        self._tls.conn = None
+        self._tls.cur = None
+        try:
+            if cur is not None and not cur.closed:
+                cur.close()
+        finally:
+            self._putconn(conn)
+
     @contextmanager
     def transaction(self):
         """
@@ -75,7 +155,16 @@ class PooledConnectionProxy:
             # Nested transactions not supported in this simple wrapper
             raise RuntimeError("Nested transactions are not supported")
 
-        conn = self.pool.getconn()
+        # A thread that already holds its autocommit connection runs the transaction on it. Checking out a second
+        # connection would deadlock the pool under load: every thread holds one slot and waits for another.
+        if self._tls.conn is not None and self._tls.conn.closed:
+            self._putconn(self._tls.conn)
+            self._tls.conn = None
+            self._tls.cur = None
+        prev_conn, prev_cur = self._tls.conn, self._tls.cur
+        reuse = prev_conn is not None
+
+        conn = prev_conn if reuse else self._getconn()
         try:
             conn.autocommit = False
             cur = conn.cursor()
@@ -90,26 +179,57 @@ class PooledConnectionProxy:
                 conn.rollback()
                 raise
             finally:
-                try:
-                    cur.close()
-                finally:
-                    self._tls.cur = None
-                    self._tls.conn = None
-                    self._tls.in_txn = False
-                    self.pool.putconn(conn)
-        except:
+                cur.close()
+        except Exception:
             # Ensure pool gets a good connection back even on unexpected errors
-            if conn:
+            if not conn.closed:
                 try:
                     conn.rollback()
                 except Exception:
                     pass
+            raise
+        finally:
+            self._tls.in_txn = False
+            self._tls.conn = prev_conn
+            self._tls.cur = prev_cur
+            if not reuse:
+                self._putconn(conn)
+            elif not conn.closed:
                 try:
-                    self.pool.putconn(conn)
+                    conn.autocommit = True
+                except Exception:
+                    # unusable, _ensure_conn_cur replaces closed connections
+                    conn.close()
+
+    @contextmanager
+    def server_side_cursor(self, name, itersize=2000):
+        """
+        Named (server-side) cursor for reading big result sets in chunks, e.g. for streaming responses.
+        It uses its own pooled connection and doesn't touch the thread-local state, so it can be used
+        from a generator that outlives the request handler.
+        Example:
+            with p_connection.server_side_cursor('export') as cur:
+                cur.execute("SELECT ...")
+                for record in cur:
+                    ...
+        """
+        conn = self._getconn()
+        try:
+            # named cursors only exist inside a transaction
+            conn.autocommit = False
+            cur = conn.cursor(name=name)
+            cur.itersize = itersize
+            try:
+                yield cur
+            finally:
+                cur.close()
+        finally:
+            if not conn.closed:
+                try:
+                    conn.rollback()
                 except Exception:
                     pass
-            raise
+            self._putconn(conn)
 
     def closeall(self):
         self.pool.closeall()
-
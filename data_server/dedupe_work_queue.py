@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Marks queued episodes with byte-identical audio as duplicates, so that only one of them is transcribed.
+
+New audio hashes are copied to the work queue by the filehashes_work_queue trigger (schema.psql) as soon as
+create_filehashes.py stores them. This script does the same for the hashes that were stored before the trigger
+existed, and can be run again any time:
+
+1. copies the audio hashes from filehashes to work_queue.file_hash (matched by the cache file of the episode)
+2. for every hash with more than one episode, marks the pending ones as 'duplicate' of one episode that is
+   already done, else in progress, else of the oldest pending one (mark_duplicate_work in schema.psql)
+
+The server links the transcript of that episode to its duplicates when it is uploaded, duplicates of episodes that
+are already done are completed by the duplicate resolver of server.py (duplicate_resolve_interval) within a few
+minutes. Apply schema.psql first. Everything runs in a single transaction, use --simulate to only print the counts.
+"""
+import argparse
+from utils import load_config, connect_to_db
+
+backfill_query = """
+    UPDATE work_queue q SET file_hash = fh.file_hash
+    FROM podcasts p JOIN filehashes fh ON fh.file_path = p.cache_audio_file AND fh.file_type = 'audio'
+    WHERE p.podcast_episode_id = q.episode_id AND q.file_hash IS DISTINCT FROM fh.file_hash
+"""
+
+mark_query = """
+    SELECT coalesce(sum(mark_duplicate_work(file_hash)), 0)
+    FROM (SELECT file_hash FROM work_queue WHERE file_hash IS NOT NULL GROUP BY file_hash HAVING count(*) > 1) hashes
+"""
+
+def dedupe(conn, cursor, simulate=False):
+    conn.autocommit = False
+
+    try:
+        cursor.execute(backfill_query)
+        print('Audio hashes copied to the work queue:', cursor.rowcount)
+
+        cursor.execute(mark_query)
+        print('Pending episodes marked as duplicates:', cursor.fetchone()[0])
+
+        cursor.execute("""
+            SELECT status, count(*), coalesce(sum(duration), 0) / 3600. FROM work_queue
+            GROUP BY status ORDER BY status
+        """)
+        for status, count, hours in cursor.fetchall():
+            print(f'  {status}: {count} episodes, {hours:.1f} hours')
+
+        if simulate:
+            print('Simulation, rolling back.')
+            conn.rollback()
+        else:
+            conn.commit()
+            print('Done.')
+    except Exception:
+        conn.rollback()
+        raise
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mark queued episodes with identical audio as duplicates.')
+    parser.add_argument('--simulate', action='store_true', help='Print what would be marked and roll back')
+    args = parser.parse_args()
+
+    config = load_config()
+    conn, cursor = connect_to_db(database=config["database"], user=config["user"], password=config["password"],
+                                 host=config["host"], port=config["port"])
+    dedupe(conn, cursor, simulate=args.simulate)
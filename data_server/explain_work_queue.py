@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Compares the query plans of the old dispatch queries (sentinel values in the wide podcasts table) with the
+work_queue queries in server.py, using EXPLAIN (ANALYZE, BUFFERS) on synthetic data.
+
+The script creates a scratch schema (default: work_queue_bench) with a podcasts copy of --rows rows and wide
+filler columns like description and episode_json, and the matching work_queue table with its partial indexes.
+The schema is dropped at the end unless --keep is given. Data modifying queries are run in a transaction
+that is rolled back.
+
+Example:
+    python3 explain_work_queue.py --rows 5000000 --language de
+"""
+import argparse
+from utils import load_config, connect_to_db
+
+setup_queries = [
+    "DROP SCHEMA IF EXISTS {schema} CASCADE",
+    "CREATE SCHEMA {schema}",
+    """
+    CREATE TABLE {schema}.podcasts (
+        podcast_episode_id INTEGER PRIMARY KEY,
+        podcast_title TEXT,
+        episode_title TEXT,
+        authors TEXT,
+        language VARCHAR(16),
+        description TEXT,
+        episode_audio_url TEXT,
+        cache_audio_url TEXT,
+        cache_audio_file TEXT,
+        transcript_file TEXT,
+        duration REAL,
+        episode_json JSON,
+        lease_owner TEXT,
+        lease_expires_at TIMESTAMPTZ
+    )
+    """,
+    # 5 languages, 20000 authors, about 30% untranscribed and 1% in progress
+    """
+    INSERT INTO {schema}.podcasts
+    SELECT i, 'podcast ' || (i %% 20000), 'episode ' || i, 'author ' || (i %% 20000),
+           (ARRAY['de', 'en', 'fr', 'es', 'nl'])[1 + (i / 20000) %% 5],
+           repeat(md5(i::text), %(filler)s / 64),
+           'https://example.com/' || i || '.mp3', 'https://cache.example.com/' || i || '.mp3',
+           '/cache/' || i || '.mp3',
+           CASE WHEN i %% 100 = 0 THEN 'in_progress' WHEN i %% 10 < 3 THEN '' ELSE '/vtt/' || i || '.mp3.vtt' END,
+           60 + (i::bigint * 7919) %% 7200,
+           json_build_object('summary', repeat(md5((i + 1)::text), %(filler)s / 64)),
+           NULL, NULL
+    FROM generate_series(1, %(rows)s) AS i
+    """,
+    # the indexes that existed on podcasts before the work queue
+    "CREATE INDEX ON {schema}.podcasts (cache_audio_file)",
+    """
+    CREATE TABLE {schema}.work_queue (
+        episode_id INTEGER PRIMARY KEY,
+        language VARCHAR(16) NOT NULL,
+        author_id INTEGER NOT NULL,
+        duration REAL,
+        status TEXT NOT NULL,
+        claimed_at TIMESTAMPTZ,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires_at TIMESTAMPTZ
+    ) WITH (fillfactor = 80)
+    """,
+    """
+    INSERT INTO {schema}.work_queue (episode_id, language, author_id, duration, status)
+    SELECT podcast_episode_id, language, hashtext(authors), duration,
+           CASE transcript_file WHEN '' THEN 'pending' WHEN 'in_progress' THEN 'in_progress' ELSE 'done' END
+    FROM {schema}.podcasts
+    """,
+    "CREATE INDEX ON {schema}.work_queue (language, author_id) WHERE status = 'pending'",
+    "CREATE INDEX ON {schema}.work_queue (language, duration) WHERE status = 'pending'",
+    "CREATE INDEX ON {schema}.work_queue (lease_expires_at) WHERE status = 'in_progress'",
+    "VACUUM ANALYZE {schema}.podcasts",
+    "VACUUM ANALYZE {schema}.work_queue",
+]
+
+# (name, old query on podcasts, new query on work_queue, modifies data)
+comparisons = [
+    ('count authors (get_work step 1)',
+     """SELECT COUNT(DISTINCT authors) FROM {schema}.podcasts
+        WHERE transcript_file = '' AND language = %(language)s""",
+     """SELECT COUNT(DISTINCT author_id) FROM {schema}.work_queue
+        WHERE status = 'pending' AND language = %(language)s""",
+     False),
+    ('sample episode of an author (get_work step 4)',
+     """SELECT podcast_episode_id, episode_title, authors, cache_audio_file FROM {schema}.podcasts
+        WHERE transcript_file = '' AND language = %(language)s AND authors = 'author 42'
+        OFFSET floor(random() * 5) LIMIT 1""",
+     """SELECT p.podcast_episode_id, p.episode_title, p.authors, p.cache_audio_file
+        FROM {schema}.work_queue q JOIN {schema}.podcasts p ON p.podcast_episode_id = q.episode_id
+        WHERE q.status = 'pending' AND q.language = %(language)s AND q.author_id = hashtext('author 42')
+        OFFSET floor(random() * 5) LIMIT 1""",
+     False),
+    ('batch by duration (get_work_batch)',
+     """SELECT podcast_episode_id, cache_audio_file, duration FROM {schema}.podcasts
+        WHERE transcript_file = '' AND language = %(language)s AND duration >= 600
+        ORDER BY duration LIMIT 32""",
+     """SELECT p.podcast_episode_id, p.cache_audio_file, q.duration
+        FROM {schema}.work_queue q JOIN {schema}.podcasts p ON p.podcast_episode_id = q.episode_id
+        WHERE q.status = 'pending' AND q.language = %(language)s AND q.duration >= 600
+        ORDER BY q.duration LIMIT 32""",
+     False),
+    ('claim batch (claim_work n=32)',
+     """UPDATE {schema}.podcasts SET transcript_file = 'in_progress', lease_owner = 'bench'
+        WHERE podcast_episode_id IN (
+            SELECT podcast_episode_id FROM {schema}.podcasts
+            WHERE transcript_file = '' AND language = %(language)s AND duration >= 600
+            ORDER BY duration LIMIT 32 FOR UPDATE SKIP LOCKED)""",
+     """UPDATE {schema}.work_queue SET status = 'in_progress', claimed_at = now(), lease_owner = 'bench'
+        WHERE episode_id IN (
+            SELECT episode_id FROM {schema}.work_queue
+            WHERE status = 'pending' AND language = %(language)s AND duration >= 600
+            ORDER BY duration LIMIT 32 FOR UPDATE SKIP LOCKED)""",
+     True),
+    ('expired leases (reaper)',
+     """SELECT podcast_episode_id FROM {schema}.podcasts
+        WHERE transcript_file = 'in_progress' AND lease_expires_at < now()""",
+     """SELECT episode_id FROM {schema}.work_queue
+        WHERE status = 'in_progress' AND lease_expires_at < now()""",
+     False),
+]
+
+def explain(conn, cursor, query, params, modifies):
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+    plan = '\n'.join(row[0] for row in cursor.fetchall())
+    if modifies:
+        conn.rollback()
+    return plan
+
+def print_sizes(cursor, schema):
+    cursor.execute("""
+        SELECT c.relname, pg_size_pretty(pg_total_relation_size(c.oid))
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relkind IN ('r', 'i')
+        ORDER BY pg_total_relation_size(c.oid) DESC
+    """, (schema,))
+    for name, size in cursor.fetchall():
+        print(f'  {name}: {size}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EXPLAIN ANALYZE the sentinel based dispatch queries against the work_queue queries.')
+    parser.add_argument('--rows', type=int, default=5000000, help='Number of synthetic episodes')
+    parser.add_argument('--filler', type=int, default=1024, help='Bytes of filler text in description and episode_json')
+    parser.add_argument('--language', default='de', help='Language to sample from')
+    parser.add_argument('--schema', default='work_queue_bench', help='Scratch schema, it is dropped and recreated')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch schema')
+    parser.add_argument('--skip-setup', action='store_true', help='Reuse the scratch schema of a previous run (--keep)')
+    args = parser.parse_args()
+
+    config = load_config()
+    conn, cursor = connect_to_db(database=config["database"], user=config["user"], password=config["password"],
+                                 host=config["host"], port=config["port"])
+
+    if not args.skip_setup:
+        print(f'Creating {args.rows} synthetic episodes in schema {args.schema}, this takes a while...')
+        for query in setup_queries:
+            cursor.execute(query.format(schema=args.schema), {'rows': args.rows, 'filler': args.filler})
+
+    print('Relation sizes:')
+    print_sizes(cursor, args.schema)
+
+    conn.autocommit = False
+    params = {'language': args.language}
+    for name, old_query, new_query, modifies in comparisons:
+        print()
+        print('=' * 100)
+        print(name)
+        print('=' * 100)
+        print('--- before: sentinel values in podcasts ---')
+        print(explain(conn, cursor, old_query.format(schema=args.schema), params, modifies))
+        print('--- after: work_queue ---')
+        print(explain(conn, cursor, new_query.format(schema=args.schema), params, modifies))
+    conn.rollback()
+    conn.autocommit = True
+
+    if not args.keep:
+        cursor.execute(f'DROP SCHEMA {args.schema} CASCADE')
+
+    cursor.close()
+    conn.close()
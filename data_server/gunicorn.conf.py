@@ -0,0 +1,20 @@
+# Gunicorn settings for server.py, used by start_wsgi.sh (gunicorn -c gunicorn.conf.py ...)
+import os
+import shutil
+
+# prometheus_client multiprocess mode: every worker writes its metrics to memory mapped files in this directory and
+# /metrics aggregates them. It has to be set before the workers import prometheus_client.
+prometheus_multiproc_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/speechcatcher_prometheus')
+
+def on_starting(server):
+    # Metrics files of a previous run would be added to the new counters
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    # Drops the live gauges (e.g. pool connections in use) of a worker that exited
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
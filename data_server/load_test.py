@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Load test for the data server on a single machine, no GPU needed.
+
+1. Creates (or reuses) a scratch database, applies schema.psql and fills it with --episodes synthetic episodes
+   of --authors authors in --languages, with fake cache files and durations between 1 minute and 3 hours.
+2. Starts server.py under gunicorn on that database, with a temporary copy of config.yaml
+   (SPEECHCATCHER_CONFIG) that points database and vtt_dir to the scratch database and a temporary directory.
+3. Runs --workers simulated workers (spread over --client-processes processes) for --duration seconds. Each
+   one runs get_work -> register_wip -> upload_result with a fake vtt (--upload-ratio of the cycles) or
+   cancel_work, see bench_async_dispatch.py.
+4. Reports throughput, latency percentiles per endpoint, claim collisions (register_wip of work that another
+   worker registered first), client errors, CPU time of postgres and gunicorn and the db transaction counts.
+
+Postgres has to run on the same machine for the CPU numbers, they are read from /proc. The db user from
+config.yaml needs the CREATEDB privilege (or create the scratch database yourself). The scratch database
+is never the one from config.yaml.
+
+Example:
+    python3 load_test.py --episodes 200000 --workers 2000 --duration 120 --gunicorn-workers 8 --threads 128
+
+To test another server (e.g. server_async.py under uvicorn) on the populated scratch database, start it yourself
+with SPEECHCATCHER_CONFIG=<printed config> and use --server-url http://127.0.0.1:6001 --skip-populate.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import yaml
+
+from bench_async_dispatch import DispatchStats, simulated_worker
+from utils import load_config, connect_to_db
+
+populate_queries = [
+    "TRUNCATE podcasts, work_queue, lease_reclaims RESTART IDENTITY CASCADE",
+    # the sync triggers would insert the work queue rows one by one, it is filled in one go below
+    "ALTER TABLE podcasts DISABLE TRIGGER USER",
+    """
+    INSERT INTO podcasts (podcast_title, episode_title, published_date, retrieval_time, authors, language,
+                          description, keywords, episode_url, episode_audio_url, cache_audio_url, cache_audio_file,
+                          transcript_file, duration, type, episode_json, model)
+    SELECT 'podcast ' || (i %% %(authors)s), 'episode ' || i, '2024-01-01', extract(epoch FROM now()),
+           'author ' || (i %% %(authors)s), (%(languages)s::text[])[1 + (i / 97) %% cardinality(%(languages)s::text[])],
+           repeat(md5(i::text), 8), 'load test', 'https://example.com/' || i,
+           'https://example.com/' || i || '.mp3', 'https://cache.example.com/' || i || '.mp3',
+           %(cache_dir)s || '/' || (i %% %(authors)s) || '/' || i || '.mp3',
+           CASE WHEN random() < %(done_ratio)s THEN '/vtt/' || i || '.mp3.vtt' ELSE '' END,
+           60 + (i * 7919) %% 10740, 'audio/mpeg', '{}'::json, NULL
+    FROM generate_series(1, %(episodes)s) AS i
+    """,
+    "ALTER TABLE podcasts ENABLE TRIGGER USER",
+    """
+    INSERT INTO work_queue (episode_id, language, author_id, duration, status)
+    SELECT podcast_episode_id, language, hashtext(authors), duration,
+           CASE WHEN transcript_file = '' THEN 'pending' ELSE 'done' END::work_status
+    FROM podcasts
+    """,
+    "VACUUM ANALYZE podcasts",
+    "VACUUM ANALYZE work_queue",
+]
+
+def create_database(config, database):
+    conn, cursor = connect_to_db(database='postgres', user=config["user"], password=config["password"],
+                                 host=config["host"], port=config["port"])
+    cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', (database,))
+    if cursor.fetchone() is None:
+        print('Creating database', database)
+        cursor.execute(f'CREATE DATABASE {database}')
+    cursor.close()
+    conn.close()
+
+def populate(cursor, args, cache_dir):
+    print('Applying schema.psql')
+    with open('schema.psql') as schema_file:
+        cursor.execute(schema_file.read())
+
+    print(f'Creating {args.episodes} synthetic episodes of {args.authors} authors, this takes a while...')
+    params = {'episodes': args.episodes, 'authors': args.authors, 'languages': args.languages.split(','),
+              'done_ratio': args.done_ratio, 'cache_dir': cache_dir}
+    for query in populate_queries:
+        cursor.execute(query, params)
+
+    cursor.execute('SELECT language, status, count(*) FROM work_queue GROUP BY language, status ORDER BY 1, 2')
+    for language, status, count in cursor.fetchall():
+        print(f'  {language} {status}: {count}')
+
+# CPU seconds (user + system) of the processes with the given pids or command name, from /proc
+def process_cpu_seconds(pids=None, comm=None):
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0.
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # the command name is in parentheses and may contain spaces
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        ppid = int(fields[1])
+        if (pids is not None and (int(pid) in pids or ppid in pids)) or (comm is not None and name.startswith(comm)):
+            total += (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+def db_counters(cursor, database):
+    cursor.execute('SELECT xact_commit, xact_rollback, deadlocks, tup_updated, blks_hit, blks_read '
+                   'FROM pg_stat_database WHERE datname = %s', (database,))
+    return dict(zip(['commits', 'rollbacks', 'deadlocks', 'tuples_updated', 'blocks_hit', 'blocks_read'],
+                    cursor.fetchone()))
+
+def start_server(args, config_filename):
+    command = ['gunicorn', '-c', 'gunicorn.conf.py', f'--workers={args.gunicorn_workers}', f'--threads={args.threads}',
+               f'--bind=127.0.0.1:{args.port}', '--worker-class=gthread', 'server:app']
+    print('Starting', ' '.join(command))
+    env = dict(os.environ, SPEECHCATCHER_CONFIG=config_filename)
+    # quiet, the server prints every sampled episode
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+
+    url = f'http://127.0.0.1:{args.port}'
+    for _ in range(120):
+        if server.poll() is not None:
+            sys.exit(f'gunicorn exited with code {server.returncode}, run with --verbose to see its output')
+        try:
+            httpx.get(url + '/metrics', timeout=1.)
+            return server, url
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    server.terminate()
+    sys.exit('gunicorn did not start within 60 seconds')
+
+async def drive(url, api_key, languages, workers, duration, upload_ratio, pause):
+    stats = DispatchStats()
+    limits = httpx.Limits(max_connections=workers, max_keepalive_connections=workers)
+    async with httpx.AsyncClient(limits=limits, timeout=60.) as client:
+        deadline = time.time() + duration
+        await asyncio.gather(*[simulated_worker(client, stats, url, api_key, languages[i % len(languages)],
+                                                deadline, upload_ratio, pause)
+                               for i in range(workers)])
+    return stats
+
+def client_process(job):
+    random.seed()
+    return asyncio.run(drive(*job))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the data server with simulated workers on a scratch db.')
+    parser.add_argument('--database', default='speechcatcher_loadtest', help='Scratch database, it is truncated and refilled')
+    parser.add_argument('--episodes', type=int, default=100000, help='Number of synthetic episodes')
+    parser.add_argument('--authors', type=int, default=5000, help='Number of synthetic authors')
+    parser.add_argument('--languages', default='de,en,fr', help='Comma separated languages of the episodes and workers')
+    parser.add_argument('--done-ratio', type=float, default=0.3, help='Fraction of the episodes that are already transcribed')
+    parser.add_argument('--skip-populate', action='store_true', help='Reuse the data of a previous run')
+    parser.add_argument('--workers', type=int, default=2000, help='Number of simulated workers')
+    parser.add_argument('--client-processes', type=int, default=4, help='Processes for the simulated workers')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to run the simulated workers')
+    parser.add_argument('--upload-ratio', type=float, default=0.2, help='Fraction of cycles that upload instead of cancel')
+    parser.add_argument('--pause', type=float, default=0.5, help='Mean seconds a worker "transcribes" between register and upload/cancel')
+    parser.add_argument('--gunicorn-workers', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=128, help='Threads per gunicorn worker')
+    parser.add_argument('--port', type=int, default=6100)
+    parser.add_argument('--server-url', default=None, help='Use an already running server instead of starting gunicorn')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of gunicorn')
+    args = parser.parse_args()
+
+    config = load_config()
+    if args.database == config["database"]:
+        sys.exit('The load test truncates its database, use a scratch database and not the one from config.yaml')
+
+    tmp_dir = tempfile.mkdtemp(prefix='speechcatcher_loadtest_')
+    test_config = dict(config, database=args.database, vtt_dir=os.path.join(tmp_dir, 'vtt'), lease_reaper_interval=10)
+    config_filename = os.path.join(tmp_dir, 'config.yaml')
+    with open(config_filename, 'w') as config_file:
+        yaml.safe_dump(test_config, config_file)
+    print('Load test config:', config_filename)
+
+    if not args.skip_populate:
+        create_database(config, args.database)
+    conn, cursor = connect_to_db(database=args.database, user=config["user"], password=config["password"],
+                                 host=config["host"], port=config["port"])
+    if not args.skip_populate:
+        populate(cursor, args, os.path.join(tmp_dir, 'cache'))
+
+    server = None
+    url = args.server_url
+    if url is None:
+        server, url = start_server(args, config_filename)
+
+    server_pids = {server.pid} if server is not None else set()
+    db_cpu_start = process_cpu_seconds(comm='postgres')
+    server_cpu_start = process_cpu_seconds(pids=server_pids)
+    counters_start = db_counters(cursor, args.database)
+
+    languages = args.languages.split(',')
+    processes = max(1, min(args.client_processes, args.workers))
+    jobs = [(url, config["secret_api_key"], languages, args.workers // processes + (i < args.workers % processes),
+             args.duration, args.upload_ratio, args.pause) for i in range(processes)]
+
+    print(f'Running {args.workers} simulated workers in {processes} processes for {args.duration}s against {url}')
+    start = time.time()
+    try:
+        with multiprocessing.Pool(processes) as client_pool:
+            results = client_pool.map(client_process, jobs)
+    finally:
+        elapsed = time.time() - start
+        db_cpu = process_cpu_seconds(comm='postgres') - db_cpu_start
+        server_cpu = process_cpu_seconds(pids=server_pids) - server_cpu_start
+        counters_end = db_counters(cursor, args.database)
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+    stats = DispatchStats()
+    for result in results:
+        stats.merge(result)
+    stats.report(elapsed, f'{url}, {args.workers} workers, {args.gunicorn_workers}x{args.threads} gunicorn threads')
+
+    print()
+    print(f'postgres CPU: {db_cpu:.1f}s ({db_cpu / elapsed * 100.:.0f}% of one core)')
+    if server is not None:
+        # only the gunicorn processes that still run at the end are counted
+        print(f'gunicorn CPU: {server_cpu:.1f}s ({server_cpu / elapsed * 100.:.0f}% of one core)')
+    for counter, value in counters_end.items():
+        print(f'db {counter}: {value - counters_start[counter]}')
+
+    cursor.execute('SELECT status, count(*) FROM work_queue GROUP BY status ORDER BY status')
+    print('Work queue after the run:', ', '.join(f'{status}: {count}' for status, count in cursor.fetchall()))
+
+    cursor.close()
+    conn.close()
@@ -0,0 +1,151 @@
+"""
+Prometheus metrics for the data server (served by server.py under /metrics).
+
+prometheus_client is optional: without it all functions here are no-ops and /metrics returns 404.
+
+Under gunicorn every worker process has its own counters. With PROMETHEUS_MULTIPROC_DIR set (see
+gunicorn.conf.py), prometheus_client keeps them in memory mapped files in that directory and /metrics
+aggregates the files of all processes, no matter which process serves the scrape.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                                   generate_latest, multiprocess)
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    print('Warning: prometheus_client not installed, /metrics is disabled.')
+    Counter = None
+
+enabled = Counter is not None
+
+# Buckets in seconds, db queries and pool waits are usually much faster than whole requests
+db_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+
+if enabled:
+    requests_total = Counter('speechcatcher_requests_total', 'HTTP requests by route, method and status code',
+                             ['route', 'method', 'status'])
+    request_seconds = Histogram('speechcatcher_request_duration_seconds', 'Time spent in the route handler',
+                                ['route', 'method'])
+    db_query_seconds = Histogram('speechcatcher_db_query_duration_seconds', 'Execution time of named db queries',
+                                 ['query'], buckets=db_buckets)
+    db_pool_wait_seconds = Histogram('speechcatcher_db_pool_wait_seconds', 'Time waiting for a free pooled db connection',
+                                     buckets=db_buckets)
+    db_pool_in_use = Gauge('speechcatcher_db_pool_connections_in_use', 'Checked out pooled db connections',
+                           multiprocess_mode='livesum')
+    db_pool_size = Gauge('speechcatcher_db_pool_connections_max', 'Maximum number of pooled db connections',
+                         multiprocess_mode='livesum')
+    load_shed_total = Counter('speechcatcher_load_shed_total', 'Requests rejected with 503 because the server was overloaded',
+                              ['route', 'reason'])
+    db_reads_total = Counter('speechcatcher_db_reads_total', 'Read-only queries by target (primary or replica host)',
+                             ['target'])
+    cache_lookups_total = Counter('speechcatcher_result_cache_lookups_total', 'Result cache lookups by route and result',
+                                  ['route', 'result'])
+
+def multiprocess_mode():
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ
+
+def observe_request(route, method, status, seconds):
+    if enabled:
+        requests_total.labels(route, method, status).inc()
+        request_seconds.labels(route, method).observe(seconds)
+
+@contextmanager
+def db_timer(name):
+    """Times the enclosed query, e.g. with db_timer('get_work.author_count'): cursor.execute(...)"""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        db_query_seconds.labels(name).observe(time.perf_counter() - start)
+
+# Callback for PreparedStatements, same histogram as db_timer
+def observe_db_query(name, seconds):
+    if enabled:
+        db_query_seconds.labels(name).observe(seconds)
+
+# Callback for ResultCache, keys start with the route name
+def observe_cache_lookup(key, hit):
+    if enabled:
+        cache_lookups_total.labels(key[0], 'hit' if hit else 'miss').inc()
+
+def observe_load_shed(route, reason):
+    if enabled:
+        load_shed_total.labels(route, reason).inc()
+
+# Callback for ReplicaRouter
+def observe_db_read(target):
+    if enabled:
+        db_reads_total.labels(target).inc()
+
+# Callbacks for PooledConnectionProxy
+def pool_checkout(wait_seconds):
+    if enabled:
+        db_pool_wait_seconds.observe(wait_seconds)
+        db_pool_in_use.inc()
+
+def pool_checkin():
+    if enabled:
+        db_pool_in_use.dec()
+
+def set_pool_size(maxconn):
+    if enabled:
+        db_pool_size.set(maxconn)
+
+class QueueHoursCollector:
+    """
+    Pending, in progress and done hours per language from the work queue. They are the same for all processes,
+    so they are queried when /metrics is scraped instead of being kept in per-process gauges. The result is
+    cached for `interval` seconds, the query sums up the whole queue table.
+    """
+    def __init__(self, db_cursor, table='work_queue', interval=60):
+        self.db_cursor = db_cursor
+        self.table = table
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.records = []
+        self.queried_at = 0.
+
+    def _query(self):
+        with self.lock:
+            if time.time() - self.queried_at > self.interval:
+                with db_timer('metrics.queue_hours'):
+                    self.db_cursor.execute(f'SELECT language, status, sum(duration) / 3600. FROM {self.table} '
+                                           'GROUP BY language, status')
+                self.records = self.db_cursor.fetchall()
+                self.queried_at = time.time()
+            return self.records
+
+    def _family(self):
+        return GaugeMetricFamily('speechcatcher_queue_hours', 'Hours of audio in the work queue by language and status',
+                                 labels=['language', 'status'])
+
+    # registering a collector with describe() doesn't call collect(), so the query only runs once per scrape
+    def describe(self):
+        yield self._family()
+
+    def collect(self):
+        hours = self._family()
+        for language, status, sum_hours in self._query():
+            hours.add_metric([language, str(status)], float(sum_hours or 0.))
+        yield hours
+
+def generate(extra_collectors=()):
+    """Returns the metrics of all processes (or of this process without multiprocess mode) and the content type."""
+    if multiprocess_mode():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        output = generate_latest(registry)
+    else:
+        output = generate_latest(REGISTRY)
+
+    extra_registry = CollectorRegistry()
+    for collector in extra_collectors:
+        extra_registry.register(collector)
+    return output + generate_latest(extra_registry), CONTENT_TYPE_LATEST
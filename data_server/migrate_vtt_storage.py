@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Moves existing vtt files into the layout configured in config.yaml (vtt_dir, vtt_shard_levels, vtt_shard_width,
+see vtt_storage.py) and updates podcasts.transcript_file accordingly, e.g. from the flat layout
+
+    {source_dir}/vtts/episode.mp3.vtt   ->   {source_dir}/vtts/3f/a2/episode.mp3.vtt
+
+Files are moved batch by batch, after every batch the new paths are written with one bulk UPDATE and committed.
+The migration can be interrupted and run again: files that are already at their new path (e.g. moved by an
+interrupted run whose UPDATE was not committed) only get their transcript_file updated. Transcripts in corrupted/
+directories (see sanity_check.py) are left where they are.
+
+Run it while the data server is stopped, or restart it right after the migration with the new layout in
+config.yaml, so that uploads don't go to the old layout in the meantime. Use --simulate to print the moves only.
+
+Example:
+    python3 migrate_vtt_storage.py --shard-levels 2 --simulate
+"""
+import argparse
+import os
+import shutil
+
+from psycopg2.extras import execute_values
+
+from utils import load_config, connect_to_db
+from vtt_storage import VttStorage, fsync_dir
+
+sql_table = 'podcasts'
+
+select_query = f"""
+    SELECT podcast_episode_id, cache_audio_file, transcript_file FROM {sql_table}
+    WHERE transcript_file IS NOT NULL AND transcript_file NOT IN ('', 'in_progress')
+    AND coalesce(cache_audio_file, '') <> '' AND transcript_file NOT LIKE '%/corrupted/%'
+    ORDER BY podcast_episode_id
+"""
+
+update_query = f"""
+    UPDATE {sql_table} p SET transcript_file = moved.new_path
+    FROM (VALUES %s) AS moved (episode_id, old_path, new_path)
+    WHERE p.podcast_episode_id = moved.episode_id AND p.transcript_file = moved.old_path
+"""
+
+def move_file(old_path, new_path, storage, simulate):
+    """Moves one vtt file, returns True if transcript_file should point to new_path."""
+    if os.path.exists(new_path) and (not os.path.exists(old_path) or os.path.samefile(old_path, new_path)):
+        # moved by an earlier, interrupted run, or the same file under another spelling of the path
+        return True
+    if not os.path.exists(old_path):
+        print('Warning, missing vtt file:', old_path)
+        return False
+    if os.path.exists(new_path):
+        print('Warning, not overwriting existing file:', new_path, '(from', old_path + ')')
+        return False
+    if simulate:
+        return True
+
+    storage.ensure_dir(os.path.dirname(new_path))
+    # a rename is atomic on the same file system, shutil.move copies (and then deletes) across file systems
+    shutil.move(old_path, new_path)
+    return True
+
+def migrate(conn, read_cursor, write_cursor, storage, batch_size=1000, simulate=False):
+    read_cursor.execute(select_query)
+    moved = skipped = unchanged = 0
+
+    while True:
+        records = read_cursor.fetchmany(batch_size)
+        if not records:
+            break
+
+        updates = []
+        for episode_id, cache_audio_file, transcript_file in records:
+            new_path = storage.path(cache_audio_file, create=False)
+            if new_path == transcript_file:
+                unchanged += 1
+                continue
+            if move_file(transcript_file, new_path, storage, simulate):
+                print('Move:', transcript_file, '->', new_path)
+                updates.append((episode_id, transcript_file, new_path))
+            else:
+                skipped += 1
+
+        if updates and not simulate:
+            # the renames have to be on disk before the db points to the new paths
+            for directory in {os.path.dirname(new_path) for _, _, new_path in updates}:
+                fsync_dir(directory)
+            execute_values(write_cursor, update_query, updates, page_size=len(updates))
+            conn.commit()
+        moved += len(updates)
+
+    verb = 'would be moved' if simulate else 'moved'
+    print(f'Done. Files {verb}: {moved}, already in the new layout: {unchanged}, skipped: {skipped}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move vtt files into the (sharded) layout from config.yaml and update transcript_file.')
+    parser.add_argument('--shard-levels', type=int, default=None, help='Overrides vtt_shard_levels from config.yaml, 0 for the flat layout')
+    parser.add_argument('--shard-width', type=int, default=None, help='Overrides vtt_shard_width from config.yaml')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Files per bulk UPDATE / commit')
+    parser.add_argument('--simulate', action='store_true', help='Only print what would be moved')
+    args = parser.parse_args()
+
+    config = load_config()
+    storage = VttStorage.from_config(config)
+    if args.shard_levels is not None:
+        storage.shard_levels = args.shard_levels
+    if args.shard_width is not None:
+        storage.shard_width = args.shard_width
+    print(f'Target layout: {storage.vtt_dir} with {storage.shard_levels} shard levels of width {storage.shard_width}')
+
+    conn, write_cursor = connect_to_db(database=config["database"], user=config["user"], password=config["password"],
+                                       host=config["host"], port=config["port"])
+    # the list of transcripts is read with a server-side cursor on its own connection, so that the commits of the
+    # batches don't close it
+    read_conn, _ = connect_to_db(database=config["database"], user=config["user"], password=config["password"],
+                                 host=config["host"], port=config["port"])
+    read_conn.autocommit = False
+    conn.autocommit = False
+
+    read_cursor = read_conn.cursor(name='migrate_vtt_storage')
+    read_cursor.itersize = args.batch_size
+    try:
+        migrate(conn, read_cursor, write_cursor, storage, batch_size=args.batch_size, simulate=args.simulate)
+    finally:
+        read_cursor.close()
+        read_conn.rollback()
+        read_conn.close()
+        conn.close()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Moves the dispatch state from the sentinel values in podcasts.transcript_file into the work_queue table.
+
+Before: transcript_file = ''            -> untranscribed
+        transcript_file = 'in_progress' -> work in progress (with lease_owner / lease_expires_at)
+        transcript_file = <path>        -> transcribed
+        transcript_file IS NULL         -> not part of the queue
+
+After:  work_queue.status = pending / in_progress / done, podcasts.transcript_file is '' or the path of the vtt file.
+
+Apply schema.psql first (it creates work_queue and the triggers), then run this script once. Everything runs
+in a single transaction, use --simulate to only print the counts.
+"""
+import argparse
+from utils import load_config, connect_to_db
+
+populate_query = """
+    INSERT INTO work_queue (episode_id, language, author_id, duration, status, claimed_at, attempts,
+                            lease_owner, lease_expires_at)
+    SELECT podcast_episode_id, coalesce(language, ''), hashtext(coalesce(authors, '')), duration,
+           CASE transcript_file WHEN '' THEN 'pending' WHEN 'in_progress' THEN 'in_progress' ELSE 'done' END::work_status,
+           CASE WHEN transcript_file = 'in_progress' THEN now() END,
+           CASE WHEN transcript_file = '' THEN 0 ELSE 1 END,
+           {lease_owner}, {lease_expires_at}
+    FROM podcasts
+    WHERE transcript_file IS NOT NULL
+    ON CONFLICT (episode_id) DO NOTHING
+"""
+
+def has_lease_columns(cursor):
+    cursor.execute("""
+        SELECT count(*) FROM information_schema.columns
+        WHERE table_name = 'podcasts' AND column_name IN ('lease_owner', 'lease_expires_at')
+    """)
+    return cursor.fetchone()[0] == 2
+
+def migrate(conn, cursor, simulate=False):
+    conn.autocommit = False
+
+    try:
+        # Leases were only added recently, databases that never had them start without leases
+        if has_lease_columns(cursor):
+            lease_columns = {'lease_owner': 'lease_owner', 'lease_expires_at': 'lease_expires_at'}
+        else:
+            lease_columns = {'lease_owner': 'NULL', 'lease_expires_at': 'NULL'}
+
+        cursor.execute(populate_query.format(**lease_columns))
+        print('Episodes added to the work queue:', cursor.rowcount)
+
+        # The triggers on podcasts keep the work in progress in progress
+        cursor.execute("UPDATE podcasts SET transcript_file = '' WHERE transcript_file = 'in_progress'")
+        print('Episodes with transcript_file = in_progress reset to empty string:', cursor.rowcount)
+
+        cursor.execute('DROP INDEX IF EXISTS lease_expires_at_index')
+        cursor.execute('ALTER TABLE podcasts DROP COLUMN IF EXISTS lease_owner, DROP COLUMN IF EXISTS lease_expires_at')
+
+        cursor.execute('SELECT status, count(*) FROM work_queue GROUP BY status ORDER BY status')
+        for status, count in cursor.fetchall():
+            print(f'  {status}: {count}')
+
+        if simulate:
+            print('Simulation, rolling back.')
+            conn.rollback()
+        else:
+            conn.commit()
+            print('Done.')
+    except Exception:
+        conn.rollback()
+        raise
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the transcript_file sentinel values to the work_queue table.')
+    parser.add_argument('--simulate', action='store_true', help='Print what would be migrated and roll back')
+    args = parser.parse_args()
+
+    config = load_config()
+    conn, cursor = connect_to_db(database=config["database"], user=config["user"], password=config["password"],
+                                 host=config["host"], port=config["port"])
+    migrate(conn, cursor, simulate=args.simulate)
+    cursor.close()
+    conn.close()
@@ -0,0 +1,124 @@
+import re
+import threading
+import time
+import weakref
+
+import psycopg2
+import psycopg2.errors
+
+# %(name)s, %s or %% in a psycopg2 query
+placeholder_re = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class PreparedStatements:
+    """
+    Registry of named hot-path queries that are prepared once per db connection (PREPARE) and then only run by name
+    (EXECUTE), so that postgres doesn't parse and plan the same SQL text on every request.
+
+    Queries are registered with their usual psycopg2 placeholders (%s or %(name)s), they are converted to $1, $2, ...
+    and execute() takes the same parameters as cursor.execute(). Which connection has prepared which statements is
+    kept in a WeakKeyDictionary, connections that are closed and dropped by the pool disappear from it on their own.
+
+    The registry also keeps the number of executions and the time spent per query (including the PREPARE), see
+    stats(), and passes every execution to on_execute(name, seconds), e.g. for metrics. With enabled=False the
+    queries are executed as plain SQL, with the same timing.
+    """
+    def __init__(self, enabled=True, on_execute=None):
+        self.enabled = enabled
+        self.on_execute = on_execute
+        self.queries = {}       # name -> (original query, statement name, parameter names or number of parameters)
+        self.prepared = weakref.WeakKeyDictionary()  # connection -> set of prepared names
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.seconds = {}
+        self.prepares = {}
+
+    def register(self, name, query, types=None):
+        """
+        Registers query under name, e.g. 'get_work.author_count'. types optionally lists the postgres types of the
+        parameters (e.g. ['varchar', 'integer']), otherwise postgres infers them when preparing.
+        """
+        names = []
+        positional = 0
+
+        def replace(match):
+            nonlocal positional
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                positional += 1
+                return f'${positional}'
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f'${names.index(match.group(1)) + 1}'
+
+        converted = placeholder_re.sub(replace, query)
+        if names and positional:
+            raise ValueError(f'{name}: mixed named and positional parameters')
+
+        statement = 'ps_' + re.sub(r'\W', '_', name)
+        type_list = f' ({", ".join(types)})' if types else ''
+        self.queries[name] = (query, statement, names if names else positional,
+                              f'PREPARE {statement}{type_list} AS {converted}')
+        with self.lock:
+            self.counts.setdefault(name, 0)
+            self.seconds.setdefault(name, 0.)
+            self.prepares.setdefault(name, 0)
+        return name
+
+    def execute_sql(self, name, params):
+        """Returns the EXECUTE statement and its parameters for the registered query name, e.g. for EXPLAIN."""
+        _, statement, parameters, _ = self.queries[name]
+        if isinstance(parameters, list):
+            params = [params[parameter] for parameter in parameters]
+        elif len(params) != parameters:
+            raise ValueError(f'{name} expects {parameters} parameters, got {len(params)}')
+        if not params:
+            return f'EXECUTE {statement}', ()
+        return f'EXECUTE {statement} ({", ".join(["%s"] * len(params))})', tuple(params)
+
+    def _prepare(self, cursor, name):
+        connection = cursor.connection
+        with self.lock:
+            names = self.prepared.setdefault(connection, set())
+        if name not in names:
+            cursor.execute(self.queries[name][3])
+            names.add(name)
+            with self.lock:
+                self.prepares[name] += 1
+        return names
+
+    def execute(self, cursor, name, params=()):
+        """Executes the registered query `name` on cursor, preparing it first if this connection hasn't yet."""
+        start = time.perf_counter()
+        try:
+            if not self.enabled:
+                cursor.execute(self.queries[name][0], params)
+                return
+
+            sql, values = self.execute_sql(name, params)
+            names = self._prepare(cursor, name)
+            try:
+                cursor.execute(sql, values)
+            except psycopg2.errors.InvalidSqlStatementName:
+                # the session lost its prepared statements (e.g. DISCARD ALL by a connection pooler). Outside of a
+                # transaction we can prepare again and retry, inside the transaction is aborted anyway.
+                names.clear()
+                if not cursor.connection.autocommit:
+                    raise
+                self._prepare(cursor, name)
+                cursor.execute(sql, values)
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.counts[name] += 1
+                self.seconds[name] += seconds
+            if self.on_execute is not None:
+                self.on_execute(name, seconds)
+
+    def stats(self):
+        with self.lock:
+            return {'enabled': self.enabled, 'connections': len(self.prepared),
+                    'queries': {name: {'executions': self.counts[name], 'prepares': self.prepares[name],
+                                       'total_seconds': self.seconds[name],
+                                       'mean_ms': self.seconds[name] / self.counts[name] * 1000. if self.counts[name] else 0.}
+                                for name in self.queries}}
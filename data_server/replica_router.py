@@ -0,0 +1,151 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from db_pool_proxy import PooledConnectionProxy, PoolTimeout
+
+class ReplicaRouter:
+    """
+    Sends read-only queries to streaming replicas of the db, so that big listings and exports don't compete with the
+    dispatch queries on the primary. Every replica has its own PooledConnectionProxy, a request sticks to the replica
+    it used first (so consecutive queries of a request see the same snapshot of the data), requests are spread over
+    the replicas round robin.
+
+    If a replica can't be reached (connection errors, pool timeouts) the query is retried on the next one and finally
+    on the primary. A failed replica is skipped for retry_interval seconds. Without replicas everything goes to the
+    primary, so the read routes work the same with and without this.
+
+    Replicas are asynchronous, reads can lag a little behind the primary. Only use this for routes that don't need
+    to see their own writes.
+
+    Usage:
+        r_cursor = router.cursor()
+        r_cursor.execute('SELECT ...')
+        records = r_cursor.fetchall()
+        router.release()  # at request teardown
+    """
+    # errors after which a query is retried on the next replica / the primary. Statement timeouts (QueryCanceledError
+    # is an OperationalError) are not retried, the query would only be as slow on the primary.
+    fallback_errors = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+    def __init__(self, primary, replica_dsns=(), retry_interval=30, on_route=None, **pool_kwargs):
+        self.primary = primary
+        self.replicas = [PooledConnectionProxy(**self.replica_connect_kwargs(dsn, pool_kwargs)) for dsn in replica_dsns]
+        self.names = {id(replica): psycopg2.extensions.parse_dsn(dsn).get('host', dsn)
+                      for replica, dsn in zip(self.replicas, replica_dsns)}
+        self.retry_interval = retry_interval
+        self.on_route = on_route
+        self.lock = threading.Lock()
+        self.down_until = {}
+        self.round_robin = itertools.count()
+        self._tls = threading.local()
+
+    @staticmethod
+    def replica_connect_kwargs(dsn, pool_kwargs):
+        # connection parameters that the dsn doesn't set (user, password, database, ...) are taken from the primary
+        given = psycopg2.extensions.parse_dsn(dsn)
+        return dict({key: value for key, value in pool_kwargs.items() if key not in given}, dsn=dsn)
+
+    def _name(self, pool):
+        return 'primary' if pool is self.primary else self.names[id(pool)]
+
+    def _candidates(self):
+        """Replicas to try for the current request, the one it already uses first, and then the primary."""
+        now = time.monotonic()
+        with self.lock:
+            healthy = [replica for replica in self.replicas if self.down_until.get(id(replica), 0.) <= now]
+        if healthy:
+            start = next(self.round_robin) % len(healthy)
+            healthy = healthy[start:] + healthy[:start]
+        current = getattr(self._tls, 'pool', None)
+        if current in healthy:
+            healthy.remove(current)
+            healthy.insert(0, current)
+        return healthy + [self.primary]
+
+    def _failed(self, pool, exc):
+        print(f'Warning: read replica {self._name(pool)} failed, skipping it for {self.retry_interval}s:', exc)
+        with self.lock:
+            self.down_until[id(pool)] = time.monotonic() + self.retry_interval
+        # drops the (possibly broken) connection of this thread, the pool closes it if it is closed
+        pool.release()
+        if getattr(self._tls, 'pool', None) is pool:
+            self._tls.pool = None
+
+    def _route(self, pool):
+        self._tls.pool = pool
+        if self.on_route is not None:
+            self.on_route(self._name(pool))
+
+    def execute(self, query, params=None):
+        for pool in self._candidates():
+            try:
+                pool.cursor().execute(query, params)
+            except self.fallback_errors as e:
+                if pool is self.primary or isinstance(e, psycopg2.extensions.QueryCanceledError):
+                    raise
+                self._failed(pool, e)
+                continue
+            self._route(pool)
+            return
+
+    def cursor(self):
+        """A cursor proxy: execute() picks a replica (see above), everything else goes to the cursor that executed."""
+        router = self
+
+        class ReadCursorProxy:
+            def execute(self, query, params=None):
+                router.execute(query, params)
+
+            def __getattr__(self, name):
+                pool = getattr(router._tls, 'pool', None) or router.primary
+                return getattr(pool.cursor(), name)
+
+        return ReadCursorProxy()
+
+    @contextmanager
+    def server_side_cursor(self, name, itersize=2000):
+        """Like PooledConnectionProxy.server_side_cursor, on a replica if one can be reached."""
+        for pool in self._candidates():
+            context = pool.server_side_cursor(name, itersize)
+            try:
+                cur = context.__enter__()
+            except self.fallback_errors as e:
+                if pool is self.primary or isinstance(e, psycopg2.extensions.QueryCanceledError):
+                    raise
+                self._failed(pool, e)
+                continue
+            if self.on_route is not None:
+                self.on_route(self._name(pool))
+            break
+
+        # the server-side cursor has its own connection, so the query can't switch replicas anymore
+        try:
+            yield cur
+        except BaseException as e:
+            if not context.__exit__(type(e), e, e.__traceback__):
+                raise
+        else:
+            context.__exit__(None, None, None)
+
+    def release(self):
+        """Gives the connections of the current request back to the replica pools (the primary's is released by its owner)."""
+        self._tls.pool = None
+        for replica in self.replicas:
+            replica.release()
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {'replicas': [{'name': self._name(replica),
+                                  'healthy': self.down_until.get(id(replica), 0.) <= now,
+                                  'waiting': replica.waiting}
+                                 for replica in self.replicas]}
+
+    def closeall(self):
+        for replica in self.replicas:
+            replica.closeall()
@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+class ResultCache:
+    """
+    Small in-process LRU cache with a TTL for the results of aggregate and read-mostly endpoints.
+
+    Keys are tuples of the route name and its arguments, e.g. ('get_podcast_list', 'de'). Every entry can have
+    tags (e.g. the languages it covers) and invalidate(tag) drops all entries with that tag. Each gunicorn worker
+    process has its own cache and only sees its own invalidations, changes made through other processes become
+    visible after at most `ttl` seconds.
+    """
+    def __init__(self, max_entries=256, ttl=300, on_lookup=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_lookup = on_lookup  # on_lookup(key, hit), e.g. for metrics
+        self.entries = OrderedDict()    # key -> (expires_at, tags, value)
+        self.keys_by_tag = defaultdict(set)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        return self.get_first([key])[1]
+
+    def get_first(self, keys):
+        """
+        Returns (key, value) of the first of keys that is cached, or (None, None). Counts as one lookup (of the first
+        key) in the stats, e.g. for a compressed variant of a response with a fallback to the plain one.
+        """
+        found_key, entry = None, None
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] < now:
+                    self._remove(key)
+                    entry = None
+                if entry is not None:
+                    found_key = key
+                    self.entries.move_to_end(key)
+                    break
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if self.on_lookup is not None:
+            self.on_lookup(keys[0], entry is not None)
+        return found_key, None if entry is None else entry[2]
+
+    def put(self, key, value, tags=()):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + self.ttl, tuple(tags), value)
+            for tag in tags:
+                self.keys_by_tag[tag].add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, tag):
+        with self.lock:
+            for key in list(self.keys_by_tag.get(tag, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_tag.clear()
+
+    def _remove(self, key):
+        _, tags, _ = self.entries.pop(key)
+        for tag in tags:
+            keys = self.keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_tag[tag]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else 0.,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
@@ -0,0 +1,275 @@
+import math
+import random
+import threading
+import time
+import traceback
+
+class AuthorSampler:
+    """
+    Untranscribed episode ids grouped by author, with O(1) add, remove and sampling.
+
+    Authors and episode ids are kept in plain lists, a removal swaps the last element into the
+    free slot. Sampling an author uniformly and then one of its episodes uniformly gives the same
+    distribution as the two-step SQL sampling in server.get_work.
+    """
+    def __init__(self):
+        self.authors = []       # authors that have at least one episode
+        self.author_pos = {}    # author -> index in self.authors
+        self.episodes = {}      # author -> list of episode ids
+        self.episode_pos = {}   # episode id -> (author, index in self.episodes[author])
+
+    def __len__(self):
+        return len(self.episode_pos)
+
+    def num_authors(self):
+        return len(self.authors)
+
+    def add(self, episode_id, author):
+        if episode_id in self.episode_pos:
+            return
+        if author not in self.episodes:
+            self.author_pos[author] = len(self.authors)
+            self.authors.append(author)
+            self.episodes[author] = []
+        author_episodes = self.episodes[author]
+        self.episode_pos[episode_id] = (author, len(author_episodes))
+        author_episodes.append(episode_id)
+
+    def remove(self, episode_id):
+        if episode_id not in self.episode_pos:
+            return False
+        author, pos = self.episode_pos.pop(episode_id)
+        author_episodes = self.episodes[author]
+        last = author_episodes.pop()
+        if last != episode_id:
+            author_episodes[pos] = last
+            self.episode_pos[last] = (author, pos)
+        if not author_episodes:
+            self._remove_author(author)
+        return True
+
+    def _remove_author(self, author):
+        del self.episodes[author]
+        pos = self.author_pos.pop(author)
+        last = self.authors.pop()
+        if last != author:
+            self.authors[pos] = last
+            self.author_pos[last] = pos
+
+    def sample(self, n=1):
+        """Returns up to n episode ids, each from a different random author."""
+        if not self.authors:
+            return []
+        authors = random.sample(self.authors, min(n, len(self.authors)))
+        return [random.choice(self.episodes[author]) for author in authors]
+
+class DurationBuckets:
+    """
+    Episode ids in log-spaced duration buckets, each bucket is an AuthorSampler. Used to build batches of similar
+    length episodes (less padding in batched transcription) from different authors in O(n), without sorting.
+
+    Bucket i covers durations in [min_duration * r^i, min_duration * r^(i+1)) with r = (max_duration / min_duration)^(1 / num_buckets),
+    shorter and longer episodes (and episodes without a duration) go into the first and last bucket.
+    """
+    def __init__(self, min_duration=30., max_duration=4 * 3600., num_buckets=16):
+        self.min_duration = min_duration
+        self.num_buckets = num_buckets
+        self.log_ratio = math.log(max_duration / min_duration) / num_buckets
+        self.buckets = [AuthorSampler() for _ in range(num_buckets)]
+        self.seconds = [0.] * num_buckets    # remaining audio per bucket, for weighting
+        self.durations = {}                  # episode id -> duration
+
+    def __len__(self):
+        return len(self.durations)
+
+    def bucket(self, duration):
+        if not duration or duration <= self.min_duration:
+            return 0
+        return min(int(math.log(duration / self.min_duration) / self.log_ratio), self.num_buckets - 1)
+
+    def lower_bound(self, i):
+        return self.min_duration * math.exp(self.log_ratio * i) if i > 0 else 0.
+
+    def add(self, episode_id, author, duration):
+        if episode_id in self.durations:
+            return
+        duration = duration or 0.
+        self.durations[episode_id] = duration
+        i = self.bucket(duration)
+        self.buckets[i].add(episode_id, author)
+        self.seconds[i] += duration
+
+    def remove(self, episode_id):
+        if episode_id not in self.durations:
+            return False
+        duration = self.durations.pop(episode_id)
+        i = self.bucket(duration)
+        self.buckets[i].remove(episode_id)
+        self.seconds[i] = max(self.seconds[i] - duration, 0.)
+        return True
+
+    def quantile_bucket(self, candidates, target):
+        """The bucket at the target quantile (0 = shortest, 1 = longest) of the remaining hours in the candidate buckets."""
+        weights = [self.seconds[i] for i in candidates]
+        if sum(weights) <= 0:
+            weights = [len(self.buckets[i]) for i in candidates]
+        threshold = target * sum(weights)
+        cumulative = 0.
+        for i, weight in zip(candidates, weights):
+            cumulative += weight
+            if cumulative >= threshold:
+                return i
+        return candidates[-1]
+
+    def sample(self, n, min_duration=0., weighting='hours', max_duration=None, target=None):
+        """
+        Picks a bucket, uniformly over the non-empty buckets or weighted by their remaining hours, and returns up to n
+        episode ids from different authors of that bucket. If the bucket has fewer authors than n, the neighbouring
+        buckets (longer ones first) fill up the batch. Episodes shorter than min_duration (or longer than max_duration)
+        are never returned. With a target quantile (see quantile_bucket), the bucket at that quantile is picked
+        instead, used to give long episodes to fast workers (worker_capabilities.py).
+        """
+        candidates = [i for i, bucket in enumerate(self.buckets)
+                      if len(bucket) and (i == self.num_buckets - 1 or self.lower_bound(i + 1) > min_duration)
+                      and (max_duration is None or self.lower_bound(i) <= max_duration)]
+        if not candidates:
+            return []
+        if target is not None:
+            first = self.quantile_bucket(candidates, target)
+        elif weighting == 'hours':
+            weights = [self.seconds[i] for i in candidates]
+            first = random.choices(candidates, weights=weights)[0] if sum(weights) > 0 else random.choice(candidates)
+        else:
+            first = random.choice(candidates)
+
+        # the chosen bucket, then alternating longer and shorter neighbours
+        order = [first]
+        for offset in range(1, self.num_buckets):
+            order += [i for i in (first + offset, first - offset) if i in candidates]
+
+        episode_ids = []
+        for i in order:
+            episode_ids += [episode_id for episode_id in self.buckets[i].sample(n - len(episode_ids))
+                            if self.durations[episode_id] >= min_duration
+                            and (max_duration is None or self.durations[episode_id] <= max_duration)]
+            if len(episode_ids) >= n:
+                break
+        return episode_ids
+
+    def stats(self):
+        return [{'min_duration': round(self.lower_bound(i), 1), 'episodes': len(bucket),
+                 'authors': bucket.num_authors(), 'hours': round(self.seconds[i] / 3600., 2)}
+                for i, bucket in enumerate(self.buckets)]
+
+class SamplingIndex:
+    """
+    Per language AuthorSampler for the pending episodes of the work queue, so that get_work doesn't
+    need to scan the queue on every call. Authors are identified by work_queue.author_id. The same
+    episodes are also kept in DurationBuckets, for batches of similar length (sample_batch).
+
+    Every gunicorn worker process has its own index and only sees the claims and cancellations that
+    it served itself. Sampled ids are therefore only candidates: the caller has to check (or claim)
+    them in the db and should remove candidates that turned out to be taken. A background thread
+    rebuilds all known languages every resync_interval seconds to pick up new episodes and the
+    changes made by other processes.
+    """
+    def __init__(self, db_connection, table='work_queue', resync_interval=600, bucket_options=None):
+        self.db_connection = db_connection
+        self.table = table
+        self.resync_interval = resync_interval
+        self.bucket_options = bucket_options or {}
+        self.samplers = {}
+        self.buckets = {}
+        self.build_stats = {}
+        self.lock = threading.Lock()
+        self.build_locks = {}
+        self.resync_thread = None
+
+    def _build_lock(self, language):
+        with self.lock:
+            return self.build_locks.setdefault(language, threading.Lock())
+
+    def rebuild(self, language):
+        """Loads all pending episodes of a language from the db and swaps in a fresh sampler."""
+        with self._build_lock(language):
+            self._load(language)
+
+    def _load(self, language):
+        start = time.time()
+        with self.db_connection.transaction() as cursor:
+            cursor.execute(f"""
+                SELECT episode_id, author_id, duration
+                FROM {self.table}
+                WHERE status = 'pending' AND language = %s
+            """, (language,))
+            records = cursor.fetchall()
+
+        sampler = AuthorSampler()
+        buckets = DurationBuckets(**self.bucket_options)
+        for episode_id, author, duration in records:
+            sampler.add(episode_id, author)
+            buckets.add(episode_id, author, duration)
+
+        build_seconds = time.time() - start
+        with self.lock:
+            self.samplers[language] = sampler
+            self.buckets[language] = buckets
+            self.build_stats[language] = {'built_at': time.time(), 'build_seconds': build_seconds}
+        print(f'Sampling index for {language} rebuilt in {build_seconds:.2f}s: '
+              f'{len(sampler)} episodes from {sampler.num_authors()} authors')
+
+    def _ensure(self, language):
+        if language not in self.samplers:
+            with self._build_lock(language):
+                # another thread may have built it while we waited for the lock
+                if language not in self.samplers:
+                    self._load(language)
+            self._start_resync_thread()
+
+    def sample(self, language, n=1):
+        self._ensure(language)
+        with self.lock:
+            return self.samplers[language].sample(n)
+
+    def sample_batch(self, language, n, min_duration=0., weighting='hours', max_duration=None, target=None):
+        """Up to n episodes of similar duration from different authors, see DurationBuckets.sample."""
+        self._ensure(language)
+        with self.lock:
+            return self.buckets[language].sample(n, min_duration, weighting, max_duration, target)
+
+    def add(self, language, episode_id, author, duration=None):
+        with self.lock:
+            if language in self.samplers:
+                self.samplers[language].add(episode_id, author)
+                self.buckets[language].add(episode_id, author, duration)
+
+    def remove(self, episode_ids):
+        with self.lock:
+            for episode_id in episode_ids:
+                for language, sampler in self.samplers.items():
+                    if sampler.remove(episode_id):
+                        self.buckets[language].remove(episode_id)
+                        break
+
+    def stats(self):
+        with self.lock:
+            return {language: {'episodes': len(sampler), 'authors': sampler.num_authors(), **self.build_stats[language],
+                               'duration_buckets': self.buckets[language].stats()}
+                    for language, sampler in self.samplers.items()}
+
+    def _start_resync_thread(self):
+        with self.lock:
+            if self.resync_thread is not None:
+                return
+            self.resync_thread = threading.Thread(target=self._resync_loop, name='sampling-index-resync', daemon=True)
+        self.resync_thread.start()
+
+    def _resync_loop(self):
+        while True:
+            time.sleep(self.resync_interval)
+            for language in list(self.samplers):
+                try:
+                    self.rebuild(language)
+                except Exception:
+                    print('Warning: could not resync sampling index for', language)
+                    traceback.print_exc()
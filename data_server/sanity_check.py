@@ -8,6 +8,7 @@ import re
 import json
 import gzip
 from utils import *
+from vtt_storage import find_vtt_files
 
 sql_table = 'podcasts'
 
@@ -47,7 +48,9 @@ def check_for_degenerate_vtts(vtt_dir, audio_dir='', file_type='vtt', language='
                               possibly_corrupted_outfile='possibly_corrupted.txt',
                               timestamps_tsv='timestamps.tsv',
                               p_connection=None, p_cursor=None, simulate=False, compression_threshold=None):
-    files = glob.glob(f'{vtt_dir}/*.{file_type}')
+    # recursive, vtt_dir can be sharded into hash-prefix subdirectories (see vtt_storage.py). Files that were already
+    # moved to a corrupted/ directory are skipped.
+    files = find_vtt_files(vtt_dir, file_type)
     
     if audio_dir=='':
         audio_files = []
@@ -150,9 +153,6 @@ def check_for_degenerate_vtts(vtt_dir, audio_dir='', file_type='vtt', language='
 
     if len(degen_files) > 0:
         corrupted_dir = "corrupted"
-        corrupted_dir_full = str(os.path.join(os.path.dirname(degen_files[0][0]), corrupted_dir))
-        print('creating dir', corrupted_dir_full, 'if it does not exist.')
-        ensure_dir(corrupted_dir_full)
         with open(possibly_corrupted_outfile, 'w') as outfile:
             for file, degen_num_lines, *rest in degen_files:
                 assert(file is not None)
@@ -173,6 +173,8 @@ def check_for_degenerate_vtts(vtt_dir, audio_dir='', file_type='vtt', language='
 
                     if new_path != file:
                         try:
+                            # every (shard) directory has its own corrupted/ directory
+                            ensure_dir(new_path)
                             print('Move:', file, '->', new_path)
                             os.rename(file, new_path)
                             if p_connection is not None:
@@ -1,5 +1,8 @@
 import argparse
 import flask
+import psycopg2
+import os
+import random
 import traceback
 import sys
 import threading
@@ -8,11 +11,24 @@ import time
 from collections import defaultdict
 
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from werkzeug.serving import WSGIRequestHandler
+from psycopg2.extras import execute_values
 
 from training_session_pg import TrainingSession
-from utils import load_config, connect_to_db, ensure_dir  
+from db_pool_proxy import PooledConnectionProxy, PoolTimeout
+from backpressure import LoadShedder
+from replica_router import ReplicaRouter
+from sampling_index import SamplingIndex
+from worker_capabilities import WorkerCapabilities
+from result_cache import ResultCache
+from work_notifier import WorkNotifier
+from prepared_statements import PreparedStatements
+import metrics
+import compression
+import vtt_stitch
+from utils import load_config, ensure_dir, make_local_url, parse_languages, language_order, status_error, unavailable_statuses
+from vtt_storage import VttStorage, link_or_copy
 
 p_connection, p_cursor = None, None
 
@@ -32,29 +48,375 @@ podcast_columns = 'podcast_episode_id, podcast_title, episode_title, published_d
                         'cache_audio_url, cache_audio_file, transcript_file, duration, type, episode_json, model'
 podcast_columns_list = podcast_columns.split(', ')
 
+work_columns = f'{sql_table_ids}, episode_title, authors, language, episode_audio_url, cache_audio_url, ' \
+            'cache_audio_file, transcript_file, duration'
+# work_columns qualified with the alias p, for queries that join podcasts with the work queue
+work_columns_p = ', '.join('p.' + column for column in work_columns.split(', '))
+
+# Dispatch state (pending, in_progress, done) lives in this narrow table, see schema.psql and migrate_work_queue.py
+queue_table = 'work_queue'
+
 # must be outside __main__ for gunicorn
 config = load_config()
 api_secret_key = config["secret_api_key"]
 vtt_dir = config["vtt_dir"]
 WSGIRequestHandler.protocol_version = 'HTTP/1.1'
-p_connection, p_cursor = connect_to_db(database=config["database"], user=config["user"], password=config["password"], host=config["host"], port=config["port"])
 
-def make_local_url(my_url, config):
-    if 'replace_local_audio_url' in config:
-        try:
-            if '->' not in config['replace_local_audio_url']:
-                return my_url
-            a, b = config['replace_local_audio_url'].split('->')
-            return my_url.replace(a, b)  # Make sure to return the modified URL
-        except Exception as e:
-            print('Warning, something went wrong trying to make local url out of:', my_url)
-            print('Error:', str(e))
-            print('Traceback:', traceback.format_exc())
-            print('Using original link instead')
-            return my_url
-    else:
-        print('Warning: replace_local_audio_url not in config, returning unmodified local link.')
-        return my_url
+# Every gunicorn worker process has its own pool. Each request checks out a connection on its first query
+# and gives it back in release_db_connection, so up to db_pool_maxconn requests per process can talk to
+# the db at the same time. Requests that find the pool exhausted wait up to db_pool_timeout seconds.
+# Load shedding: if the pool is saturated, requests for new work get a 503 with Retry-After right away, instead of
+# queueing up for a connection. Requests that finish work (register_wip, upload_result, cancel_work, heartbeat) are
+# never shed, they only get a 503 if they really time out waiting for a connection. See backpressure.py.
+load_shedder = LoadShedder(wait_threshold=config.get("overload_pool_wait_threshold", 1.),
+                           max_waiting=config.get("overload_max_waiting", 2 * config.get("db_pool_maxconn", 16)),
+                           retry_after=config.get("overload_retry_after", 5),
+                           max_retry_after=config.get("overload_max_retry_after", 60))
+
+def pool_checkout(wait_seconds):
+    metrics.pool_checkout(wait_seconds)
+    load_shedder.observe_wait(wait_seconds)
+
+db_connect_kwargs = dict(database=config["database"], user=config["user"], password=config["password"],
+                         host=config["host"], port=config["port"],
+                         connect_timeout=config.get("db_connect_timeout", 10))
+p_connection = PooledConnectionProxy(minconn=config.get("db_pool_minconn", 1),
+                                     maxconn=config.get("db_pool_maxconn", 16),
+                                     timeout=config.get("db_pool_timeout", 10),
+                                     options=f'-c statement_timeout={int(config.get("db_statement_timeout", 30000))}',
+                                     on_checkout=pool_checkout, on_checkin=metrics.pool_checkin,
+                                     **db_connect_kwargs)
+metrics.set_pool_size(p_connection.maxconn)
+# A cursor proxy that resolves to the cursor of the calling thread's connection
+p_cursor = p_connection.cursor()
+
+# Read-only routes (podcast and episode lists, exports, session_status, queue hours for /metrics) run on the streaming
+# replicas in replica_dsns (libpq connection strings like "host=replica1 port=5432", user, password and database default
+# to the primary's), so that they don't slow down dispatch on the primary. Unreachable replicas are skipped for
+# replica_retry_interval seconds and the reads fall back to the primary, without replicas all reads go to the primary.
+# See replica_router.py. Replica pools connect lazily (minconn=0), so a replica that is down doesn't stop the server.
+replica_router = ReplicaRouter(p_connection, config.get("replica_dsns", []),
+                               retry_interval=config.get("replica_retry_interval", 30),
+                               on_route=metrics.observe_db_read,
+                               minconn=0, maxconn=config.get("replica_db_pool_maxconn", config.get("db_pool_maxconn", 16)),
+                               timeout=config.get("db_pool_timeout", 10),
+                               options=f'-c statement_timeout={int(config.get("db_statement_timeout", 30000))}',
+                               **dict(db_connect_kwargs, connect_timeout=config.get("replica_connect_timeout", 3)))
+# Cursor proxy for the read-only routes, like p_cursor
+r_cursor = replica_router.cursor()
+
+# The hot dispatch queries (get_work, claim_work, register_wip, upload_result, cancel_work, heartbeat) are registered
+# by name, prepared once per pooled connection and then executed by name, so postgres doesn't parse and plan their SQL
+# on every request. Execution times go to the same metrics as db_timer, see also /apiv1/prepared_statement_stats.
+prepared = PreparedStatements(enabled=config.get("prepared_statements", True), on_execute=metrics.observe_db_query)
+
+@app.teardown_request
+def release_db_connection(exc):
+    p_connection.release()
+    replica_router.release()
+
+# Request counts and latencies per route for /metrics. The route label is the url rule (e.g.
+# /apiv1/get_work/<language>/<api_access_key>), so that api keys and ids don't end up in the metrics.
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - g.request_start)
+    return response
+
+def overloaded_response(reason):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe_load_shed(route, reason)
+    retry_after = load_shedder.retry_after()
+    response = jsonify({'success': False, 'error': f'Server overloaded ({reason}), retry in {retry_after}s',
+                        'retry_after': retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+# Routes that hand out new work, they are shed first when the server is overloaded
+shed_endpoints = {'get_work', 'get_work_slow', 'get_work_batch', 'claim_work', 'claim_chunk'}
+
+@app.before_request
+def shed_load():
+    if request.endpoint in shed_endpoints:
+        reason = load_shedder.overloaded(p_connection.waiting)
+        if reason is not None:
+            return overloaded_response(reason)
+
+# Any request that times out waiting for a pooled connection. The routes re-raise PoolTimeout instead of handling
+# it like other db errors, so that workers see a 503 and back off.
+@app.errorhandler(PoolTimeout)
+def pool_timeout(exc):
+    return overloaded_response('pool_timeout')
+
+# Request bodies with Content-Encoding gzip or zstd (e.g. vtt uploads from worker.py) are decompressed before flask
+# parses them, and JSON / NDJSON responses are compressed for clients that send a matching Accept-Encoding.
+# See compression.py, zstd needs the zstandard package.
+app.wsgi_app = compression.DecompressRequestMiddleware(app.wsgi_app,
+                                                       max_size=config.get("max_decompressed_request_size", 256 * 1024 * 1024))
+compress_responses = config.get("compress_responses", True)
+compression_min_size = config.get("compression_min_size", 1024)
+
+@app.after_request
+def compress_response(response):
+    if compress_responses:
+        compression.compress_response(response, request.headers.get('Accept-Encoding'), min_size=compression_min_size)
+    return response
+
+# In-memory author -> untranscribed episodes index (per language) used by get_work and claim_work, see sampling_index.py
+# It also keeps the episodes in log-spaced duration buckets, get_work_batch and claim_work with n > 1 take their
+# batches from one bucket (picked uniformly or weighted by the remaining hours, batch_bucket_weighting).
+sampling_index = None
+if config.get("sampling_index", True):
+    sampling_index = SamplingIndex(p_connection, table=queue_table,
+                                   resync_interval=config.get("sampling_index_resync_interval", 600),
+                                   bucket_options={'min_duration': config.get("batch_bucket_min_duration", 30),
+                                                   'max_duration': config.get("batch_bucket_max_duration", 4 * 3600),
+                                                   'num_buckets': config.get("batch_buckets", 16)})
+batch_bucket_weighting = config.get("batch_bucket_weighting", 'hours')
+
+# How many stale candidates from the sampling index we try before falling back to sampling in SQL
+index_candidate_retries = 10
+
+# Capability-aware dispatch, see worker_capabilities.py. Workers register their implementation, model and the longest
+# episode they accept (register_worker) and report their processing times (report_speed). get_work, get_work_batch and
+# claim_work with ?worker_id=... never hand out episodes longer than max_duration, and with the sampling index they pick
+# the duration bucket from the speed range of the worker, so that long episodes go to fast workers. The range is
+# widened by capability_spread on both sides, so that neighbouring ranges overlap a little.
+capability_scheduling = config.get("capability_scheduling", True)
+capability_spread = config.get("capability_spread", 0.1)
+worker_capabilities = WorkerCapabilities(p_connection, queue_table=queue_table,
+                                         active_seconds=config.get("worker_active_seconds", 900),
+                                         refresh_interval=config.get("worker_capabilities_refresh_interval", 60),
+                                         ema_alpha=config.get("rtf_ema_alpha", 0.2))
+
+# Returns (target, max_duration) for the dispatch of a worker: target is the quantile of the remaining hours to sample
+# from (see DurationBuckets.sample), None for random sampling. Workers that didn't register get (None, None).
+def dispatch_options(worker_id, language):
+    if not worker_id:
+        return None, None
+    try:
+        worker = worker_capabilities.get(worker_id)
+    except PoolTimeout:
+        raise
+    except Exception:
+        print('Warning: could not look up the capabilities of worker', worker_id)
+        traceback.print_exc()
+        return None, None
+    if worker is None:
+        return None, None
+
+    target = None
+    if capability_scheduling:
+        low, high = worker_capabilities.speed_range(worker, language)
+        target = min(1., max(0., random.uniform(low - capability_spread, high + capability_spread)))
+    return target, worker['max_duration']
+
+# max_duration parameter for the SQL fallbacks, which compare with <=
+def max_duration_param(max_duration):
+    return float('inf') if max_duration is None else max_duration
+
+# Long polling: get_work and claim_work with ?wait=<seconds> wait for new work instead of returning 404 right away.
+# The work_queue_notify trigger announces new pending work, every gunicorn process listens for it on its own
+# connection (outside of the pool) and also adds the announced episodes to its sampling index.
+long_poll_max_wait = config.get("long_poll_max_wait", 60)
+
+def add_notified_work(payload):
+    if sampling_index is not None:
+        sampling_index.add(payload['language'], payload['episode_id'], payload['author_id'], payload.get('duration'))
+
+work_notifier = None
+if config.get("long_poll", True):
+    work_notifier = WorkNotifier(channel='work_queue', on_notify=add_notified_work, **db_connect_kwargs)
+    work_notifier.start()
+
+# Calls attempt() (a route implementation) until it finds work, i.e. doesn't return a 404, or until `wait` seconds
+# have passed. The pooled db connection is given back while waiting, so waiting requests don't block the pool.
+# Wakes up when new work for any of the languages is announced.
+def long_poll(languages, wait, attempt):
+    deadline = time.time() + min(max(wait, 0), long_poll_max_wait)
+    while True:
+        generations = {language: work_notifier.generation(language) for language in languages} \
+            if work_notifier is not None else None
+        response = attempt()
+        status = response[1] if isinstance(response, tuple) else 200
+        remaining = deadline - time.time()
+        if status != 404 or work_notifier is None or remaining <= 0:
+            return response
+        p_connection.release()
+        work_notifier.wait_any(generations, remaining)
+
+# Multi-language workers: get_work, claim_work, get_work_batch and claim_chunk accept several languages in the url,
+# in order of priority (de,fr: French only when there is no German work left) or with weights (de:3,fr:1: 3/4 of the
+# requests look at German first), see parse_languages in utils.py. Returns (languages, error response).
+def parse_languages_param(language):
+    try:
+        return parse_languages(language), None
+    except ValueError:
+        return None, (jsonify({'success': False, 'error': 'Invalid language format'}), 400)
+
+# Calls attempt(language) for the languages in language_order until one of them has work, i.e. doesn't return a 404.
+# Returns the 404 of the last language if none has work.
+def first_with_work(languages, attempt):
+    for language in language_order(languages):
+        response = attempt(language)
+        status = response[1] if isinstance(response, tuple) else 200
+        if status != 404:
+            return response
+    return response
+
+# Work that is claimed with a worker_id gets a lease, workers extend it with heartbeat requests while they transcribe.
+# The lease reaper puts work with expired leases back into the queue (see reap_expired_leases below).
+lease_seconds = config.get("lease_seconds", 900)
+lease_reaper_interval = config.get("lease_reaper_interval", 60)
+
+# Sets the lease columns in UPDATE statements that mark work as in_progress. Without a worker_id (older workers that don't
+# send heartbeats) there is no lease and the work stays in progress until it is uploaded or cancelled, like before.
+set_lease_sql = "lease_owner = %(worker_id)s, lease_expires_at = CASE WHEN %(worker_id)s::text IS NULL THEN NULL " \
+                "ELSE now() + %(lease_seconds)s * interval '1 second' END"
+clear_lease_sql = "lease_owner = NULL, lease_expires_at = NULL"
+
+# Cancelled work goes back to pending. A cancel with a reason (worker.py sends the exception) counts as a failed attempt,
+# and after max_failures failures the work is quarantined instead, so that broken files (corrupt audio, ffmpeg errors,
+# OOM on huge files) don't come back to the GPUs over and over. A cancel without reason (e.g. a worker that is stopped)
+# doesn't count. Expired leases count as failures too (a worker that crashed or was OOM killed can't send a reason).
+# max_failures 0 disables the quarantine. The SET clause uses failed (0 or 1), reason and max_failures parameters.
+max_failures = config.get("max_failures", 3)
+max_error_length = 2000
+
+fail_sql = "failures = failures + %(failed)s::integer, last_error = coalesce(%(reason)s::text, last_error), " \
+           "status = CASE WHEN %(max_failures)s::integer > 0 AND failures + %(failed)s::integer >= %(max_failures)s::integer " \
+           "THEN 'quarantined' ELSE 'pending' END::work_status"
+
+def fail_params(reason):
+    reason = reason[:max_error_length] if reason else None
+    return {'failed': 1 if reason else 0, 'reason': reason, 'max_failures': max_failures}
+
+# Turns a db record with the columns in work_columns into the task dict that is sent to workers
+def make_task(record):
+    table_id, episode_title, authors, language, episode_audio_url, cache_audio_url, cache_audio_file, transcript_file, duration = record
+    return {
+        'wid': table_id,
+        'episode_title': episode_title,
+        'authors': authors,
+        'language': language,
+        'episode_audio_url': episode_audio_url,
+        'cache_audio_url': cache_audio_url,
+        'local_cache_audio_url': make_local_url(cache_audio_url, config),
+        'cache_audio_file': cache_audio_file,
+        'transcript_file': transcript_file,
+        'duration': duration,
+        'success': True
+    }
+
+# In-process cache for the JSON responses of aggregate and read-mostly endpoints (get_podcast_list, get_episode_list).
+# Entries are tagged with their languages and dropped when an upload or cancel in this process touches one of them,
+# other gunicorn processes see the change after at most result_cache_ttl seconds. result_cache_ttl: 0 disables it.
+result_cache = ResultCache(max_entries=config.get("result_cache_max_entries", 256),
+                           ttl=config.get("result_cache_ttl", 300) if config.get("result_cache", True) else 0,
+                           on_lookup=metrics.observe_cache_lookup)
+
+# Compressed bodies are cached too (key + (encoding,)), so that large listings aren't compressed again for every client
+def response_encoding():
+    return compression.negotiate(request.headers.get('Accept-Encoding')) if compress_responses else None
+
+def compressed_json_response(body, encoding):
+    response = Response(body, mimetype='application/json', headers={'Content-Encoding': encoding})
+    response.vary.add('Accept-Encoding')
+    return response
+
+# One lookup per request (for the hit ratio): the compressed body if the client accepts it, else the plain one
+def cached_json_response(key):
+    encoding = response_encoding()
+    keys = [key + (encoding,), key] if encoding is not None else [key]
+    found_key, body = result_cache.get_first(keys)
+    if body is None:
+        return None
+    if found_key != key:
+        return compressed_json_response(body, encoding)
+    return Response(body, mimetype='application/json')
+
+def cache_json_response(key, result, tags):
+    body = app.json.dumps(result).encode('utf-8')
+    result_cache.put(key, body, tags)
+    encoding = response_encoding()
+    if encoding is not None and len(body) >= compression_min_size:
+        compressed_body = compression.compress(body, encoding)
+        result_cache.put(key + (encoding,), compressed_body, tags)
+        return compressed_json_response(compressed_body, encoding)
+    return Response(body, mimetype='application/json')
+
+# Drops the cached responses that an upload or cancel of episodes in these languages (and podcasts) could change
+def invalidate_result_cache(languages, podcast_titles=()):
+    for language in set(languages):
+        result_cache.invalidate(language)
+    for podcast_title in set(podcast_titles):
+        result_cache.invalidate(('podcast_title', podcast_title))
+
+# Field projection and filters for the episode listing endpoints, applied in SQL so that exporters only get what they need:
+#   fields=podcast_episode_id,episode_title,...   only return these columns (default: all of podcast_columns + transcript_file_url)
+#   language=de, model=<model name>               exact matches
+#   min_duration=3.5, max_duration=7200           in seconds
+#   exclude_corrupted=1                           skip episodes whose vtt sanity_check.py moved to a corrupted/ directory
+#                                                 and episodes whose audio update_durations.py couldn't read (duration -1)
+listing_fields = podcast_columns_list + ['transcript_file_url']
+
+class ListingOptions:
+    def __init__(self, values):
+        fields = values.get('fields')
+        self.fields = [field.strip() for field in fields.split(',') if field.strip()] if fields else listing_fields
+        unknown = [field for field in self.fields if field not in listing_fields]
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+
+        # transcript_file_url is made from transcript_file
+        self.columns = [field for field in self.fields if field != 'transcript_file_url']
+        if 'transcript_file_url' in self.fields and 'transcript_file' not in self.columns:
+            self.columns.append('transcript_file')
+
+        self.conditions = []
+        self.params = []
+        for name, condition, value_type in (('language', 'language = %s', str), ('model', 'model = %s', str),
+                                            ('min_duration', 'duration >= %s', float),
+                                            ('max_duration', 'duration <= %s', float)):
+            value = values.get(name)
+            if value is not None and value != '':
+                try:
+                    self.params.append(value_type(value))
+                except ValueError:
+                    raise ValueError(f'Invalid value for {name}: {value}')
+                self.conditions.append(condition)
+        if values.get('exclude_corrupted', '0') not in ('', '0', 'false'):
+            self.conditions.append("coalesce(transcript_file, '') NOT LIKE '%%/corrupted/%%' AND coalesce(duration, 0) >= 0")
+
+    # Columns for the SELECT list, with optional extra columns that the route needs itself
+    def select_sql(self, extra_columns=()):
+        return ', '.join(self.columns + [column for column in extra_columns if column not in self.columns])
+
+    # ' AND ...' for the WHERE clause
+    def where_sql(self):
+        return ''.join(' AND ' + condition for condition in self.conditions)
+
+    def cache_key(self):
+        return (tuple(self.fields), tuple(self.conditions), tuple(self.params))
+
+    def make_record(self, record, extra_columns=()):
+        record_dict = dict(zip(self.columns + [column for column in extra_columns if column not in self.columns], record))
+        if 'transcript_file_url' in self.fields:
+            record_dict['transcript_file_url'] = record_dict['transcript_file'].replace(transcript_file_replace_prefix, 'https://')
+            if 'transcript_file' not in self.fields:
+                del record_dict['transcript_file']
+        return record_dict
+
+def parse_listing_options():
+    try:
+        return ListingOptions(request.values), None
+    except ValueError as e:
+        return None, (jsonify({'success': False, 'error': str(e)}), 400)
 
 # Returns all podcast titles
 @app.route(api_version + '/get_podcast_list/<language>/<api_access_key>', methods=['GET'])
@@ -62,12 +424,19 @@ def get_podcast_list(language, api_access_key):
     if api_secret_key != api_access_key:
         return jsonify({'success':False, 'error':'api_access_key invalid'})
     
+    cache_key = ('get_podcast_list', language)
+    cached = cached_json_response(cache_key)
+    if cached is not None:
+        return cached
 
     try:
-        p_cursor.execute(f'SELECT distinct(podcast_title), count(podcast_episode_id) from podcasts '
-                     'WHERE language=%s GROUP BY podcast_title', (language,) )
+        with metrics.db_timer('get_podcast_list.select'):
+            r_cursor.execute(f'SELECT distinct(podcast_title), count(podcast_episode_id) from podcasts '
+                         'WHERE language=%s GROUP BY podcast_title', (language,) )
 
-        records = p_cursor.fetchall()
+        records = r_cursor.fetchall()
+    except PoolTimeout:
+        raise
     except:
         traceback.print_exc()
         return_dict = {'success':False, 'error':'SQL query did not execute'}
@@ -75,7 +444,7 @@ def get_podcast_list(language, api_access_key):
 
     podcast_titles = [{'title':record[0], 'count':record[1]} for record in records] 
 
-    return jsonify(podcast_titles)
+    return cache_json_response(cache_key, podcast_titles, [language])
 
 # Get list of all podcast episodes from a podcast title with available vtt files
 @app.route(api_version + '/get_episode_list/<api_access_key>', methods=['POST'])
@@ -87,23 +456,36 @@ def get_episode_list(api_access_key):
 
     assert(podcast_title is not None)
 
+    options, error = parse_listing_options()
+    if error is not None:
+        return error
+
+    cache_key = ('get_episode_list', podcast_title, options.cache_key())
+    cached = cached_json_response(cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        p_cursor.execute(f'SELECT {podcast_columns} from podcasts '
-            'WHERE podcast_title=%s and transcript_file<>%s', (podcast_title, '') )
+        with metrics.db_timer('get_episode_list.select'):
+            r_cursor.execute(f'SELECT {options.select_sql(["language"])} from podcasts '
+                f'WHERE podcast_title=%s and transcript_file<>%s{options.where_sql()}', (podcast_title, '', *options.params))
 
-        records = p_cursor.fetchall()
+        records = r_cursor.fetchall()
+    except PoolTimeout:
+        raise
     except:
         traceback.print_exc()
         return_dict = {'success':False, 'error':'SQL query did not execute'}
         return jsonify(return_dict)
 
+    # language is always selected for the cache tags, but only returned if it is in fields
     return_list = []
+    languages = set()
     for record in records:
-        record_dict = dict(zip(podcast_columns_list,record))
+        record_dict = options.make_record(record, ['language'])
+        languages.add(record_dict['language'] if 'language' in options.fields else record_dict.pop('language'))
         return_list.append(record_dict)
-        record_dict['transcript_file_url'] = record_dict['transcript_file'].replace(transcript_file_replace_prefix, 'https://')
-
-    return jsonify(return_list)
+    return cache_json_response(cache_key, return_list, [('podcast_title', podcast_title), *languages])
 
 # Get list of all podcast episodes with available vtt files
 # Note: can probably be refactored with the above function
@@ -112,23 +494,134 @@ def get_every_episode_list(api_access_key):
     if api_secret_key != api_access_key:
         return jsonify({'success':False, 'error':'api_access_key invalid'})
 
+    options, error = parse_listing_options()
+    if error is not None:
+        return error
+
     try:
-        p_cursor.execute(f'SELECT {podcast_columns} from podcasts '
-            'WHERE transcript_file<>%s', ('',) )
-        records = p_cursor.fetchall()
+        with metrics.db_timer('get_every_episode_list.select'):
+            r_cursor.execute(f'SELECT {options.select_sql()} from podcasts '
+                f'WHERE transcript_file<>%s{options.where_sql()}', ('', *options.params) )
+        records = r_cursor.fetchall()
 
+    except PoolTimeout:
+        raise
     except:
         traceback.print_exc()
         return_dict = {'success':False, 'error':'SQL query did not execute'}
         return jsonify(return_dict)
 
+    return jsonify([options.make_record(record) for record in records])
+
+# Keyset-paginated list of the episodes that changed since a point in time, for incremental syncs of mirrors and exporters.
+#
+# Episodes are ordered by (updated_at, podcast_episode_id) and a page starts after the (since, after_id) position, so pages
+# are stable under concurrent inserts and need no OFFSET. Pass the 'next' values of a response to get the following page.
+# Like get_every_episode_list, only episodes with a transcript are returned unless include_untranscribed=1 is set.
+#
+# Note: updated_at is set when a row is written, not when the transaction commits. Clients that sync periodically should
+# start a little before their last position (e.g. a few minutes) to catch rows from transactions that committed late.
+episode_changes_default_limit = 1000
+episode_changes_max_limit = 10000
+
+@app.route(api_version + '/get_episode_changes/<api_access_key>', methods=['GET'])
+def get_episode_changes(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success':False, 'error':'api_access_key invalid'}), 401
+
+    since = request.args.get('since', default='-infinity')
+    after_id = request.args.get('after_id', default=0, type=int)
+    limit = min(request.args.get('limit', default=episode_changes_default_limit, type=int), episode_changes_max_limit)
+    include_untranscribed = request.args.get('include_untranscribed', default=0, type=int)
+
+    # with limit 0 every page would be "full" and clients would ask for the same position forever
+    if limit < 1:
+        return jsonify({'success': False, 'error': 'limit must be >= 1'}), 400
+
+    # work in progress is tracked in the work queue, transcript_file is only set when a transcript is uploaded
+    transcript_filter = '' if include_untranscribed else "AND transcript_file<>''"
+
+    options, error = parse_listing_options()
+    if error is not None:
+        return error
+
+    # the position of the next page is always returned, whatever the fields are
+    position_columns = [sql_table_ids, 'updated_at']
+
+    try:
+        with metrics.db_timer('get_episode_changes.select'):
+            r_cursor.execute(f'SELECT {options.select_sql(position_columns)} FROM {sql_table} '
+                f'WHERE (updated_at, {sql_table_ids}) > (%s::timestamptz, %s) {transcript_filter}{options.where_sql()} '
+                f'ORDER BY updated_at, {sql_table_ids} LIMIT %s', (since, after_id, *options.params, limit))
+        records = r_cursor.fetchall()
+    except PoolTimeout:
+        raise
+    except:
+        traceback.print_exc()
+        return jsonify({'success':False, 'error':'SQL query did not execute'}), 400
+
     return_list = []
     for record in records:
-        record_dict = dict(zip(podcast_columns_list,record))
+        record_dict = options.make_record(record, position_columns)
+        record_dict['updated_at'] = record_dict['updated_at'].isoformat()
         return_list.append(record_dict)
-        record_dict['transcript_file_url'] = record_dict['transcript_file'].replace(transcript_file_replace_prefix, 'https://')
 
-    return jsonify(return_list)
+    if return_list:
+        next_position = {'since': return_list[-1]['updated_at'], 'after_id': return_list[-1]['podcast_episode_id']}
+    else:
+        next_position = {'since': since, 'after_id': after_id}
+
+    return jsonify({'success': True, 'episodes': return_list, 'next': next_position, 'has_more': len(return_list) == limit})
+
+# Same as get_every_episode_list, but streamed as newline-delimited JSON (one episode per line).
+# The rows are read from a server-side cursor in chunks of stream_chunk_size, so memory use stays constant with the size
+# of the table and clients can start processing rows right away.
+stream_chunk_size = config.get("stream_chunk_size", 2000)
+
+@app.route(api_version + '/get_every_episode_list_stream/<api_access_key>', methods=['GET'])
+def get_every_episode_list_stream(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success':False, 'error':'api_access_key invalid'}), 401
+
+    options, error = parse_listing_options()
+    if error is not None:
+        return error
+
+    def generate():
+        with replica_router.server_side_cursor('every_episode_list', itersize=stream_chunk_size) as cur:
+            cur.execute(f'SELECT {options.select_sql()} from podcasts '
+                f'WHERE transcript_file<>%s{options.where_sql()}', ('', *options.params) )
+            while True:
+                records = cur.fetchmany(stream_chunk_size)
+                if not records:
+                    break
+                yield ''.join(app.json.dumps(options.make_record(record)) + '\n' for record in records)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+prepared.register('get_work.index_candidate',
+                  f'SELECT {work_columns_p} FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id '
+                  "WHERE q.episode_id=%s AND q.status='pending'")
+
+# Samples an episode with the in-memory sampling index and returns its record, [] if the index is empty for the language
+# or None if all candidates were stale (already taken by another gunicorn process). New and requeued episodes are added
+# as soon as the work notifier announces them (add_notified_work), and the periodic resync picks up anything that was
+# missed, e.g. while the listener was disconnected. So an empty index means that there is no pending work for the
+# language, or that it showed up while notifications were lost and comes with the next resync.
+def sample_from_index(language, target=None, max_duration=None):
+    for _ in range(index_candidate_retries):
+        if target is None and max_duration is None:
+            candidates = sampling_index.sample(language)
+        else:
+            candidates = sampling_index.sample_batch(language, 1, 0, batch_bucket_weighting, max_duration, target)
+        if not candidates:
+            return []
+        prepared.execute(p_cursor, 'get_work.index_candidate', (candidates[0],))
+        record = p_cursor.fetchone()
+        if record:
+            return record
+        sampling_index.remove(candidates)
+    return None
 
 # Samples a new untranscribed episode from the db and sends the result as JSON
 # 
@@ -142,6 +635,9 @@ def get_every_episode_list(api_access_key):
 # 4. Select a random offset into that list to fetch one episode.
 #
 # This maintains randomness while being much faster on large datasets.
+# All steps run on the narrow work_queue table and its partial index on pending work.
+#
+# With ?wait=<seconds> the request long-polls for new work if there is none, see long_poll.
 
 @app.route(api_version + '/get_work/<language>/<api_access_key>', methods=['GET'])
 def get_work(language, api_access_key):
@@ -149,80 +645,91 @@ def get_work(language, api_access_key):
     if api_secret_key != api_access_key:
         return jsonify({'success': False, 'error': 'API access key invalid'}), 401
 
-    # Validate language input
-    if not language.isalpha():
-        return jsonify({'success': False, 'error': 'Invalid language format'}), 400
-
+    # Validate language input, one or several languages (see parse_languages_param)
+    languages, error = parse_languages_param(language)
+    if error:
+        return error
+
+    wait = request.args.get('wait', default=0, type=float)
+    worker_id = request.args.get('worker_id', default=None)
+    return long_poll([name for name, _ in languages], wait,
+                     lambda: first_with_work(languages, lambda language: sample_work(language, worker_id)))
+
+prepared.register('get_work.author_count', f"""
+    SELECT COUNT(DISTINCT author_id)
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = %s
+""")
+prepared.register('get_work.author_sample', f"""
+    SELECT DISTINCT author_id
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = %s
+    OFFSET floor(random() * %s)
+    LIMIT 1
+""")
+prepared.register('get_work.episode_count', f"""
+    SELECT COUNT(*)
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = %s AND author_id = %s AND (duration IS NULL OR duration <= %s)
+""")
+prepared.register('get_work.episode_sample', f"""
+    SELECT {work_columns_p}
+    FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id
+    WHERE q.status = 'pending' AND q.language = %s AND q.author_id = %s AND (q.duration IS NULL OR q.duration <= %s)
+    OFFSET floor(random() * %s)
+    LIMIT 1
+""")
+
+def sample_work(language, worker_id=None):
     try:
+        target, max_duration = dispatch_options(worker_id, language)
+        if sampling_index is not None:
+            record = sample_from_index(language, target, max_duration)
+            if record == []:
+                return jsonify({'success': False, 'error': f'No episodes left without transcriptions for language {language}.'}), 404
+            if record is not None:
+                print("Language:", language)
+                print("Sampled from index:", record[0])
+                return jsonify(make_task(record))
+
         # Get count of authors with untranscribed episodes in the given language
-        p_cursor.execute("""
-            SELECT COUNT(DISTINCT authors)
-            FROM podcasts
-            WHERE transcript_file = %s AND language = %s
-        """, ('', language))
+        prepared.execute(p_cursor, 'get_work.author_count', (language,))
         author_count = p_cursor.fetchone()[0]
 
         if author_count == 0:
             return jsonify({'success': False, 'error': f'No episodes left without transcriptions for language {language}.'}), 404
 
         # Sample a random offset and pick one author
-        p_cursor.execute("""
-            SELECT DISTINCT authors
-            FROM podcasts
-            WHERE transcript_file = %s AND language = %s
-            OFFSET floor(random() * %s)
-            LIMIT 1
-        """, ('', language, author_count))
+        prepared.execute(p_cursor, 'get_work.author_sample', (language, author_count))
         author_record = p_cursor.fetchone()
 
         print("Language:", language)
         print("Sampled author:", author_record)
 
         if author_record:
-            author = author_record[0]
+            author_id = author_record[0]
 
             # Get count of episodes by that author
-            p_cursor.execute(f"""
-                SELECT COUNT(*)
-                FROM {sql_table}
-                WHERE transcript_file = %s AND language = %s AND authors = %s
-            """, ('', language, author))
+            prepared.execute(p_cursor, 'get_work.episode_count', (language, author_id, max_duration_param(max_duration)))
             episode_count = p_cursor.fetchone()[0]
 
             if episode_count == 0:
-                return jsonify({'success': False, 'error': f'No episodes without transcription for author: {author}'}), 404
+                return jsonify({'success': False, 'error': f'No episodes without transcription for author: {author_id}'}), 404
 
             # Sample a random episode from that author
-            p_cursor.execute(f"""
-                SELECT {sql_table_ids}, episode_title, authors, language, episode_audio_url, cache_audio_url,
-                       cache_audio_file, transcript_file, duration
-                FROM {sql_table}
-                WHERE transcript_file = %s AND language = %s AND authors = %s
-                OFFSET floor(random() * %s)
-                LIMIT 1
-            """, ('', language, author, episode_count))
+            prepared.execute(p_cursor, 'get_work.episode_sample',
+                             (language, author_id, max_duration_param(max_duration), episode_count))
             episode_record = p_cursor.fetchone()
 
             if episode_record:
-                table_id, episode_title, authors, language, episode_audio_url, cache_audio_url, cache_audio_file, transcript_file, duration = episode_record
-                return jsonify({
-                    'wid': table_id,
-                    'episode_title': episode_title,
-                    'authors': authors,
-                    'language': language,
-                    'episode_audio_url': episode_audio_url,
-                    'cache_audio_url': cache_audio_url,
-                    'local_cache_audio_url': make_local_url(cache_audio_url, config),
-                    'cache_audio_file': cache_audio_file,
-                    'transcript_file': transcript_file,
-                    'duration': duration,
-                    'success': True
-                })
+                return jsonify(make_task(episode_record))
             else:
-                return jsonify({'success': False, 'error': f'No episodes found for author: {author}'}), 404
+                return jsonify({'success': False, 'error': f'No episodes found for author: {author_id}'}), 404
         else:
             return jsonify({'success': False, 'error': 'No author found'}), 404
 
+    except PoolTimeout:
+        raise
     except Exception as e:
         app.logger.error('Unexpected error:', exc_info=True)
         return jsonify({'success': False, 'error': 'An unexpected error occurred'}), 500
@@ -243,178 +750,445 @@ def get_work_slow(language, api_access_key):
 
     try:
         # Sample an author with untranscribed episodes in the given language
-        p_cursor.execute("""
-            SELECT authors, count(%s) as episode_count FROM podcasts
-            WHERE transcript_file = %s AND language = %s
-            GROUP BY authors
-            ORDER BY RANDOM()
-            LIMIT 1
-        """, (sql_table_ids, '', language))
+        with metrics.db_timer('get_work_slow.author_sample'):
+            p_cursor.execute(f"""
+                SELECT author_id, count(*) as episode_count FROM {queue_table}
+                WHERE status = 'pending' AND language = %s
+                GROUP BY author_id
+                ORDER BY RANDOM()
+                LIMIT 1
+            """, (language,))
         author_record = p_cursor.fetchone()
-        
+
         print("Language:", language)
         print("Sampled author:", author_record)
 
         if author_record:
             # Sample a random untranscribed episode from the sampled author
-            p_cursor.execute(f"""
-                SELECT {sql_table_ids}, episode_title, authors, language, episode_audio_url, cache_audio_url, 
-                cache_audio_file, transcript_file, duration FROM {sql_table}
-                WHERE transcript_file = %s AND language = %s AND authors = %s
-                ORDER BY RANDOM()
-                LIMIT 1
-            """, ('', language, author_record[0]))
+            with metrics.db_timer('get_work_slow.episode_sample'):
+                p_cursor.execute(f"""
+                    SELECT {work_columns_p}
+                    FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id
+                    WHERE q.status = 'pending' AND q.language = %s AND q.author_id = %s
+                    ORDER BY RANDOM()
+                    LIMIT 1
+                """, (language, author_record[0]))
             episode_record = p_cursor.fetchone()
-            
+
             if episode_record:
-                table_id, episode_title, authors, language, episode_audio_url, cache_audio_url, cache_audio_file, transcript_file, duration = episode_record
-                return jsonify({
-                    'wid': table_id,
-                    'episode_title': episode_title,
-                    'authors': authors,
-                    'language': language,
-                    'episode_audio_url': episode_audio_url,
-                    'cache_audio_url': cache_audio_url,
-                    'local_cache_audio_url': make_local_url(cache_audio_url, config),
-                    'cache_audio_file': cache_audio_file,
-                    'transcript_file': transcript_file,
-                    'duration': duration,
-                    'success': True
-                })
+                return jsonify(make_task(episode_record))
             else:
-                return jsonify({'success': False, 'error': f'No episodes without transcription for author: {author_record["authors"]}'}), 404
+                return jsonify({'success': False, 'error': f'No episodes without transcription for author: {author_record[0]}'}), 404
         else:
             return jsonify({'success': False, 'error': f'No episodes left without transcriptions for language {language}.'}), 404
+    except PoolTimeout:
+        raise
     except Exception as e:
         app.logger.error('Unexpected error:', exc_info=True)
         return jsonify({'success': False, 'error': 'An unexpected error occurred'}), 500
 
 
+# Like sample_from_index, for a batch of similar length episodes from the duration buckets of the sampling index
+def sample_batch_from_index(language, n, min_duration, weighting, max_duration=None, target=None):
+    for _ in range(index_candidate_retries):
+        candidates = sampling_index.sample_batch(language, n, min_duration, weighting, max_duration, target)
+        if not candidates:
+            return []
+        with metrics.db_timer('get_work_batch.index_candidates'):
+            p_cursor.execute(f'SELECT {work_columns_p} FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id '
+                             "WHERE q.episode_id = ANY(%s) AND q.status='pending'", (candidates,))
+        records = p_cursor.fetchall()
+        found = {record[0] for record in records}
+        sampling_index.remove([candidate for candidate in candidates if candidate not in found])
+        if records:
+            return records
+    return None
+
+# Batch of up to n episodes of similar length. With the sampling index, the batch comes from one duration bucket
+# (O(n), no sorting). Without it, the shortest episodes >= min_duration are handed out first.
 @app.route(api_version + '/get_work_batch/<language>/<api_access_key>/<int:n>', methods=['GET'])
 def get_work_batch(language, api_access_key, n):
     if api_secret_key != api_access_key:
         return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
 
-    # Fetch optional min_duration from query parameters
+    languages, error = parse_languages_param(language)
+    if error:
+        return error
+
+    # Fetch optional min_duration and bucket weighting (uniform or hours) from query parameters
     min_duration = request.args.get('min_duration', default=0, type=float)
+    weighting = request.args.get('weighting', default=batch_bucket_weighting)
+    worker_id = request.args.get('worker_id', default=None)
+    # a batch comes from one language
+    return first_with_work(languages, lambda language: work_batch(language, n, min_duration, weighting, worker_id))
+
+def work_batch(language, n, min_duration, weighting, worker_id):
+    target, max_duration = dispatch_options(worker_id, language)
+
+    if sampling_index is not None:
+        records = sample_batch_from_index(language, n, min_duration, weighting, max_duration, target)
+        if records == []:
+            return jsonify({'success': False, 'error': 'No sufficient tasks available'}), 404
+        if records is not None:
+            return jsonify({'tasks': [make_task(record) for record in records], 'success': True})
 
     # Fetch up to n tasks with specified minimum duration and similar durations
-    p_cursor.execute(f"""
-        SELECT {sql_table_ids}, episode_title, authors, language, episode_audio_url, cache_audio_url, cache_audio_file, transcript_file, duration
-        FROM {sql_table}
-        WHERE transcript_file=%s and language=%s and duration >= %s
-        ORDER BY duration, RANDOM()
-        LIMIT %s
-    """, ('', language, min_duration, n))
+    with metrics.db_timer('get_work_batch.select'):
+        p_cursor.execute(f"""
+            SELECT {work_columns_p}
+            FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id
+            WHERE q.status = 'pending' AND q.language = %s AND q.duration >= %s AND q.duration <= %s
+            ORDER BY q.duration, RANDOM()
+            LIMIT %s
+        """, (language, min_duration, max_duration_param(max_duration), n))
 
-    tasks = []
     records = p_cursor.fetchall()
 
     if records:
-        for record in records:
-            if record:
-                table_id, episode_title, authors, language, episode_audio_url, cache_audio_url, cache_audio_file, transcript_file, duration = record
-                tasks.append({
-                    'wid': table_id,
-                    'episode_title': episode_title,
-                    'authors': authors,
-                    'language': language,
-                    'episode_audio_url': episode_audio_url,
-                    'cache_audio_url': cache_audio_url,
-                    'local_cache_audio_url': make_local_url(cache_audio_url, config),
-                    'cache_audio_file': cache_audio_file,
-                    'transcript_file': transcript_file,
-                    'duration': duration,
-                    'success': True
-                })
-        return jsonify({'tasks': tasks, 'success': True})
+        return jsonify({'tasks': [make_task(record) for record in records], 'success': True})
     else:
         return jsonify({'success': False, 'error': 'No sufficient tasks available'}), 404
 
-# Client worker registers that he is working on the transcript. Sets transcript_file = 'in_progress' in the db.
+# Samples and registers work in one statement, replacing the get_work -> register_wip round trip.
+#
+# The inner SELECT picks the candidates and locks them with FOR UPDATE SKIP LOCKED, so concurrent claims
+# never wait for each other and never hand out the same episode twice: rows that another claim has locked
+# are simply skipped. The UPDATE marks the candidates as in_progress in the work queue and the task payload
+# is joined from the podcasts table.
+#
+# With n=1 (default) an author is sampled first, with the same "OFFSET + RANDOM * COUNT" trick as in get_work,
+# and then a random episode of that author. With n>1 the batch is built like in get_work_batch, i.e. similar
+# durations >= min_duration. Like get_work, claim_work long-polls with ?wait=<seconds>.
+def make_claim_query(candidates_sql):
+    return f"""
+    WITH claimed AS (
+        UPDATE {queue_table}
+        SET status = 'in_progress', claimed_at = now(), attempts = attempts + 1, {set_lease_sql}
+        WHERE episode_id IN ({candidates_sql} FOR UPDATE SKIP LOCKED)
+        AND status = 'pending'
+        RETURNING episode_id)
+    SELECT {work_columns_p} FROM claimed JOIN {sql_table} p ON p.{sql_table_ids} = claimed.episode_id
+    """
+
+claim_author_query = make_claim_query(f"""
+        SELECT episode_id
+        FROM {queue_table}
+        WHERE status = 'pending' AND language = %(language)s
+        AND (duration IS NULL OR duration <= %(max_duration)s) AND author_id = (
+            SELECT author_id
+            FROM (SELECT DISTINCT author_id FROM {queue_table}
+                  WHERE status = 'pending' AND language = %(language)s) AS pending_authors
+            OFFSET floor(random() * (SELECT COUNT(DISTINCT author_id) FROM {queue_table}
+                                     WHERE status = 'pending' AND language = %(language)s))
+            LIMIT 1)
+        ORDER BY RANDOM()
+        LIMIT %(n)s""")
+
+claim_batch_query = make_claim_query(f"""
+        SELECT episode_id
+        FROM {queue_table}
+        WHERE status = 'pending' AND language = %(language)s
+        AND duration >= %(min_duration)s AND duration <= %(max_duration)s
+        ORDER BY duration, RANDOM()
+        LIMIT %(n)s""")
+
+# Claims episodes sampled by the sampling index. Candidates that are locked or were already taken are skipped.
+claim_ids_query = make_claim_query(f"""
+        SELECT episode_id
+        FROM {queue_table}
+        WHERE episode_id = ANY(%(ids)s) AND status = 'pending'""")
+
+prepared.register('claim_work.claim_author', claim_author_query)
+prepared.register('claim_work.claim_batch', claim_batch_query)
+prepared.register('claim_work.claim_ids', claim_ids_query)
+
+# How often claim_work resamples when all episodes of the sampled author were locked by concurrent claims
+claim_retries = 3
+
+# Like sample_from_index, but claims up to n episodes from n different authors. Batches (n > 1) come from the
+# duration buckets, like in get_work_batch.
+def claim_from_index(language, n, worker_id=None, min_duration=0, weighting=batch_bucket_weighting,
+                     max_duration=None, target=None):
+    for _ in range(index_candidate_retries):
+        if n == 1 and target is None and max_duration is None:
+            candidates = sampling_index.sample(language)
+        else:
+            candidates = sampling_index.sample_batch(language, n, min_duration, weighting, max_duration, target)
+        if not candidates:
+            return []
+        prepared.execute(p_cursor, 'claim_work.claim_ids',
+                         {'ids': candidates, 'worker_id': worker_id, 'lease_seconds': lease_seconds})
+        records = p_cursor.fetchall()
+        # claimed candidates are gone from the queue and the others were taken by someone else
+        sampling_index.remove(candidates)
+        if records:
+            return records
+    return None
+
+@app.route(api_version + '/claim_work/<language>/<api_access_key>', methods=['GET'])
+def claim_work(language, api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'API access key invalid'}), 401
+
+    languages, error = parse_languages_param(language)
+    if error:
+        return error
+
+    n = request.args.get('n', default=1, type=int)
+    min_duration = request.args.get('min_duration', default=0, type=float)
+    worker_id = request.args.get('worker_id', default=None)
+    wait = request.args.get('wait', default=0, type=float)
+    weighting = request.args.get('weighting', default=batch_bucket_weighting)
+
+    if n < 1:
+        return jsonify({'success': False, 'error': 'n must be >= 1'}), 400
+
+    # a batch (n > 1) comes from one language
+    return long_poll([name for name, _ in languages], wait,
+                     lambda: first_with_work(languages, lambda language: claim(language, n, min_duration, worker_id, weighting)))
+
+def claim(language, n, min_duration, worker_id, weighting=batch_bucket_weighting):
+    target, max_duration = dispatch_options(worker_id, language)
+    params = {'language': language, 'n': n, 'min_duration': min_duration, 'max_duration': max_duration_param(max_duration),
+              'worker_id': worker_id, 'lease_seconds': lease_seconds}
+    query = 'claim_work.claim_author' if n == 1 else 'claim_work.claim_batch'
+
+    try:
+        records = None
+        if sampling_index is not None:
+            records = claim_from_index(language, n, worker_id, min_duration, weighting, max_duration, target)
+            if records == []:
+                return jsonify({'success': False, 'error': f'No episodes left without transcriptions for language {language}.'}), 404
+
+        for _ in range(claim_retries if records is None else 0):
+            prepared.execute(p_cursor, query, params)
+            records = p_cursor.fetchall()
+            if records:
+                break
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error('Unexpected error:', exc_info=True)
+        return jsonify({'success': False, 'error': 'An unexpected error occurred'}), 500
+
+    if not records:
+        return jsonify({'success': False, 'error': f'No episodes left without transcriptions for language {language}.'}), 404
+
+    if sampling_index is not None:
+        sampling_index.remove([record[0] for record in records])
+
+    return jsonify({'tasks': [make_task(record) for record in records], 'success': True})
+
+prepared.register('register_wip.select', f'SELECT episode_id, status FROM {queue_table} WHERE episode_id=%s FOR UPDATE')
+prepared.register('register_wip.update',
+                  f"UPDATE {queue_table} SET status = 'in_progress', claimed_at = now(), attempts = attempts + 1, "
+                  f"{set_lease_sql} WHERE episode_id=%(wid)s")
+
+# Client worker registers that he is working on the transcript. Sets the status in the work queue to in_progress.
+# With ?worker_id=... the work gets a lease that the worker has to extend with heartbeat requests.
 @app.route(api_version + '/register_wip/<wid>/<api_access_key>', methods=['GET'])
 def register_wip(wid, api_access_key):
 
     if api_secret_key != api_access_key:
         return jsonify({'success': False, 'error':'api_access_key invalid'})
 
-    p_cursor.execute(f'SELECT {sql_table_ids}, transcript_file FROM {sql_table} WHERE {sql_table_ids}=%s', (str(wid),))
-    record = p_cursor.fetchone()
+    worker_id = request.args.get('worker_id', default=None)
+
+    # SELECT ... FOR UPDATE locks the row until the transaction ends, so two workers can't both register the same wid
+    with p_connection.transaction() as cur:
+        prepared.execute(cur, 'register_wip.select', (str(wid),))
+        record = cur.fetchone()
+
+        if record is None:
+            return jsonify({'success': False, 'error': str(wid)+' not found in work queue'})
 
-    table_id, transcript_file = record
+        table_id, status = record
 
-    if transcript_file == 'in_progress':
-        return jsonify({'success': False, 'error': str(wid)+' already in progress'})
-    elif transcript_file != '':
-        return jsonify({'success': False, 'error': str(wid)+' already transcribed'})
+        if status != 'pending':
+            return jsonify({'success': False, 'error': status_error(wid, status)})
 
-    p_cursor.execute(f"UPDATE {sql_table} SET transcript_file = 'in_progress' WHERE {sql_table_ids}=%s" , (str(wid),))
-    p_connection.commit()
+        prepared.execute(cur, 'register_wip.update', {'wid': str(wid), 'worker_id': worker_id, 'lease_seconds': lease_seconds})
+
+    if sampling_index is not None:
+        sampling_index.remove([table_id])
 
     return jsonify({'success': True})
 
+# Registers a batch of work in one statement. All wids are locked, and they are only updated if every one of them is
+# pending; otherwise nothing changes and the conflicts are reported, just like before with one query per wid.
+register_batch_query = f"""
+    WITH locked AS (
+        SELECT episode_id, status
+        FROM {queue_table}
+        WHERE episode_id = ANY(%(wids)s)
+        FOR UPDATE
+    ), registered AS (
+        UPDATE {queue_table} q
+        SET status = 'in_progress', claimed_at = now(), attempts = q.attempts + 1, {set_lease_sql}
+        FROM locked
+        WHERE q.episode_id = locked.episode_id
+        AND NOT EXISTS (SELECT 1 FROM locked WHERE status <> 'pending')
+        RETURNING q.episode_id
+    )
+    SELECT locked.episode_id, locked.status, registered.episode_id IS NOT NULL
+    FROM locked LEFT JOIN registered ON registered.episode_id = locked.episode_id
+"""
+
 @app.route(api_version + '/register_wip_batch/<api_access_key>', methods=['POST'])
 def register_wip_batch(api_access_key):
     if api_secret_key != api_access_key:
         return jsonify({'success': False, 'error':'api_access_key invalid'})
 
-    # Retrieve the list of wids from the POST request body
+    # Retrieve the list of wids (and optionally the worker_id for leases) from the POST request body
     wids = request.json.get('wids')
+    worker_id = request.json.get('worker_id')
     if not wids:
         return jsonify({'success': False, 'error': 'No wids provided'})
 
     try:
-        # Begin a transaction to ensure atomicity
-        p_cursor.execute('BEGIN')
-
-        # Cast wids to integers and check current status of each wid
         int_wids = list(map(int, wids))  # Ensure wids are integers
-        p_cursor.execute(f"""
-            SELECT {sql_table_ids}, transcript_file
-            FROM {sql_table}
-            WHERE {sql_table_ids} = ANY(%s)
-        """, (int_wids,))
+        with metrics.db_timer('register_wip_batch.update'):
+            p_cursor.execute(register_batch_query, {'wids': int_wids, 'worker_id': worker_id, 'lease_seconds': lease_seconds})
 
         wip_conflict = []
         already_transcribed = []
-        to_update = []
+        unavailable = []
+        updated = []
 
-        records = p_cursor.fetchall()
-        for record in records:
-            table_id, transcript_file = record
-            if transcript_file == 'in_progress':
+        for table_id, status, registered in p_cursor.fetchall():
+            if registered:
+                updated.append(table_id)
+            elif status == 'in_progress':
                 wip_conflict.append(str(table_id))
-            elif transcript_file != '':
+            elif status in unavailable_statuses:
+                unavailable.append(str(table_id))
+            elif status != 'pending':
                 already_transcribed.append(str(table_id))
-            else:
-                to_update.append(table_id)
 
-        if wip_conflict or already_transcribed:
+        if wip_conflict or already_transcribed or unavailable:
             return jsonify({
                 'success': False,
                 'error': {
                     'already_in_progress': wip_conflict,
-                    'already_transcribed': already_transcribed
+                    'already_transcribed': already_transcribed,
+                    'unavailable': unavailable
                 }
             })
 
-        # Update the status to 'in_progress' for all applicable wids
-        if to_update:
-            p_cursor.execute(f"""
-                UPDATE {sql_table}
-                SET transcript_file = 'in_progress'
-                WHERE {sql_table_ids} = ANY(%s)
-            """, (to_update,))
-            p_connection.commit()
-            return jsonify({'success': True, 'updated': to_update})
-        else:
+        if not updated:
             return jsonify({'success': False, 'error': 'No eligible work IDs to update'})
-        
+
+        if sampling_index is not None:
+            sampling_index.remove(updated)
+
+        return jsonify({'success': True, 'updated': updated})
+
+    except PoolTimeout:
+        raise
     except Exception as e:
-        p_cursor.execute('ROLLBACK')
         return jsonify({'success': False, 'error': str(e)})
 
-# Client worker uploads the resulting vtt file. Sets transcript_file to the path of the uploaded file in the db.
+# Locks the work queue entries of the given wids and returns their status and the cache file of the episode, used by the upload routes
+upload_status_query = f"""
+    SELECT q.episode_id, q.status, p.cache_audio_file, q.language, p.podcast_title, q.lease_owner
+    FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id
+    WHERE q.episode_id = ANY(%s)
+    FOR UPDATE OF q
+"""
+prepared.register('upload_result.select', upload_status_query)
+
+# A worker whose lease expired and was reclaimed (and maybe handed to another worker) must not overwrite the result
+# of the new lease holder. Uploads without worker_id (older workers) and work without lease are not checked.
+def lease_lost(lease_owner, worker_id):
+    return worker_id is not None and lease_owner is not None and lease_owner != worker_id
+
+def lease_lost_error(wid):
+    return f'{wid} is leased to another worker'
+
+# upload_result marks the episode as done only if it is still in progress under the lease of the uploading worker
+upload_result_query = f"""
+    WITH done AS (
+        UPDATE {queue_table} q
+        SET status = 'done', {clear_lease_sql}
+        WHERE q.episode_id = %(wid)s AND q.status = 'in_progress'
+        AND (%(worker_id)s::text IS NULL OR q.lease_owner IS NULL OR q.lease_owner = %(worker_id)s)
+        RETURNING q.episode_id
+    )
+    UPDATE {sql_table} p
+    SET transcript_file = %(transcript_file)s, model = coalesce(%(model)s, p.model)
+    FROM done
+    WHERE p.{sql_table_ids} = done.episode_id
+    RETURNING p.{sql_table_ids}
+"""
+
+# Sets transcript_file (and model, if given) of all uploaded episodes and marks them as done, in one statement.
+# The VALUES list is filled in by psycopg2.extras.execute_values.
+upload_batch_query = f"""
+    WITH uploaded (episode_id, transcript_file, model) AS (
+        VALUES %s
+    ), done AS (
+        UPDATE {queue_table} q
+        SET status = 'done', {clear_lease_sql}
+        FROM uploaded
+        WHERE q.episode_id = uploaded.episode_id
+    )
+    UPDATE {sql_table} p
+    SET transcript_file = uploaded.transcript_file, model = coalesce(uploaded.model, p.model)
+    FROM uploaded
+    WHERE p.{sql_table_ids} = uploaded.episode_id
+"""
+upload_batch_template = '(%s::integer, %s::text, %s::varchar)'
+
+# Get the directory and filename to store the vtt file
+# The config variable can use {source_dir} as a variable for the directory where the source file is stored
+# We append .vtt to the input filename, with vtt_shard_levels > 0 in hash-prefix subdirectories (see vtt_storage.py)
+vtt_storage = VttStorage.from_config(config)
+
+def make_vtt_filename(cache_audio_file):
+    return vtt_storage.path(cache_audio_file)
+
+# Episodes with the same audio as a transcribed episode (status 'duplicate', see schema.psql and dedupe_work_queue.py)
+# get a hard link of its vtt file and are marked as done, like an upload with the same model. Called in the upload
+# transaction for the uploaded episodes, and periodically for all duplicates (resolve_duplicates below).
+duplicates_query = f"""
+    SELECT d.episode_id, dp.cache_audio_file, cp.transcript_file, cp.model, dp.language, dp.podcast_title
+    FROM {queue_table} d
+    JOIN {queue_table} c ON c.episode_id = d.duplicate_of
+    JOIN {sql_table} dp ON dp.{sql_table_ids} = d.episode_id
+    JOIN {sql_table} cp ON cp.{sql_table_ids} = d.duplicate_of
+    WHERE d.status = 'duplicate' AND c.status = 'done'
+    AND coalesce(cp.transcript_file, '') <> '' AND coalesce(dp.cache_audio_file, '') <> ''
+    AND (%(canonical_ids)s::integer[] IS NULL OR d.duplicate_of = ANY(%(canonical_ids)s::integer[]))
+    FOR UPDATE OF d SKIP LOCKED
+    LIMIT %(limit)s
+"""
+
+def copy_transcript_to_duplicates(cur, canonical_ids=None, limit=1000):
+    """Returns the (language, podcast_title) of the duplicates that were completed, for the result cache."""
+    with metrics.db_timer('duplicates.select'):
+        cur.execute(duplicates_query, {'canonical_ids': canonical_ids, 'limit': limit})
+    records = cur.fetchall()
+
+    uploads = []
+    completed = []
+    for table_id, cache_audio_file, transcript_file, model_name, language, podcast_title in records:
+        full_filename = make_vtt_filename(cache_audio_file)
+        try:
+            link_or_copy(transcript_file, full_filename)
+        except OSError as e:
+            print(f'Warning: could not copy transcript {transcript_file} to duplicate {table_id}:', e)
+            continue
+        print(f'Duplicate {table_id}: linked transcript {transcript_file} to {full_filename}')
+        uploads.append((table_id, full_filename, model_name))
+        completed.append((language, podcast_title))
+
+    if uploads:
+        with metrics.db_timer('duplicates.update'):
+            execute_values(cur, upload_batch_query, uploads, template=upload_batch_template, page_size=len(uploads))
+    return completed
+
+# Client worker uploads the resulting vtt file. Sets transcript_file to the path of the uploaded file in the db
+# and marks the work as done in the work queue.
 @app.route(api_version + '/upload_result/<wid>/<api_access_key>', methods=['POST'])
 def upload_result(wid, api_access_key):
     if api_secret_key != api_access_key:
@@ -424,205 +1198,872 @@ def upload_result(wid, api_access_key):
     if 'file' not in request.files:
         return jsonify({'success': False, 'error':'no file found in POST request'})
 
-    p_cursor.execute(f'SELECT {sql_table_ids}, transcript_file, cache_audio_file, episode_audio_url FROM {sql_table} WHERE {sql_table_ids}=%s', (str(wid),))
-    record = p_cursor.fetchone()
-    table_id, transcript_file, cache_audio_file, episode_audio_url = record
-
     # Check if model parameter is present
     model_name = request.form.get('model', None)
+    worker_id = request.form.get('worker_id', None) or None
+
+    with p_connection.transaction() as cur:
+        prepared.execute(cur, 'upload_result.select', ([int(wid)],))
+        record = cur.fetchone()
 
-    if transcript_file != 'in_progress':
-        return jsonify({'success': False, 'error': str(wid)+' not in progress'})
+        if record is None:
+            return jsonify({'success': False, 'error': str(wid)+' not found in work queue'})
 
-    if cache_audio_file == '':
-        return jsonify({'success': False, 'error': str(wid)+' does not have a cache file, this is currently unsupported'})
+        table_id, status, cache_audio_file, language, podcast_title, lease_owner = record
 
-    myfile = request.files['file']
+        if status != 'in_progress':
+            return jsonify({'success': False, 'error': str(wid)+' not in progress'})
 
-    if myfile:
-        # Get the directory and filename to store the vtt file
-        # The config variable can use {source_dir} as a variable for the directory where the source file is stored
-        # We append .vtt to the input filename
+        # checked before the vtt file is written, the row is locked until the end of the transaction
+        if lease_lost(lease_owner, worker_id):
+            return jsonify({'success': False, 'error': lease_lost_error(wid)}), 409
 
-        cache_audio_file_split = cache_audio_file.split('/')
-        source_dir = '/'.join(cache_audio_file_split[:-1])
-        full_dir = vtt_dir.replace('{source_dir}', source_dir) + '/'
-        ensure_dir(full_dir)
-        full_filename = full_dir + cache_audio_file_split[-1] + '.vtt'
+        if cache_audio_file == '':
+            return jsonify({'success': False, 'error': str(wid)+' does not have a cache file, this is currently unsupported'})
+
+        myfile = request.files['file']
+
+        if not myfile:
+            return jsonify({'success': False, 'error': str(wid)+' could not access upload file'})
+
+        full_filename = make_vtt_filename(cache_audio_file)
         print('Saving vtt file to:', full_filename)
-        myfile.save(full_filename)
+        vtt_storage.save(full_filename, myfile.save)
 
         # Update the transcript_file and model columns
-        if model_name:
-            p_cursor.execute(f'UPDATE {sql_table} SET transcript_file=%s, model=%s WHERE {sql_table_ids}=%s',
-                             (full_filename, model_name, str(wid)))
-        else:
-            p_cursor.execute(f'UPDATE {sql_table} SET transcript_file=%s WHERE {sql_table_ids}=%s',
-                             (full_filename, str(wid)))
+        with metrics.db_timer('upload_result.update'):
+            cur.execute(upload_result_query, {'wid': table_id, 'worker_id': worker_id,
+                                              'transcript_file': full_filename, 'model': model_name or None})
+        if cur.fetchone() is None:
+            return jsonify({'success': False, 'error': lease_lost_error(wid)}), 409
 
-        p_connection.commit()
-    else:
-        return jsonify({'success': False, 'error': str(wid)+' could not access upload file'})
+        duplicates = copy_transcript_to_duplicates(cur, [table_id])
+
+    invalidate_result_cache([language] + [language for language, _ in duplicates],
+                            [podcast_title] + [podcast_title for _, podcast_title in duplicates])
 
     return jsonify({'success': True})
 
+# Bulk version of upload_result: a multipart request with one 'file' part per transcript, named <wid>.vtt, and an
+# optional 'model' form field for all of them. Either all files are stored and committed in one transaction, or
+# (if any wid is not in progress) none of them.
 @app.route(api_version + '/upload_result_batch/<api_access_key>', methods=['POST'])
 def upload_result_batch(api_access_key):
     if api_secret_key != api_access_key:
         return jsonify({'success': False, 'error': 'api_access_key invalid'})
 
-    # Retrieve the JSON payload containing wids and file paths
-    results = request.json.get('results')
-    if not results:
-        return jsonify({'success': False, 'error': 'No results provided'})
+    uploaded_files = request.files.getlist('file')
+    if not uploaded_files:
+        return jsonify({'success': False, 'error': 'No files found in POST request'})
 
-    try:
-        # Start a transaction to ensure atomicity
-        p_cursor.execute('BEGIN')
+    model_name = request.form.get('model', None) or None
+    worker_id = request.form.get('worker_id', None) or None
 
-        successful_uploads = []
-        errors = []
+    # Get the wid of every file from its filename
+    files_by_wid = {}
+    errors = []
+    for uploaded_file in uploaded_files:
+        wid = os.path.splitext(os.path.basename(uploaded_file.filename or ''))[0]
+        try:
+            files_by_wid[int(wid)] = uploaded_file
+        except ValueError:
+            errors.append({'wid': wid, 'error': 'Invalid Work ID format'})
 
-        for result in results:
-            wid = result.get('wid')
-            file_path = result.get('file_path')
-            model_name = result.get('model', None)
+    if errors:
+        return jsonify({'success': False, 'errors': errors})
 
-            # Ensure WID is an integer
-            try:
-                wid_int = int(wid)
-            except ValueError:
-                errors.append({'wid': wid, 'error': 'Invalid Work ID format'})
-                continue
+    try:
+        # One transaction to ensure atomicity
+        with p_connection.transaction() as cur:
+            with metrics.db_timer('upload_result_batch.select'):
+                cur.execute(upload_status_query, (list(files_by_wid),))
+            records = {record[0]: record for record in cur.fetchall()}
+
+            for wid in files_by_wid:
+                if wid not in records:
+                    errors.append({'wid': wid, 'error': 'Work ID not found'})
+                    continue
+
+                table_id, status, cache_audio_file, language, podcast_title, lease_owner = records[wid]
+
+                if status != 'in_progress':
+                    errors.append({'wid': wid, 'error': 'Work ID not in progress'})
+                elif lease_lost(lease_owner, worker_id):
+                    errors.append({'wid': wid, 'error': lease_lost_error(wid)})
+                elif cache_audio_file == '':
+                    errors.append({'wid': wid, 'error': 'No cache file, currently unsupported'})
+
+            # Nothing has been written yet, leaving the transaction here keeps the db untouched
+            if errors:
+                lost = [wid for wid in files_by_wid if wid in records and lease_lost(records[wid][5], worker_id)]
+                if lost:
+                    return jsonify({'success': False, 'errors': errors, 'lease_lost': lost}), 409
+                return jsonify({'success': False, 'errors': errors})
+
+            uploads = []
+            for wid, uploaded_file in files_by_wid.items():
+                full_filename = make_vtt_filename(records[wid][2])
+                print('Saving vtt file to:', full_filename)
+                vtt_storage.save(full_filename, uploaded_file.save)
+                uploads.append((wid, full_filename, model_name))
+
+            with metrics.db_timer('upload_result_batch.update'):
+                execute_values(cur, upload_batch_query, uploads, template=upload_batch_template, page_size=len(uploads))
+
+            duplicates = copy_transcript_to_duplicates(cur, [wid for wid, _, _ in uploads])
+
+        invalidate_result_cache([record[3] for record in records.values()] + [language for language, _ in duplicates],
+                                [record[4] for record in records.values()] + [podcast_title for _, podcast_title in duplicates])
+
+        return jsonify({'success': True, 'uploaded': [{'wid': wid, 'file_path': full_filename}
+                                                      for wid, full_filename, _ in uploads]})
+
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-            # Fetch the current status and file details
-            p_cursor.execute(f"""
-                SELECT {sql_table_ids}, transcript_file, cache_audio_file, episode_audio_url
-                FROM {sql_table}
-                WHERE {sql_table_ids}=%s
-            """, (wid_int,))
-            record = p_cursor.fetchone()
+prepared.register('cancel_work.select',
+                  f'SELECT episode_id, status, language, author_id, duration FROM {queue_table} WHERE episode_id=%s FOR UPDATE')
+prepared.register('cancel_work.update',
+                  f"UPDATE {queue_table} SET {fail_sql}, {clear_lease_sql} WHERE episode_id=%(wid)s RETURNING status")
 
-            if not record:
-                errors.append({'wid': wid, 'error': 'Work ID not found'})
-                continue
+# Cancel work in progress. Sets the status in the work queue back to pending and makes it available for sampling again,
+# or quarantines it if it failed too often (?reason=<error>, see fail_sql).
+# Will throw an error if the work wasn't previously in progress.
+@app.route(api_version + '/cancel_work/<wid>/<api_access_key>', methods=['GET'])
+def cancel_work(wid, api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'error':'api_access_key invalid'})
 
-            table_id, transcript_file, cache_audio_file, episode_audio_url = record
+    reason = request.args.get('reason', default=None)
+
+    with p_connection.transaction() as cur:
+        prepared.execute(cur, 'cancel_work.select', (str(wid),))
+        record = cur.fetchone()
+
+        if record is None:
+            return jsonify({'success': False, 'error': str(wid)+' not found in work queue'})
+
+        table_id, status, language, author_id, duration = record
+
+        if status != 'in_progress':
+            return jsonify({'success': False, 'error': status_error(wid, status)})
+
+        prepared.execute(cur, 'cancel_work.update', {'wid': str(wid), **fail_params(reason)})
+        new_status = cur.fetchone()[0]
+
+    if new_status == 'quarantined':
+        print(f'Quarantined {table_id} after {max_failures} failures, last error:', reason)
+    elif sampling_index is not None:
+        sampling_index.add(language, table_id, author_id, duration)
+    invalidate_result_cache([language])
+
+    return jsonify({'success': True, 'quarantined': new_status == 'quarantined'})
+
+# Cancels a batch of work in one statement, like register_batch_query: either all wids are in progress and go back
+# to pending, or nothing changes.
+cancel_batch_query = f"""
+    WITH locked AS (
+        SELECT episode_id, status, language, author_id, duration
+        FROM {queue_table}
+        WHERE episode_id = ANY(%(wids)s)
+        FOR UPDATE
+    ), cancelled AS (
+        UPDATE {queue_table} q
+        SET {fail_sql.replace('failures + ', 'q.failures + ')}, {clear_lease_sql}
+        FROM locked
+        WHERE q.episode_id = locked.episode_id
+        AND NOT EXISTS (SELECT 1 FROM locked WHERE status <> 'in_progress')
+        RETURNING q.episode_id, q.status
+    )
+    SELECT locked.episode_id, locked.status, locked.language, locked.author_id, locked.duration,
+           cancelled.episode_id IS NOT NULL, cancelled.status
+    FROM locked LEFT JOIN cancelled ON cancelled.episode_id = locked.episode_id
+"""
 
-            if transcript_file != 'in_progress':
-                errors.append({'wid': wid, 'error': 'Work ID not in progress'})
-                continue
+@app.route(api_version + '/cancel_work_batch/<api_access_key>', methods=['POST'])
+def cancel_work_batch(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'})
 
-            if cache_audio_file == '':
-                errors.append({'wid': wid, 'error': 'No cache file, currently unsupported'})
-                continue
+    # Retrieve the list of wids (and optionally the reason for the cancel, see fail_sql) from the POST request body
+    wids = request.json.get('wids')
+    reason = request.json.get('reason')
+    if not wids:
+        return jsonify({'success': False, 'error': 'No wids provided'})
 
-            # Update the transcript_file and model columns
-            if model_name:
-                p_cursor.execute(f"""
-                    UPDATE {sql_table}
-                    SET transcript_file=%s, model=%s
-                    WHERE {sql_table_ids}=%s
-                """, (file_path, model_name, wid_int))
-            else:
-                p_cursor.execute(f"""
-                    UPDATE {sql_table}
-                    SET transcript_file=%s
-                    WHERE {sql_table_ids}=%s
-                """, (file_path, wid_int))
+    try:
+        # Cast wids to integers
+        int_wids = list(map(int, wids))
+        with metrics.db_timer('cancel_work_batch.update'):
+            p_cursor.execute(cancel_batch_query, {'wids': int_wids, **fail_params(reason)})
+
+        cancelled = []
+        quarantined = []
+        errors = []
 
-            successful_uploads.append({'wid': wid, 'file_path': file_path})
+        for table_id, status, language, author_id, duration, was_cancelled, new_status in p_cursor.fetchall():
+            if was_cancelled and new_status == 'quarantined':
+                quarantined.append((table_id, language))
+            elif was_cancelled:
+                cancelled.append((table_id, language, author_id, duration))
+            elif status == 'pending':
+                errors.append({'wid': table_id, 'error': 'Work ID not in progress'})
+            elif status in unavailable_statuses:
+                errors.append({'wid': table_id, 'error': f'Work ID is {status}'})
+            elif status != 'in_progress':
+                errors.append({'wid': table_id, 'error': 'Work ID already transcribed'})
 
         if errors:
-            p_cursor.execute('ROLLBACK')
             return jsonify({'success': False, 'errors': errors})
 
-        p_connection.commit()
-        return jsonify({'success': True, 'uploaded': successful_uploads})
+        if not cancelled and not quarantined:
+            return jsonify({'success': False, 'error': 'No valid wids to update'})
+
+        quarantined_ids = [table_id for table_id, _ in quarantined]
+        if quarantined:
+            print(f'Quarantined {quarantined_ids} after {max_failures} failures, last error:', reason)
+        if sampling_index is not None:
+            for table_id, language, author_id, duration in cancelled:
+                sampling_index.add(language, table_id, author_id, duration)
+        invalidate_result_cache([language for _, language, _, _ in cancelled] + [language for _, language in quarantined])
+
+        return jsonify({'success': True, 'updated': [table_id for table_id, _, _, _ in cancelled] + quarantined_ids,
+                        'quarantined': quarantined_ids})
 
+    except PoolTimeout:
+        raise
     except Exception as e:
-        p_cursor.execute('ROLLBACK')
         return jsonify({'success': False, 'error': str(e)})
 
-# Cancel work in progress. Sets transcript_file = '' in the db and makes it available for sampling again.
-# Will throw an error if transcript_file wasn't previously set to in_progress.
-@app.route(api_version + '/cancel_work/<wid>/<api_access_key>', methods=['GET'])
-def cancel_work(wid, api_access_key):
+# Extends the lease of work in progress. Workers call this periodically while they transcribe. If the lease is owned
+# by another worker (because it expired and the work was claimed again), the heartbeat fails and the lease is untouched.
+heartbeat_query = f"""
+    UPDATE {queue_table}
+    SET lease_owner = %(worker_id)s, lease_expires_at = now() + %(lease_seconds)s * interval '1 second'
+    WHERE episode_id = ANY(%(wids)s) AND status = 'in_progress'
+    AND (lease_owner IS NULL OR lease_owner = %(worker_id)s)
+    RETURNING episode_id
+"""
+prepared.register('heartbeat.update', heartbeat_query)
+
+@app.route(api_version + '/heartbeat/<wid>/<api_access_key>', methods=['GET'])
+def heartbeat(wid, api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    worker_id = request.args.get('worker_id', default=None)
+    if not worker_id:
+        return jsonify({'success': False, 'error': 'No worker_id provided'}), 400
+
+    prepared.execute(p_cursor, 'heartbeat.update', {'wids': [int(wid)], 'worker_id': worker_id, 'lease_seconds': lease_seconds})
+    if not p_cursor.fetchall():
+        return jsonify({'success': False, 'error': str(wid)+' not in progress or leased by another worker'}), 409
+
+    return jsonify({'success': True, 'lease_seconds': lease_seconds})
+
+@app.route(api_version + '/heartbeat_batch/<api_access_key>', methods=['POST'])
+def heartbeat_batch(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    wids = request.json.get('wids')
+    worker_id = request.json.get('worker_id')
+    if not wids or not worker_id:
+        return jsonify({'success': False, 'error': 'No wids or worker_id provided'}), 400
+
+    int_wids = list(map(int, wids))
+    with metrics.db_timer('heartbeat_batch.update'):
+        p_cursor.execute(heartbeat_query, {'wids': int_wids, 'worker_id': worker_id, 'lease_seconds': lease_seconds})
+    extended = [record[0] for record in p_cursor.fetchall()]
+    lost = [wid for wid in int_wids if wid not in extended]
+
+    return jsonify({'success': not lost, 'extended': extended, 'lost': lost, 'lease_seconds': lease_seconds})
+
+# Workers register their capabilities when they start, see worker_capabilities.py. POST body:
+# {"worker_id": ..., "host": ..., "language": ..., "implementation": ..., "model": ..., "max_duration": <seconds or null>,
+#  "rtf": <optional initial real-time factor>}. Returns the stored capabilities, with the rtf of an earlier worker on
+# the same host (same implementation and model) if the worker didn't measure one.
+@app.route(api_version + '/register_worker/<api_access_key>', methods=['POST'])
+def register_worker(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    worker_id = request.json.get('worker_id')
+    if not worker_id:
+        return jsonify({'success': False, 'error': 'No worker_id provided'}), 400
+
+    try:
+        max_duration = request.json.get('max_duration')
+        rtf = request.json.get('rtf')
+        worker = worker_capabilities.register(worker_id, host=request.json.get('host'),
+                                              language=request.json.get('language'),
+                                              implementation=request.json.get('implementation'),
+                                              model=request.json.get('model'),
+                                              max_duration=float(max_duration) if max_duration else None,
+                                              rtf=float(rtf) if rtf else None)
+    except PoolTimeout:
+        raise
+    except (TypeError, ValueError, psycopg2.Error) as e:
+        return jsonify({'success': False, 'error': str(e).strip()}), 400
+
+    print('Registered worker:', worker)
+    return jsonify({'success': True, 'worker': worker, 'speed_range': worker_capabilities.speed_range(worker)})
+
+# Workers report how long a task took: {"worker_id": ..., "audio_seconds": ..., "processing_seconds": ...}, for a
+# batch the sums. Updates the moving average of the real-time factor of the worker.
+@app.route(api_version + '/report_speed/<api_access_key>', methods=['POST'])
+def report_speed(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    worker_id = request.json.get('worker_id')
+    try:
+        audio_seconds = float(request.json.get('audio_seconds'))
+        processing_seconds = float(request.json.get('processing_seconds'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'audio_seconds and processing_seconds must be numbers'}), 400
+    if not worker_id or audio_seconds <= 0 or processing_seconds <= 0:
+        return jsonify({'success': False, 'error': 'worker_id, audio_seconds > 0 and processing_seconds > 0 required'}), 400
+
+    worker = worker_capabilities.report(worker_id, audio_seconds, processing_seconds)
+    if worker is None:
+        return jsonify({'success': False, 'error': f'{worker_id} is not registered'}), 404
+
+    return jsonify({'success': True, 'rtf': worker['rtf'], 'speed_range': worker_capabilities.speed_range(worker)})
+
+# Puts work with an expired lease back into the queue and logs it in lease_reclaims. Every gunicorn process runs a reaper
+# thread, the advisory lock makes sure that only one of them does the work per round.
+lease_reaper_lock_id = 4242001
+
+reap_expired_leases_query = f"""
+    WITH expired AS (
+        SELECT episode_id, lease_owner
+        FROM {queue_table}
+        WHERE status = 'in_progress' AND lease_expires_at < now()
+        FOR UPDATE SKIP LOCKED
+    ), reclaimed AS (
+        UPDATE {queue_table} q
+        SET failures = q.failures + 1, last_error = 'lease of ' || coalesce(expired.lease_owner, '?') || ' expired',
+            status = CASE WHEN %(max_failures)s > 0 AND q.failures + 1 >= %(max_failures)s
+                          THEN 'quarantined' ELSE 'pending' END::work_status,
+            {clear_lease_sql}
+        FROM expired
+        WHERE q.episode_id = expired.episode_id
+        RETURNING q.episode_id, expired.lease_owner, q.language, q.author_id, q.duration, q.status
+    ), logged AS (
+        INSERT INTO lease_reclaims (podcast_episode_id, lease_owner, language, duration)
+        SELECT episode_id, lease_owner, language, duration FROM reclaimed
+    )
+    SELECT episode_id, lease_owner, language, author_id, duration, status FROM reclaimed
+"""
+
+# Chunks of long episodes (see claim_chunk) with expired leases, a chunk that is quarantined quarantines its episode
+reap_expired_chunks_query = f"""
+    WITH expired AS (
+        SELECT chunk_id
+        FROM work_chunks
+        WHERE status = 'in_progress' AND lease_expires_at < now()
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE work_chunks c
+    SET failures = c.failures + 1, last_error = 'lease of ' || coalesce(c.lease_owner, '?') || ' expired',
+        status = CASE WHEN %(max_failures)s > 0 AND c.failures + 1 >= %(max_failures)s
+                      THEN 'quarantined' ELSE 'pending' END::work_status,
+        {clear_lease_sql}
+    FROM expired
+    WHERE c.chunk_id = expired.chunk_id
+    RETURNING c.chunk_id, c.episode_id, c.chunk_index, c.status, c.last_error
+"""
+
+def reap_expired_leases():
+    with p_connection.transaction() as cur:
+        cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (lease_reaper_lock_id,))
+        if not cur.fetchone()[0]:
+            return []
+        with metrics.db_timer('lease_reaper.reap'):
+            cur.execute(reap_expired_leases_query, {'max_failures': max_failures})
+        records = cur.fetchall()
+
+        with metrics.db_timer('lease_reaper.reap_chunks'):
+            cur.execute(reap_expired_chunks_query, {'max_failures': max_failures})
+        for chunk_id, episode_id, chunk_index, status, last_error in cur.fetchall():
+            print(f'Lease on chunk {chunk_index} ({chunk_id}) of {episode_id} expired:', last_error)
+            if status == 'quarantined':
+                quarantine_chunked_episode(cur, episode_id, f'chunk {chunk_index}: {last_error}')
+
+    for table_id, lease_owner, language, author_id, duration, status in records:
+        if status == 'quarantined':
+            print(f'Lease of {lease_owner} on {table_id} expired, quarantined it after {max_failures} failures.')
+            continue
+        print(f'Lease of {lease_owner} on {table_id} expired, put it back into the queue.')
+        if sampling_index is not None:
+            sampling_index.add(language, table_id, author_id, duration)
+
+    return records
+
+def lease_reaper_loop():
+    while True:
+        time.sleep(lease_reaper_interval)
+        try:
+            reap_expired_leases()
+        except Exception:
+            print('Warning: lease reaper failed')
+            traceback.print_exc()
+
+if lease_reaper_interval > 0:
+    threading.Thread(target=lease_reaper_loop, name='lease-reaper', daemon=True).start()
+
+# Completes duplicates whose transcript was not copied at upload time, e.g. because the audio hash of the duplicate
+# was only added (create_filehashes.py) after the upload, or the upload went to server_async.py. Duplicates whose
+# episode was deleted (duplicate_of is set to NULL) go back into the queue. Rows are locked with SKIP LOCKED, so the
+# resolver threads of the gunicorn processes don't get in each other's way.
+duplicate_resolve_interval = config.get("duplicate_resolve_interval", 300)
+
+requeue_orphaned_duplicates_query = f"""
+    UPDATE {queue_table} SET status = 'pending'
+    WHERE status = 'duplicate' AND duplicate_of IS NULL
+    RETURNING episode_id, language, author_id, duration
+"""
+
+def resolve_duplicates():
+    with p_connection.transaction() as cur:
+        with metrics.db_timer('duplicates.requeue_orphaned'):
+            cur.execute(requeue_orphaned_duplicates_query)
+        requeued = cur.fetchall()
+
+    for table_id, language, author_id, duration in requeued:
+        print(f'Duplicate {table_id} lost its transcribed episode, put it back into the queue.')
+        if sampling_index is not None:
+            sampling_index.add(language, table_id, author_id, duration)
+
+    completed = []
+    while True:
+        with p_connection.transaction() as cur:
+            batch = copy_transcript_to_duplicates(cur)
+        completed += batch
+        if not batch:
+            break
+    if completed:
+        invalidate_result_cache([language for language, _ in completed], [podcast_title for _, podcast_title in completed])
+    return completed
+
+def duplicate_resolver_loop():
+    while True:
+        time.sleep(duplicate_resolve_interval)
+        try:
+            resolve_duplicates()
+        except Exception:
+            print('Warning: duplicate resolver failed')
+            traceback.print_exc()
+
+if duplicate_resolve_interval > 0:
+    threading.Thread(target=duplicate_resolver_loop, name='duplicate-resolver', daemon=True).start()
+
+# Lists quarantined work (see fail_sql), with the number of failures and the last error, most failures first.
+# Optional parameters: ?language=<language>&limit=<n> (default 100).
+quarantined_work_query = f"""
+    SELECT q.episode_id, q.language, q.failures, q.attempts, q.last_error, q.duration,
+           p.episode_title, p.podcast_title, p.episode_audio_url
+    FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id
+    WHERE q.status = 'quarantined' AND q.failures > 0 AND (%(language)s::text IS NULL OR q.language = %(language)s)
+    ORDER BY q.failures DESC, q.episode_id
+    LIMIT %(limit)s
+"""
+
+@app.route(api_version + '/quarantined_work/<api_access_key>', methods=['GET'])
+def quarantined_work(api_access_key):
     if api_secret_key != api_access_key:
         return jsonify({'error':'api_access_key invalid'})
 
-    p_cursor.execute(f'SELECT {sql_table_ids}, transcript_file FROM {sql_table} WHERE {sql_table_ids}=%s', (str(wid),))
-    record = p_cursor.fetchone()
+    language = request.args.get('language', default=None)
+    limit = request.args.get('limit', default=100, type=int)
+
+    with metrics.db_timer('quarantined_work.select'):
+        p_cursor.execute(quarantined_work_query, {'language': language, 'limit': limit})
+    columns = [desc[0] for desc in p_cursor.description]
+    work = [dict(zip(columns, record)) for record in p_cursor.fetchall()]
+
+    return jsonify({'success': True, 'work': work})
+
+# Puts quarantined work back into the queue, e.g. after a bug in the worker was fixed. The POST body is either
+# {"wids": [...]} or {"all": true} (optionally with "language"). The failure count is kept, so the work is
+# quarantined again after its next failure, unless "reset_failures": true. Duplicates of quarantined work stay
+# duplicates, they are completed when the requeued work is transcribed.
+requeue_quarantined_query = f"""
+    UPDATE {queue_table}
+    SET status = 'pending', failures = CASE WHEN %(reset_failures)s THEN 0 ELSE failures END
+    WHERE status = 'quarantined'
+    AND (%(wids)s::integer[] IS NULL OR episode_id = ANY(%(wids)s::integer[]))
+    AND (%(language)s::text IS NULL OR language = %(language)s)
+    RETURNING episode_id, language, author_id, duration
+"""
+
+@app.route(api_version + '/requeue_quarantined/<api_access_key>', methods=['POST'])
+def requeue_quarantined(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'error':'api_access_key invalid'})
 
-    table_id, transcript_file = record
+    wids = request.json.get('wids')
+    requeue_all = request.json.get('all', False)
+    if not wids and not requeue_all:
+        return jsonify({'success': False, 'error': 'No wids provided (use "all": true to requeue everything)'})
 
-    if transcript_file != 'in_progress':
-        if transcript_file != '':
-            return jsonify({'success': False, 'error': str(wid)+' already transcribed'})
-        return jsonify({'success': False, 'error': str(wid)+' not in progress'})
+    try:
+        params = {'wids': None if requeue_all else list(map(int, wids)),
+                  'language': request.json.get('language'),
+                  'reset_failures': bool(request.json.get('reset_failures', False))}
+        with p_connection.transaction() as cur:
+            with metrics.db_timer('requeue_quarantined.update'):
+                cur.execute(requeue_quarantined_query, params)
+            requeued = cur.fetchall()
+
+        if sampling_index is not None:
+            for table_id, language, author_id, duration in requeued:
+                sampling_index.add(language, table_id, author_id, duration)
+        invalidate_result_cache([language for _, language, _, _ in requeued])
+
+        return jsonify({'success': True, 'requeued': [table_id for table_id, _, _, _ in requeued]})
+
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-    p_cursor.execute(f"UPDATE {sql_table} SET transcript_file = '' WHERE {sql_table_ids}=%s" , (str(wid),))
-    p_connection.commit()
+# Chunked work: with chunk_threshold > 0, pending episodes longer than chunk_threshold seconds are split into chunks of
+# chunk_length seconds by a splitter thread, so that a long episode doesn't keep one worker busy for hours while the
+# others run out of work. Every chunk is transcribed with chunk_overlap seconds of extra audio on both sides. The
+# episode gets the status 'chunked', its chunks are in work_chunks (see schema.psql). Workers ask for chunks first
+# (claim_chunk) and fall back to whole episodes, chunks of the same episode are handed out in order so that episodes
+# are completed one after the other. When the last chunk of an episode is uploaded, the chunk transcripts are stitched
+# into the vtt of the episode (vtt_stitch.py) and it is marked as done, like with upload_result.
+# Only enable this when all workers understand chunks (worker.py transcribe_loop, not the batched implementation).
+chunk_threshold = config.get("chunk_threshold", 0)
+chunk_length = config.get("chunk_length", 1200)
+chunk_overlap = config.get("chunk_overlap", 15)
+chunk_split_interval = config.get("chunk_split_interval", 300)
+
+split_long_episodes_query = f"""
+    WITH long AS (
+        SELECT episode_id FROM {queue_table}
+        WHERE status = 'pending' AND duration > %(threshold)s
+        ORDER BY duration DESC
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ), chunked AS (
+        UPDATE {queue_table} q SET status = 'chunked'
+        FROM long
+        WHERE q.episode_id = long.episode_id
+        RETURNING q.episode_id, q.language, ceil(q.duration / %(length)s)::integer AS num_chunks
+    ), inserted AS (
+        INSERT INTO work_chunks (episode_id, language, chunk_index, num_chunks, start_time, end_time, cut_time)
+        SELECT episode_id, language, i, num_chunks, greatest(i * %(length)s - %(overlap)s, 0),
+               CASE WHEN i < num_chunks - 1 THEN (i + 1) * %(length)s + %(overlap)s END,
+               CASE WHEN i < num_chunks - 1 THEN (i + 1) * %(length)s END
+        FROM chunked, generate_series(0, num_chunks - 1) AS i
+    )
+    SELECT episode_id, language, num_chunks FROM chunked
+"""
+
+def split_long_episodes(limit=1000):
+    params = {'threshold': max(chunk_threshold, chunk_length), 'length': chunk_length, 'overlap': chunk_overlap,
+              'limit': limit}
+    with p_connection.transaction() as cur:
+        with metrics.db_timer('chunks.split'):
+            cur.execute(split_long_episodes_query, params)
+        records = cur.fetchall()
 
-    return jsonify({'success': True})
+    if records:
+        print(f'Split {len(records)} long episodes into {sum(num_chunks for _, _, num_chunks in records)} chunks.')
+        if sampling_index is not None:
+            sampling_index.remove([episode_id for episode_id, _, _ in records])
+        invalidate_result_cache([language for _, language, _ in records])
+    return records
+
+def chunk_splitter_loop():
+    while True:
+        try:
+            split_long_episodes()
+        except Exception:
+            print('Warning: chunk splitter failed')
+            traceback.print_exc()
+        time.sleep(chunk_split_interval)
+
+if chunk_threshold > 0 and chunk_split_interval > 0:
+    threading.Thread(target=chunk_splitter_loop, name='chunk-splitter', daemon=True).start()
+
+claim_chunk_query = f"""
+    WITH claimed AS (
+        UPDATE work_chunks
+        SET status = 'in_progress', claimed_at = now(), attempts = attempts + 1, {set_lease_sql}
+        WHERE chunk_id IN (SELECT chunk_id FROM work_chunks
+                           WHERE status = 'pending' AND language = %(language)s
+                           ORDER BY episode_id, chunk_index
+                           LIMIT 1
+                           FOR UPDATE SKIP LOCKED)
+        AND status = 'pending'
+        RETURNING chunk_id, episode_id, chunk_index, num_chunks, start_time, end_time)
+    SELECT claimed.chunk_id, claimed.chunk_index, claimed.num_chunks, claimed.start_time, claimed.end_time, {work_columns_p}
+    FROM claimed JOIN {sql_table} p ON p.{sql_table_ids} = claimed.episode_id
+"""
+
+# Claims the next chunk of a long episode for a worker. The task is the one of the episode (wid is the episode id),
+# with chunk_id, chunk_index, num_chunks and the range to transcribe in seconds: start, end (null: until the end).
+# 404 if there is no chunk, workers then ask for whole episodes with get_work / claim_work.
+@app.route(api_version + '/claim_chunk/<language>/<api_access_key>', methods=['GET'])
+def claim_chunk(language, api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'API access key invalid'}), 401
 
-@app.route(api_version + '/cancel_work_batch/<api_access_key>', methods=['POST'])
-def cancel_work_batch(api_access_key):
+    languages, error = parse_languages_param(language)
+    if error:
+        return error
+
+    worker_id = request.args.get('worker_id', default=None)
+    return first_with_work(languages, lambda language: claim_next_chunk(language, worker_id))
+
+def claim_next_chunk(language, worker_id):
+    _, max_duration = dispatch_options(worker_id, language)
+    if max_duration is not None and max_duration < chunk_length + 2 * chunk_overlap:
+        return jsonify({'success': False, 'error': 'Chunks are longer than the max_duration of this worker'}), 404
+
+    with metrics.db_timer('claim_chunk.claim'):
+        p_cursor.execute(claim_chunk_query, {'language': language, 'worker_id': worker_id, 'lease_seconds': lease_seconds})
+    record = p_cursor.fetchone()
+
+    if record is None:
+        return jsonify({'success': False, 'error': f'No chunks left for language {language}.'}), 404
+
+    chunk_id, chunk_index, num_chunks, start_time, end_time = record[:5]
+    task = make_task(record[5:])
+    task.update({'chunk_id': chunk_id, 'chunk_index': chunk_index, 'num_chunks': num_chunks,
+                 'start': start_time, 'end': end_time})
+    return jsonify(task)
+
+# Locks the chunk and its episode, uploads of the chunks of one episode wait for each other, so that exactly one
+# of them sees all chunks done and stitches the transcript.
+upload_chunk_select_query = f"""
+    SELECT c.episode_id, c.status, q.status, p.cache_audio_file, q.language, p.podcast_title, c.lease_owner
+    FROM work_chunks c
+    JOIN {queue_table} q ON q.episode_id = c.episode_id
+    JOIN {sql_table} p ON p.{sql_table_ids} = c.episode_id
+    WHERE c.chunk_id = %s
+    FOR UPDATE OF q, c
+"""
+
+# Marks a chunk as done only while the uploading worker holds its lease, see lease_lost
+upload_chunk_update_query = f"""
+    UPDATE work_chunks SET status = 'done', transcript = %(transcript)s, {clear_lease_sql}
+    WHERE chunk_id = %(chunk_id)s AND status = 'in_progress'
+    AND (%(worker_id)s::text IS NULL OR lease_owner IS NULL OR lease_owner = %(worker_id)s)
+    RETURNING chunk_id
+"""
+
+# Worker uploads the vtt of a chunk (timestamps relative to the start of the chunk audio), multipart 'file' part
+# and optional 'model' and 'worker_id' form fields like upload_result.
+@app.route(api_version + '/upload_chunk/<chunk_id>/<api_access_key>', methods=['POST'])
+def upload_chunk(chunk_id, api_access_key):
     if api_secret_key != api_access_key:
         return jsonify({'success': False, 'error': 'api_access_key invalid'})
 
-    # Retrieve the list of wids from the POST request body
-    wids = request.json.get('wids')
-    if not wids:
-        return jsonify({'success': False, 'error': 'No wids provided'})
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': 'no file found in POST request'})
+
+    model_name = request.form.get('model', None) or None
+    worker_id = request.form.get('worker_id', None) or None
 
     try:
-        # Start a transaction to ensure atomicity
-        p_cursor.execute('BEGIN')
+        transcript = request.files['file'].read().decode('utf-8')
 
-        # Cast wids to integers
-        int_wids = list(map(int, wids))
+        with p_connection.transaction() as cur:
+            cur.execute(upload_chunk_select_query, (int(chunk_id),))
+            record = cur.fetchone()
 
-        # Fetch the current status of each wid to ensure they are all in 'in_progress'
-        p_cursor.execute(f"""
-            SELECT {sql_table_ids}, transcript_file
-            FROM {sql_table}
-            WHERE {sql_table_ids} = ANY(%s)
-        """, (int_wids,))
+            if record is None:
+                return jsonify({'success': False, 'error': f'chunk {chunk_id} not found'})
 
-        records = p_cursor.fetchall()
-        update_candidates = []
-        errors = []
+            episode_id, status, episode_status, cache_audio_file, language, podcast_title, lease_owner = record
 
-        for record in records:
-            table_id, transcript_file = record
-            if transcript_file != 'in_progress':
-                if transcript_file == '':
-                    errors.append({'wid': table_id, 'error': 'Work ID not in progress'})
-                else:
-                    errors.append({'wid': table_id, 'error': 'Work ID already transcribed'})
-            else:
-                update_candidates.append(table_id)
+            if status != 'in_progress' or episode_status != 'chunked':
+                return jsonify({'success': False, 'error': f'chunk {chunk_id} not in progress'})
 
-        if errors:
-            return jsonify({'success': False, 'errors': errors})
+            if lease_lost(lease_owner, worker_id):
+                return jsonify({'success': False, 'error': lease_lost_error(f'chunk {chunk_id}')}), 409
 
-        # Update the status to '' for all applicable wids
-        if update_candidates:
-            p_cursor.execute(f"""
-                UPDATE {sql_table}
-                SET transcript_file = ''
-                WHERE {sql_table_ids} = ANY(%s)
-            """, (update_candidates,))
-            p_connection.commit()
-            return jsonify({'success': True, 'updated': update_candidates})
-        else:
-            return jsonify({'success': False, 'error': 'No valid wids to update'})
+            if cache_audio_file == '':
+                return jsonify({'success': False, 'error': str(episode_id)+' does not have a cache file, this is currently unsupported'})
+
+            with metrics.db_timer('upload_chunk.update'):
+                cur.execute(upload_chunk_update_query, {'transcript': transcript, 'chunk_id': int(chunk_id),
+                                                        'worker_id': worker_id})
+                if cur.fetchone() is None:
+                    return jsonify({'success': False, 'error': lease_lost_error(f'chunk {chunk_id}')}), 409
+                cur.execute('SELECT start_time, cut_time, transcript, status FROM work_chunks '
+                            'WHERE episode_id = %s ORDER BY chunk_index', (episode_id,))
+            chunks = cur.fetchall()
+
+            remaining = sum(1 for chunk in chunks if chunk[3] != 'done')
+            if remaining:
+                return jsonify({'success': True, 'stitched': False, 'remaining': remaining})
+
+            full_filename = make_vtt_filename(cache_audio_file)
+            vtt = vtt_stitch.stitch([(start_time, cut_time, chunk_transcript)
+                                     for start_time, cut_time, chunk_transcript, _ in chunks])
+            print(f'Stitched {len(chunks)} chunks of {episode_id}, saving vtt file to:', full_filename)
+            vtt_storage.save(full_filename, lambda out_file: out_file.write(vtt.encode('utf-8')))
+
+            with metrics.db_timer('upload_chunk.done'):
+                execute_values(cur, upload_batch_query, [(episode_id, full_filename, model_name)],
+                               template=upload_batch_template)
+                cur.execute('DELETE FROM work_chunks WHERE episode_id = %s', (episode_id,))
+
+            duplicates = copy_transcript_to_duplicates(cur, [episode_id])
+
+        invalidate_result_cache([language] + [language for language, _ in duplicates],
+                                [podcast_title] + [podcast_title for _, podcast_title in duplicates])
+
+        return jsonify({'success': True, 'stitched': True, 'file_path': full_filename})
+
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# Quarantines a chunked episode if one of its chunks failed max_failures times. The other chunks are deleted, the
+# episode is split again when it is requeued (requeue_quarantined).
+quarantine_chunked_episode_query = f"""
+    WITH quarantined AS (
+        UPDATE {queue_table} SET status = 'quarantined', failures = failures + 1, last_error = %(error)s
+        WHERE episode_id = %(episode_id)s AND status = 'chunked'
+        RETURNING language
+    ), deleted AS (
+        DELETE FROM work_chunks WHERE episode_id = %(episode_id)s
+    )
+    SELECT language FROM quarantined
+"""
+
+def quarantine_chunked_episode(cur, episode_id, error):
+    cur.execute(quarantine_chunked_episode_query, {'episode_id': episode_id, 'error': error[:max_error_length]})
+    print(f'Quarantined chunked episode {episode_id}:', error)
+    return [record[0] for record in cur.fetchall()]
+
+cancel_chunk_query = f"""
+    UPDATE work_chunks SET {fail_sql}, {clear_lease_sql}
+    WHERE chunk_id = %(chunk_id)s AND status = 'in_progress'
+    RETURNING episode_id, chunk_index, status
+"""
+
+# Cancels a chunk in progress, with ?reason=<error> it counts as a failure like in cancel_work.
+@app.route(api_version + '/cancel_chunk/<chunk_id>/<api_access_key>', methods=['GET'])
+def cancel_chunk(chunk_id, api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'error':'api_access_key invalid'})
+
+    reason = request.args.get('reason', default=None)
+
+    try:
+        with p_connection.transaction() as cur:
+            cur.execute(cancel_chunk_query, {'chunk_id': int(chunk_id), **fail_params(reason)})
+            record = cur.fetchone()
+
+            if record is None:
+                return jsonify({'success': False, 'error': f'chunk {chunk_id} not in progress'})
+
+            episode_id, chunk_index, status = record
+            languages = []
+            if status == 'quarantined':
+                languages = quarantine_chunked_episode(cur, episode_id, f'chunk {chunk_index}: {reason}')
+        invalidate_result_cache(languages)
+
+        return jsonify({'success': True, 'quarantined': status == 'quarantined'})
 
+    except PoolTimeout:
+        raise
     except Exception as e:
-        p_cursor.execute('ROLLBACK')
         return jsonify({'success': False, 'error': str(e)})
 
+# Extends the leases of chunks in progress, like heartbeat_batch. POST body: {"chunk_ids": [...], "worker_id": ...}
+heartbeat_chunks_query = f"""
+    UPDATE work_chunks
+    SET lease_owner = %(worker_id)s, lease_expires_at = now() + %(lease_seconds)s * interval '1 second'
+    WHERE chunk_id = ANY(%(chunk_ids)s) AND status = 'in_progress'
+    AND (lease_owner IS NULL OR lease_owner = %(worker_id)s)
+    RETURNING chunk_id
+"""
+
+@app.route(api_version + '/heartbeat_chunks/<api_access_key>', methods=['POST'])
+def heartbeat_chunks(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    chunk_ids = request.json.get('chunk_ids')
+    worker_id = request.json.get('worker_id')
+    if not chunk_ids or not worker_id:
+        return jsonify({'success': False, 'error': 'No chunk_ids or worker_id provided'}), 400
+
+    int_chunk_ids = list(map(int, chunk_ids))
+    with metrics.db_timer('heartbeat_chunks.update'):
+        p_cursor.execute(heartbeat_chunks_query, {'chunk_ids': int_chunk_ids, 'worker_id': worker_id,
+                                                  'lease_seconds': lease_seconds})
+    extended = [record[0] for record in p_cursor.fetchall()]
+    lost = [chunk_id for chunk_id in int_chunk_ids if chunk_id not in extended]
+
+    return jsonify({'success': not lost, 'extended': extended, 'lost': lost, 'lease_seconds': lease_seconds})
+
+# Prometheus metrics: request counts and latencies per route, db query times per named query, pool utilisation
+# and the hours in the work queue per language and status. Aggregated over all gunicorn workers, see metrics.py.
+queue_hours_collector = metrics.QueueHoursCollector(r_cursor, table=queue_table,
+                                                    interval=config.get("metrics_queue_hours_interval", 60))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not metrics.enabled or not config.get("metrics", True):
+        return jsonify({'success': False, 'error': 'metrics are disabled'}), 404
+
+    output, content_type = metrics.generate([queue_hours_collector])
+    return Response(output, content_type=content_type)
+
+@app.route(api_version + '/result_cache_stats/<api_access_key>', methods=['GET'])
+def result_cache_stats(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    return jsonify({'success': True, 'pid': os.getpid(), 'result_cache': result_cache.stats()})
+
+@app.route(api_version + '/prepared_statement_stats/<api_access_key>', methods=['GET'])
+def prepared_statement_stats(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    return jsonify({'success': True, 'pid': os.getpid(), 'prepared_statements': prepared.stats()})
+
+@app.route(api_version + '/replica_stats/<api_access_key>', methods=['GET'])
+def replica_stats(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    return jsonify({'success': True, 'pid': os.getpid(), **replica_router.stats()})
+
+# Active workers with their capabilities and speed range, as seen by this server process
+@app.route(api_version + '/worker_stats/<api_access_key>', methods=['GET'])
+def worker_stats(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    return jsonify({'success': True, 'pid': os.getpid(), **worker_capabilities.stats()})
+
+# Size and last rebuild time of the sampling index of this server process
+@app.route(api_version + '/sampling_index_stats/<api_access_key>', methods=['GET'])
+def sampling_index_stats(api_access_key):
+    if api_secret_key != api_access_key:
+        return jsonify({'success': False, 'error': 'api_access_key invalid'}), 401
+
+    if sampling_index is None:
+        return jsonify({'success': False, 'error': 'sampling index is disabled'}), 404
+
+    return jsonify({'success': True, 'languages': sampling_index.stats()})
+
 # -----------------------------------------------------------------------------
 # Training‑session (curriculum‑learning) support 
 # -----------------------------------------------------------------------------
@@ -672,6 +2113,8 @@ def start_training_session(api_access_key):
             min_duration=min_duration,
             max_duration=max_duration,
         )
+    except PoolTimeout:
+        raise
     except Exception as exc:
         traceback.print_exc()
         return jsonify({"success": False, "error": f"Failed to create session: {exc}"}), 500
@@ -698,6 +2141,8 @@ def get_next_batch(session_id, api_access_key):
             podcast_columns=podcast_columns,
             podcast_columns_list=podcast_columns_list
         )
+    except PoolTimeout:
+        raise
     except Exception as exc:
         return jsonify({"success": False, "error": str(exc)}), 400
 
@@ -719,6 +2164,8 @@ def mark_batch_done(session_id, batch_id, api_access_key):
     try:
         sess = TrainingSession(session_id=session_id)
         sess.mark_batch_done(p_connection=p_connection, p_cursor=p_cursor, epoch=epoch, batch_id=batch_id)
+    except PoolTimeout:
+        raise
     except Exception as exc:
         return jsonify({"success": False, "error": str(exc)}), 400
 
@@ -737,6 +2184,8 @@ def append_log(session_id, api_access_key):
     try:
         sess = TrainingSession(session_id=session_id)
         sess.append_log(p_cursor=p_cursor, p_connection=p_connection, level=level, message=message)
+    except PoolTimeout:
+        raise
     except Exception as exc:
         return jsonify({"success": False, "error": str(exc)}), 500
 
@@ -750,7 +2199,9 @@ def session_status(session_id, api_access_key):
 
     try:
         sess = TrainingSession(session_id=session_id)
-        status = sess.status(p_cursor)
+        status = sess.status(r_cursor)
+    except PoolTimeout:
+        raise
     except Exception as exc:
         return jsonify({"success": False, "error": str(exc)}), 404
 
@@ -764,7 +2215,9 @@ def end_training_session(session_id, api_access_key):
 
     try:
         sess = TrainingSession(session_id=session_id)
-        sess.delete(p_cursor)
+        sess.delete(p_cursor, p_connection)
+    except PoolTimeout:
+        raise
     except Exception as exc:
         return jsonify({"success": False, "error": str(exc)}), 404
 
@@ -0,0 +1,441 @@
+"""
+ASGI variant of the dispatch routes of server.py (get_work, claim_work, register_wip, upload_result, cancel_work
+and heartbeat), on Starlette and an asyncpg connection pool.
+
+The dispatch routes only wait for the db, under gunicorn's gthread workers every request in flight holds a thread.
+Here a waiting request is just a coroutine, so one process can serve thousands of workers with a small pool.
+Routes, parameters and responses are the same as in server.py, workers can use either server. Everything else
+(podcast lists, batch routes, training sessions, /metrics) is only served by server.py, run both behind the same
+proxy if you want to move only the dispatch traffic:
+
+    uvicorn server_async:app --host 127.0.0.1 --port 6001 --workers 4
+
+Not (yet) supported here: the in-memory sampling index, so episodes are always sampled in SQL, and long polling,
+?wait=<seconds> is ignored and workers get a 404 right away when there is no work.
+Transcripts of episodes with duplicate audio (see dedupe_work_queue.py) are not copied at upload time, the duplicate
+resolver of server.py does that a few minutes later.
+Capability-aware dispatch (register_worker, report_speed, see worker_capabilities.py) is only in server.py, here
+workers get episodes of any length regardless of their speed and max_duration.
+Chunks of long episodes (claim_chunk, upload_chunk, see chunk_threshold in config.yaml) are only served by server.py.
+
+bench_async_dispatch.py compares the latencies and requests per second of both servers.
+"""
+import contextlib
+import traceback
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from compression import AsgiDecompressRequestMiddleware
+from utils import load_config, make_local_url, parse_languages, language_order, status_error
+from vtt_storage import VttStorage
+
+api_version = '/apiv1'
+sql_table = 'podcasts'
+sql_table_ids = 'podcast_episode_id'
+queue_table = 'work_queue'
+
+work_columns = f'{sql_table_ids}, episode_title, authors, language, episode_audio_url, cache_audio_url, ' \
+            'cache_audio_file, transcript_file, duration'
+work_columns_p = ', '.join('p.' + column for column in work_columns.split(', '))
+
+config = load_config()
+api_secret_key = config["secret_api_key"]
+vtt_storage = VttStorage.from_config(config)
+lease_seconds = config.get("lease_seconds", 900)
+max_failures = config.get("max_failures", 3)
+max_error_length = 2000
+
+# Created in lifespan(), one pool per uvicorn worker process
+pool = None
+
+# Same as set_lease_sql in server.py. asyncpg has positional parameters, worker and seconds are their numbers
+def set_lease_sql(worker, seconds):
+    return f"lease_owner = ${worker}, lease_expires_at = CASE WHEN ${worker}::text IS NULL THEN NULL " \
+           f"ELSE now() + ${seconds}::float8 * interval '1 second' END"
+clear_lease_sql = "lease_owner = NULL, lease_expires_at = NULL"
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = await asyncpg.create_pool(database=config["database"], user=config["user"], password=config["password"],
+                                     host=config["host"], port=config["port"],
+                                     timeout=config.get("db_connect_timeout", 10),
+                                     min_size=config.get("async_db_pool_minconn", 4),
+                                     max_size=config.get("async_db_pool_maxconn", 32),
+                                     server_settings={'statement_timeout': str(int(config.get("db_statement_timeout", 30000)))})
+    try:
+        yield
+    finally:
+        await pool.close()
+
+# Checks out a connection like pool.acquire(), but waits at most db_pool_timeout seconds for it
+def acquire():
+    return pool.acquire(timeout=config.get("db_pool_timeout", 10))
+
+def make_task(record):
+    table_id, episode_title, authors, language, episode_audio_url, cache_audio_url, cache_audio_file, transcript_file, duration = record
+    return {
+        'wid': table_id,
+        'episode_title': episode_title,
+        'authors': authors,
+        'language': language,
+        'episode_audio_url': episode_audio_url,
+        'cache_audio_url': cache_audio_url,
+        'local_cache_audio_url': make_local_url(cache_audio_url, config),
+        'cache_audio_file': cache_audio_file,
+        'transcript_file': transcript_file,
+        'duration': duration,
+        'success': True
+    }
+
+def error(message, status_code=200):
+    return JSONResponse({'success': False, 'error': message}, status_code=status_code)
+
+def no_work_left(language):
+    return error(f'No episodes left without transcriptions for language {language}.', 404)
+
+# Several languages in the url (de,fr or de:3,fr:1) like in server.py, tried in language_order until one has work
+def parse_languages_param(language):
+    try:
+        return parse_languages(language), None
+    except ValueError:
+        return None, error('Invalid language format', 400)
+
+async def first_with_work(languages, attempt):
+    for language in language_order(languages):
+        response = await attempt(language)
+        if response.status_code != 404:
+            return response
+    return response
+
+def unexpected_error():
+    traceback.print_exc()
+    return error('An unexpected error occurred', 500)
+
+# Same four steps as sample_work in server.py: count the authors with pending episodes, pick one at a random
+# offset, count its episodes and pick one of them at a random offset.
+author_count_query = f"""
+    SELECT COUNT(DISTINCT author_id)
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = $1
+"""
+author_sample_query = f"""
+    SELECT DISTINCT author_id
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = $1
+    OFFSET floor(random() * $2::integer)
+    LIMIT 1
+"""
+episode_count_query = f"""
+    SELECT COUNT(*)
+    FROM {queue_table}
+    WHERE status = 'pending' AND language = $1 AND author_id = $2
+"""
+episode_sample_query = f"""
+    SELECT {work_columns_p}
+    FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id
+    WHERE q.status = 'pending' AND q.language = $1 AND q.author_id = $2
+    OFFSET floor(random() * $3::integer)
+    LIMIT 1
+"""
+
+async def get_work(request):
+    if api_secret_key != request.path_params['api_access_key']:
+        return error('API access key invalid', 401)
+
+    languages, invalid = parse_languages_param(request.path_params['language'])
+    if invalid:
+        return invalid
+
+    return await first_with_work(languages, sample_work)
+
+async def sample_work(language):
+    try:
+        async with acquire() as conn:
+            author_count = await conn.fetchval(author_count_query, language)
+            if author_count == 0:
+                return no_work_left(language)
+
+            author_id = await conn.fetchval(author_sample_query, language, author_count)
+            if author_id is None:
+                return error('No author found', 404)
+
+            episode_count = await conn.fetchval(episode_count_query, language, author_id)
+            if episode_count == 0:
+                return error(f'No episodes without transcription for author: {author_id}', 404)
+
+            record = await conn.fetchrow(episode_sample_query, language, author_id, episode_count)
+    except Exception:
+        return unexpected_error()
+
+    if record is None:
+        return error(f'No episodes found for author: {author_id}', 404)
+
+    return JSONResponse(make_task(record))
+
+# See make_claim_query in server.py. $1 is the language, $2 n, $3 the worker_id, $4 lease_seconds, $5 min_duration
+def make_claim_query(candidates_sql):
+    return f"""
+    WITH claimed AS (
+        UPDATE {queue_table}
+        SET status = 'in_progress', claimed_at = now(), attempts = attempts + 1, {set_lease_sql(3, 4)}
+        WHERE episode_id IN ({candidates_sql} FOR UPDATE SKIP LOCKED)
+        AND status = 'pending'
+        RETURNING episode_id)
+    SELECT {work_columns_p} FROM claimed JOIN {sql_table} p ON p.{sql_table_ids} = claimed.episode_id
+    """
+
+claim_author_query = make_claim_query(f"""
+        SELECT episode_id
+        FROM {queue_table}
+        WHERE status = 'pending' AND language = $1 AND author_id = (
+            SELECT author_id
+            FROM (SELECT DISTINCT author_id FROM {queue_table}
+                  WHERE status = 'pending' AND language = $1) AS pending_authors
+            OFFSET floor(random() * (SELECT COUNT(DISTINCT author_id) FROM {queue_table}
+                                     WHERE status = 'pending' AND language = $1))
+            LIMIT 1)
+        ORDER BY RANDOM()
+        LIMIT $2""")
+
+claim_batch_query = make_claim_query(f"""
+        SELECT episode_id
+        FROM {queue_table}
+        WHERE status = 'pending' AND language = $1 AND duration >= $5
+        ORDER BY duration, RANDOM()
+        LIMIT $2""")
+
+claim_retries = 3
+
+async def claim_work(request):
+    if api_secret_key != request.path_params['api_access_key']:
+        return error('API access key invalid', 401)
+
+    languages, invalid = parse_languages_param(request.path_params['language'])
+    if invalid:
+        return invalid
+
+    try:
+        n = int(request.query_params.get('n', 1))
+        min_duration = float(request.query_params.get('min_duration', 0))
+    except ValueError:
+        return error('n and min_duration must be numbers', 400)
+    worker_id = request.query_params.get('worker_id')
+
+    if n < 1:
+        return error('n must be >= 1', 400)
+
+    return await first_with_work(languages, lambda language: claim(language, n, min_duration, worker_id))
+
+async def claim(language, n, min_duration, worker_id):
+    try:
+        records = None
+        async with acquire() as conn:
+            for _ in range(claim_retries):
+                if n == 1:
+                    records = await conn.fetch(claim_author_query, language, n, worker_id, lease_seconds)
+                else:
+                    records = await conn.fetch(claim_batch_query, language, n, worker_id, lease_seconds, min_duration)
+                if records:
+                    break
+    except Exception:
+        return unexpected_error()
+
+    if not records:
+        return no_work_left(language)
+
+    return JSONResponse({'tasks': [make_task(record) for record in records], 'success': True})
+
+async def register_wip(request):
+    wid = request.path_params['wid']
+    if api_secret_key != request.path_params['api_access_key']:
+        return error('api_access_key invalid')
+
+    worker_id = request.query_params.get('worker_id')
+
+    try:
+        async with acquire() as conn:
+            async with conn.transaction():
+                record = await conn.fetchrow(f'SELECT episode_id, status FROM {queue_table} WHERE episode_id=$1 FOR UPDATE',
+                                             int(wid))
+
+                if record is None:
+                    return error(str(wid)+' not found in work queue')
+
+                if record['status'] != 'pending':
+                    return error(status_error(wid, record['status']))
+
+                await conn.execute(f"UPDATE {queue_table} SET status = 'in_progress', claimed_at = now(), "
+                                   f"attempts = attempts + 1, {set_lease_sql(2, 3)} WHERE episode_id=$1",
+                                   int(wid), worker_id, lease_seconds)
+    except ValueError:
+        return error(str(wid)+' is not a valid work ID')
+    except Exception:
+        return unexpected_error()
+
+    return JSONResponse({'success': True})
+
+upload_status_query = f"""
+    SELECT q.episode_id, q.status, p.cache_audio_file, q.lease_owner
+    FROM {queue_table} q JOIN {sql_table} p ON p.{sql_table_ids} = q.episode_id
+    WHERE q.episode_id = $1
+    FOR UPDATE OF q
+"""
+
+# Only while the uploading worker ($4) holds the lease, see lease_lost in server.py
+upload_query = f"""
+    WITH done AS (
+        UPDATE {queue_table}
+        SET status = 'done', {clear_lease_sql}
+        WHERE episode_id = $1 AND status = 'in_progress'
+        AND ($4::text IS NULL OR lease_owner IS NULL OR lease_owner = $4)
+        RETURNING episode_id
+    )
+    UPDATE {sql_table} p
+    SET transcript_file = $2, model = coalesce($3, p.model)
+    FROM done
+    WHERE p.{sql_table_ids} = done.episode_id
+    RETURNING p.{sql_table_ids}
+"""
+
+def save_upload(upload_file, full_filename):
+    upload_file.file.seek(0)
+
+    def write(out_file):
+        while chunk := upload_file.file.read(1024 * 1024):
+            out_file.write(chunk)
+
+    vtt_storage.save(full_filename, write)
+
+async def upload_result(request):
+    wid = request.path_params['wid']
+    if api_secret_key != request.path_params['api_access_key']:
+        return error('api_access_key invalid')
+
+    # starlette spools large uploads to a temporary file, like werkzeug
+    form = await request.form()
+    upload_file = form.get('file')
+    if upload_file is None or isinstance(upload_file, str):
+        return error('no file found in POST request')
+
+    model_name = form.get('model', None) or None
+    worker_id = form.get('worker_id', None) or None
+
+    try:
+        async with acquire() as conn:
+            async with conn.transaction():
+                record = await conn.fetchrow(upload_status_query, int(wid))
+
+                if record is None:
+                    return error(str(wid)+' not found in work queue')
+
+                table_id, status, cache_audio_file, lease_owner = record
+
+                if status != 'in_progress':
+                    return error(str(wid)+' not in progress')
+
+                if worker_id is not None and lease_owner is not None and lease_owner != worker_id:
+                    return error(f'{wid} is leased to another worker', 409)
+
+                if cache_audio_file == '':
+                    return error(str(wid)+' does not have a cache file, this is currently unsupported')
+
+                # file system calls block, they run in starlette's thread pool
+                full_filename = await run_in_threadpool(vtt_storage.path, cache_audio_file)
+                print('Saving vtt file to:', full_filename)
+                await run_in_threadpool(save_upload, upload_file, full_filename)
+
+                if await conn.fetchval(upload_query, table_id, full_filename, model_name, worker_id) is None:
+                    return error(f'{wid} is leased to another worker', 409)
+    except ValueError:
+        return error(str(wid)+' is not a valid work ID')
+    except Exception:
+        return unexpected_error()
+    finally:
+        await form.close()
+
+    return JSONResponse({'success': True})
+
+async def cancel_work(request):
+    wid = request.path_params['wid']
+    if api_secret_key != request.path_params['api_access_key']:
+        return JSONResponse({'error': 'api_access_key invalid'})
+
+    # a cancel with a reason counts as a failure, see fail_sql in server.py
+    reason = request.query_params.get('reason') or None
+    if reason:
+        reason = reason[:max_error_length]
+
+    try:
+        async with acquire() as conn:
+            async with conn.transaction():
+                status = await conn.fetchval(f'SELECT status FROM {queue_table} WHERE episode_id=$1 FOR UPDATE', int(wid))
+
+                if status is None:
+                    return error(str(wid)+' not found in work queue')
+
+                if status != 'in_progress':
+                    return error(status_error(wid, status))
+
+                status = await conn.fetchval(
+                    f"UPDATE {queue_table} SET failures = failures + $2::integer, last_error = coalesce($3::text, last_error), "
+                    f"status = CASE WHEN $4::integer > 0 AND failures + $2::integer >= $4::integer "
+                    f"THEN 'quarantined' ELSE 'pending' END::work_status, {clear_lease_sql} "
+                    f"WHERE episode_id=$1 RETURNING status",
+                    int(wid), 1 if reason else 0, reason, max_failures)
+    except ValueError:
+        return error(str(wid)+' is not a valid work ID')
+    except Exception:
+        return unexpected_error()
+
+    return JSONResponse({'success': True, 'quarantined': status == 'quarantined'})
+
+heartbeat_query = f"""
+    UPDATE {queue_table}
+    SET lease_owner = $2, lease_expires_at = now() + $3::float8 * interval '1 second'
+    WHERE episode_id = ANY($1::integer[]) AND status = 'in_progress'
+    AND (lease_owner IS NULL OR lease_owner = $2)
+    RETURNING episode_id
+"""
+
+async def heartbeat(request):
+    wid = request.path_params['wid']
+    if api_secret_key != request.path_params['api_access_key']:
+        return error('api_access_key invalid', 401)
+
+    worker_id = request.query_params.get('worker_id')
+    if not worker_id:
+        return error('No worker_id provided', 400)
+
+    try:
+        async with acquire() as conn:
+            extended = await conn.fetch(heartbeat_query, [int(wid)], worker_id, lease_seconds)
+    except ValueError:
+        return error(str(wid)+' is not a valid work ID', 400)
+    except Exception:
+        return unexpected_error()
+
+    if not extended:
+        return error(str(wid)+' not in progress or leased by another worker', 409)
+
+    return JSONResponse({'success': True, 'lease_seconds': lease_seconds})
+
+routes = [
+    Route(api_version + '/get_work/{language}/{api_access_key}', get_work, methods=['GET']),
+    Route(api_version + '/claim_work/{language}/{api_access_key}', claim_work, methods=['GET']),
+    Route(api_version + '/register_wip/{wid}/{api_access_key}', register_wip, methods=['GET']),
+    Route(api_version + '/upload_result/{wid}/{api_access_key}', upload_result, methods=['POST']),
+    Route(api_version + '/cancel_work/{wid}/{api_access_key}', cancel_work, methods=['GET']),
+    Route(api_version + '/heartbeat/{wid}/{api_access_key}', heartbeat, methods=['GET']),
+]
+
+# Compressed uploads (worker.py --upload-encoding, gzip by default) are decompressed like in server.py
+middleware = [Middleware(AsgiDecompressRequestMiddleware,
+                         max_size=config.get("max_decompressed_request_size", 256 * 1024 * 1024))]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=middleware)
@@ -1,4 +1,8 @@
 # You can also use a unix socket for more efficiency
-# gunicorn --workers=4 --threads=32 --bind unix:speechcatcher.sock --worker-class=gthread server:app
+# gunicorn -c gunicorn.conf.py --workers=4 --threads=32 --bind unix:speechcatcher.sock --worker-class=gthread server:app
 
-gunicorn --workers=8 --threads=128 --bind 127.0.0.1:6000 --worker-class=gthread server:app
+# Every worker process opens its own db connection pool (db_pool_maxconn in config.yaml) plus one
+# connection that listens for new work (long_poll), so postgres needs max_connections >= workers * (db_pool_maxconn + 1).
+# Long-polling requests hold a gunicorn thread (but no db connection) while they wait.
+# gunicorn.conf.py sets up the multiprocess directory for the /metrics endpoint.
+gunicorn -c gunicorn.conf.py --workers=8 --threads=128 --bind 127.0.0.1:6000 --worker-class=gthread server:app
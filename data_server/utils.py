@@ -1,3 +1,4 @@
+import random
 import yaml
 import psycopg2
 import traceback
@@ -15,7 +16,10 @@ def ensure_dir(f):
     if not os.path.exists(d):
         os.makedirs(d)
 
-def load_config(config_filename='../config.yaml'):
+# SPEECHCATCHER_CONFIG can point to another config file, e.g. for a server that load_test.py starts on a scratch db
+def load_config(config_filename=None):
+    if config_filename is None:
+        config_filename = os.environ.get('SPEECHCATCHER_CONFIG', '../config.yaml')
     with open(config_filename, "r") as stream:
         try:
             return yaml.safe_load(stream)
@@ -48,4 +52,70 @@ def connect_to_db(database, user, password, host='127.0.0.1', port='5432'):
         print ("Error while connecting to PostgreSQL", error)
         traceback.print_exc()
         sys.exit(-1)
- 
+
+def make_local_url(my_url, config):
+    if 'replace_local_audio_url' in config:
+        try:
+            if '->' not in config['replace_local_audio_url']:
+                return my_url
+            a, b = config['replace_local_audio_url'].split('->')
+            return my_url.replace(a, b)  # Make sure to return the modified URL
+        except Exception as e:
+            print('Warning, something went wrong trying to make local url out of:', my_url)
+            print('Error:', str(e))
+            print('Traceback:', traceback.format_exc())
+            print('Using original link instead')
+            return my_url
+    else:
+        print('Warning: replace_local_audio_url not in config, returning unmodified local link.')
+        return my_url
+
+def parse_languages(spec):
+    """
+    Parses the language part of get_work / claim_work urls (and worker.py --language): one language ('de'), several
+    in order of priority ('de,fr,en') or with weights ('de:3,fr:1', a language without weight has weight 1).
+    Returns a list of (language, weight) tuples, weight is None for a priority list. Raises ValueError if invalid.
+    """
+    languages = []
+    for part in spec.split(','):
+        language, _, weight = part.strip().partition(':')
+        if not language.isalpha():
+            raise ValueError(f'Invalid language format: {part}')
+        if weight:
+            weight = float(weight)
+            if not weight > 0:
+                raise ValueError(f'Invalid weight for language {language}: {weight}')
+        languages.append((language, weight or None))
+    if any(weight is not None for _, weight in languages):
+        languages = [(language, weight or 1.) for language, weight in languages]
+    return languages
+
+def language_order(languages):
+    """
+    Order in which to look for work in the languages from parse_languages: the given order for a priority list.
+    With weights, a language comes first with a probability proportional to its weight, then the next one is drawn
+    from the remaining languages the same way, so work is split by the weights while every language has work left.
+    """
+    remaining = list(languages)
+    if all(weight is None for _, weight in remaining):
+        return [language for language, _ in remaining]
+    order = []
+    while remaining:
+        i = random.choices(range(len(remaining)), weights=[weight for _, weight in remaining])[0]
+        order.append(remaining.pop(i)[0])
+    return order
+
+# Work queue statuses of episodes that are neither pending nor transcribed by a worker of their own (see schema.psql):
+# duplicates get the transcript of another episode, quarantined work failed too often, chunked episodes are
+# transcribed chunk by chunk
+unavailable_statuses = ('duplicate', 'quarantined', 'chunked')
+
+def status_error(wid, status):
+    """Error for work that can't be registered or cancelled because of its status, for server.py and server_async.py."""
+    if status == 'in_progress':
+        return str(wid)+' already in progress'
+    if status == 'pending':
+        return str(wid)+' not in progress'
+    if status in unavailable_statuses:
+        return f'{wid} is {status}'
+    return str(wid)+' already transcribed'
@@ -0,0 +1,64 @@
+"""
+Merges the vtt transcripts of the chunks of a long episode into one vtt, see work_chunks in schema.psql.
+
+Chunk i covers [i * chunk_length, (i + 1) * chunk_length) of the episode and is transcribed with chunk_overlap seconds
+of extra audio on both sides, so that the words at a cut are complete in at least one chunk. The timestamps in a chunk
+vtt are relative to the start of its audio and are shifted by the chunk start here. A cue of chunk i is kept if it
+starts before the next cut and not before the end of the last kept cue: the cue that runs across a cut is taken from
+the chunk in which it starts, and the cues of the next chunk that repeat it (they start before it ends) are dropped.
+"""
+import re
+
+timestamp_re = re.compile(r'(?:(\d+):)?(\d+):(\d+)[.,](\d+)')
+
+def parse_timestamp(timestamp):
+    """Seconds from a vtt timestamp (hh:mm:ss.mmm or mm:ss.mmm)."""
+    match = timestamp_re.fullmatch(timestamp.strip())
+    if match is None:
+        raise ValueError(f'Invalid vtt timestamp: {timestamp}')
+    hours, minutes, seconds, fraction = match.groups()
+    return int(hours or 0) * 3600. + int(minutes) * 60. + int(seconds) + int(fraction) / 10 ** len(fraction)
+
+def format_timestamp(seconds):
+    """Like whisper.utils.format_timestamp, hours are only included for timestamps >= 1 hour."""
+    milliseconds = round(max(seconds, 0.) * 1000.)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    hours_marker = f'{hours:02d}:' if hours > 0 else ''
+    return f'{hours_marker}{minutes:02d}:{seconds:02d}.{milliseconds:03d}'
+
+def parse_vtt(vtt):
+    """List of (start, end, text) cues of a vtt string, in seconds."""
+    cues = []
+    for block in re.split(r'\n\s*\n', vtt.replace('\r\n', '\n')):
+        lines = [line for line in block.split('\n') if line.strip()]
+        for i, line in enumerate(lines):
+            if '-->' in line:
+                start, end = line.split('-->', 1)
+                # settings after the end timestamp (position, align, ...) are dropped
+                text = '\n'.join(lines[i + 1:]).strip()
+                if text:
+                    cues.append((parse_timestamp(start), parse_timestamp(end.split()[0]), text))
+                break
+    return cues
+
+def write_vtt(cues):
+    return 'WEBVTT\n\n' + ''.join(f'{format_timestamp(start)} --> {format_timestamp(end)}\n{text}\n\n'
+                                  for start, end, text in cues)
+
+def stitch(chunks):
+    """
+    chunks: list of (offset, cut, vtt) in episode order, offset is the start of the chunk audio in the episode and cut
+    the time where the next chunk takes over (None for the last chunk). Returns the vtt string of the whole episode.
+    """
+    cues = []
+    last_end = 0.
+    for offset, cut, vtt in chunks:
+        for start, end, text in parse_vtt(vtt):
+            start, end = start + offset, end + offset
+            if start < last_end or (cut is not None and start >= cut):
+                continue
+            cues.append((start, end, text))
+            last_end = end
+    return write_vtt(cues)
@@ -0,0 +1,126 @@
+"""
+Where vtt files are stored and how they are written.
+
+Layout: vtt_dir (config.yaml) can use {source_dir} for the directory of the audio file in the cache, the vtt file is
+named like the audio file with .vtt appended. With vtt_shard_levels > 0 the files are spread over hash-prefix
+subdirectories, e.g. with 2 levels of width 2:
+
+    {source_dir}/vtts/3f/a2/episode.mp3.vtt
+
+where 3fa2... is the md5 of the audio filename. Directories then stay small (at most 256 entries per level with the
+default width), which keeps listings, globs and backups fast with millions of transcripts. vtt_shard_levels 0 is
+the old flat layout. migrate_vtt_storage.py moves existing files between layouts and updates transcript_file.
+
+Writes are atomic: the data goes to a temporary file in the target directory, which is fsynced and then renamed to
+the final name, so a crashed upload never leaves a truncated vtt behind.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+class VttStorage:
+    def __init__(self, vtt_dir, shard_levels=0, shard_width=2):
+        self.vtt_dir = vtt_dir
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+        # directories that are known to exist, so that uploads don't stat them every time
+        self.created = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["vtt_dir"], shard_levels=config.get("vtt_shard_levels", 0),
+                   shard_width=config.get("vtt_shard_width", 2))
+
+    def shard_dirs(self, filename):
+        digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+        return [digest[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_levels)]
+
+    def path(self, cache_audio_file, create=True):
+        """Path of the vtt file for an audio file in the cache, creates its directory unless create=False."""
+        source_dir, _, filename = cache_audio_file.rpartition('/')
+        directory = os.path.join(self.vtt_dir.replace('{source_dir}', source_dir), *self.shard_dirs(filename))
+        if create:
+            self.ensure_dir(directory)
+        return os.path.join(directory, filename + '.vtt')
+
+    def ensure_dir(self, directory):
+        with self.lock:
+            if directory in self.created:
+                return
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.created.add(directory)
+
+    def save(self, full_filename, write):
+        """Atomically writes full_filename, write(file) gets a binary file object, e.g. FileStorage.save."""
+        with atomic_write(full_filename) as out_file:
+            write(out_file)
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Opens a temporary file next to path for writing, on success it is fsynced and renamed to path (replacing an
+    older file), on errors it is removed and path is untouched.
+    """
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=f'.{filename}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as out_file:
+            yield out_file
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        # mkstemp creates the file with 0600, uploaded vtts are served by the web server like before
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    fsync_dir(directory or '.')
+
+def link_or_copy(src, dst):
+    """
+    Makes dst a hard link of src (e.g. the transcript of an episode with the same audio, see dedupe_work_queue.py),
+    or a copy if src is on another file system. dst is replaced atomically.
+    """
+    # rename() does nothing if both names are links of the same file, the temporary link would be left behind
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    directory, filename = os.path.split(dst)
+    tmp_path = os.path.join(directory, f'.{filename}.{os.getpid()}.{threading.get_ident()}.link')
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        with open(src, 'rb') as in_file, atomic_write(dst) as out_file:
+            shutil.copyfileobj(in_file, out_file)
+        return
+    os.replace(tmp_path, dst)
+    fsync_dir(directory or '.')
+
+def fsync_dir(directory):
+    """Makes a rename in directory durable. Not supported on every OS / file system, errors are ignored."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def find_vtt_files(vtt_dir, file_type='vtt'):
+    """All transcript files below vtt_dir, in the flat and the sharded layout (but not in corrupted/ directories)."""
+    files = []
+    for root, dirs, filenames in os.walk(vtt_dir):
+        dirs[:] = [d for d in dirs if d != 'corrupted']
+        files.extend(os.path.join(root, filename) for filename in filenames
+                     if filename.endswith('.' + file_type) and not filename.startswith('.'))
+    return sorted(files)
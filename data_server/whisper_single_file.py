@@ -1,5 +1,20 @@
 import os
 import copy
+import subprocess
+import numpy as np
+
+def load_audio_range(url, start=0., end=None, sample_rate=16000):
+    '''Decodes [start, end) seconds of an audio file or url with ffmpeg, as 16 kHz mono float32 like whisper.audio.load_audio.
+       Used for the chunks of long episodes, all implementations accept the array instead of a url.'''
+    cmd = ['ffmpeg', '-nostdin', '-threads', '0', '-ss', str(start)]
+    if end is not None:
+        cmd += ['-t', str(end - start)]
+    cmd += ['-i', url, '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(sample_rate), '-']
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode(errors='replace')[-1000:]}") from e
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
 
 class WhisperSingleFile:
     '''Base class for Whisper implementations that work operate on single files.'''
@@ -146,7 +161,8 @@ class WhisperX(FasterWhisper):
         if language is not None:
             params['language'] = language
         print('Running single-file transcription with CTranslate2 WhisperX fp16 implementation on:', url)
-        audio = self.whisperx.load_audio(url)
+        # chunks of long episodes are passed as an array, see load_audio_range
+        audio = self.whisperx.load_audio(url) if isinstance(url, str) else url
         result = self.model.transcribe(audio, **params)
         segments, info = result
         return {'segments': list(segments), 'language': info.language}
@@ -0,0 +1,106 @@
+import json
+import select
+import threading
+import time
+import traceback
+import psycopg2
+
+class WorkNotifier:
+    """
+    Listens for the notifications that the work_queue_notify trigger (schema.psql) sends when an episode becomes
+    pending, i.e. when it is inserted, cancelled or reclaimed by the lease reaper, and wakes up long-polling requests.
+
+    The listener runs in a background thread with its own db connection (not from the pool, it is idle most of the
+    time). Every notification bumps a per-language generation counter. To not miss work that shows up between an
+    empty query and the wait, take the generation before the query and pass it to wait():
+
+        generation = notifier.generation(language)
+        ... query, nothing found ...
+        notifier.wait(language, generation, timeout)
+
+    on_notify(payload) is called for every notification, e.g. to add the episode to the sampling index.
+    """
+    def __init__(self, channel='work_queue', on_notify=None, poll_interval=5., **connect_kwargs):
+        self.channel = channel
+        self.on_notify = on_notify
+        self.poll_interval = poll_interval
+        self.connect_kwargs = connect_kwargs
+        self.generations = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.connected = False
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._listen_loop, name='work-notifier', daemon=True)
+            self.thread.start()
+
+    def generation(self, language):
+        with self.condition:
+            return self.generations.setdefault(language, 0)
+
+    def wait(self, language, generation, timeout):
+        """Waits until new work for the language was announced after `generation`, returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.generations.get(language, 0) != generation, timeout)
+
+    def wait_any(self, generations, timeout):
+        """Like wait for several languages, generations is a {language: generation} dict."""
+        with self.condition:
+            return self.condition.wait_for(lambda: any(self.generations.get(language, 0) != generation
+                                                       for language, generation in generations.items()), timeout)
+
+    def _notify(self, payload):
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            print('Warning: could not parse work queue notification:', payload)
+            return
+        with self.condition:
+            language = payload.get('language')
+            self.generations[language] = self.generations.get(language, 0) + 1
+            self.condition.notify_all()
+        if self.on_notify is not None:
+            self.on_notify(payload)
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f'LISTEN {self.channel}')
+            self.connected = True
+            print(f'Listening for work queue notifications on channel {self.channel}')
+            # notifications sent while we were disconnected are lost, let all waiting requests query again
+            self._wake_all()
+            while True:
+                # select() returns when a notification arrives, on timeout a cheap query checks the connection
+                if select.select([conn], [], [], self.poll_interval) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        self._notify(conn.notifies.pop(0).payload)
+                else:
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT 1')
+        finally:
+            self.connected = False
+            conn.close()
+
+    def _wake_all(self):
+        with self.condition:
+            for language in self.generations:
+                self.generations[language] += 1
+            self.condition.notify_all()
+
+    def _listen_loop(self):
+        backoff = 1.
+        while True:
+            start = time.time()
+            try:
+                self._listen()
+            except Exception:
+                print('Warning: work queue listener failed, reconnecting in', backoff, 's')
+                traceback.print_exc()
+            # waiting requests fall back to their timeout while we are disconnected
+            backoff = 1. if time.time() - start > 60. else min(backoff * 2., 60.)
+            time.sleep(backoff)
@@ -5,15 +5,20 @@ import argparse
 import torch
 import numpy as np
 import io
+import os
+import socket
+import threading
 import time
 from json import JSONDecodeError
 from urllib.parse import urlparse, urlunparse
 
-from utils import load_config
+from utils import load_config, parse_languages
+from compression import post_compressed
+from backpressure import Backoff
 from whisper.utils import format_timestamp
 from typing import Iterator, TextIO
 
-from whisper_single_file import WhisperOriginal, FasterWhisper, WhisperX, WhisperCpp
+from whisper_single_file import WhisperOriginal, FasterWhisper, WhisperX, WhisperCpp, load_audio_range
 from whisper_multiple_files import BatchedTransformerWhisper
 
 podcast_initial_prompts = {
@@ -45,28 +50,230 @@ def add_auth_to_url(url, https_user, https_password):
         return urlunparse(parsed_url._replace(netloc=netloc))
     return url
 
-def cancel_work(server, secret_api_key, wid, api_version='apiv1'):
-    """ Cancels the work in progress for one task on the server. """
+def wait_for_work(resp, request_seconds, idle_sleep):
+    """
+    Handles a 404 (no work left) from get_work / claim_work. With long polling the server already waited for new
+    work, so we only sleep if the server answered faster than idle_sleep (e.g. an older server without long polling).
+    Returns True if the response was a 404.
+    """
+    if resp.status_code != 404:
+        return False
+    print('No work available:', resp.text.strip())
+    time.sleep(max(0., idle_sleep - request_seconds))
+    return True
+
+class ServerOverloaded(Exception):
+    """ The server answered 503 (or 429), it sheds load. retry_after is its Retry-After header (or None). """
+    def __init__(self, resp):
+        super().__init__(f'Server overloaded ({resp.status_code}): {resp.text.strip()}')
+        self.retry_after = resp.headers.get('Retry-After')
+
+def raise_if_overloaded(resp):
+    if resp.status_code in (429, 503):
+        raise ServerOverloaded(resp)
+    return resp
+
+def request_with_backoff(send, attempts=8, max_backoff=300):
+    """
+    Calls send() (a function that makes one request and returns the response) until the server is reachable and not
+    overloaded, at most attempts times, with jittered exponential backoff in between. Used for requests that must not
+    get lost, like uploading a finished transcript. Raises the last error if all attempts failed.
+    """
+    backoff = Backoff(max_delay=max_backoff)
+    for attempt in range(attempts):
+        try:
+            return raise_if_overloaded(send())
+        except (ServerOverloaded, requests.ConnectionError, requests.Timeout) as e:
+            if attempt == attempts - 1:
+                raise
+            print(f'Request failed (attempt {attempt + 1} of {attempts}):', e)
+            backoff.sleep(getattr(e, 'retry_after', None))
+
+def register_worker(server, secret_api_key, worker_id, language, implementation, model, max_duration=None, rtf=None, api_version='apiv1'):
+    """
+    Registers the capabilities of this worker with the server, which routes long episodes to fast workers and never
+    sends episodes longer than max_duration (seconds). Older servers don't have this, the worker then runs without it.
+    """
+    url = f'{server}/{api_version}/register_worker/{secret_api_key}'
+    payload = {'worker_id': worker_id, 'host': socket.gethostname(), 'language': language,
+               'implementation': implementation, 'model': model, 'max_duration': max_duration, 'rtf': rtf}
+    try:
+        resp = request_with_backoff(lambda: requests.post(url, json=payload, timeout=60), attempts=3)
+        data = resp.json()
+        print('Registered worker capabilities:', data)
+        return data
+    except Exception as e:
+        print('Warning, could not register worker capabilities:', e)
+        return None
+
+def report_speed(server, secret_api_key, worker_id, audio_seconds, processing_seconds, api_version='apiv1'):
+    """ Reports how long the transcription of audio_seconds of audio took, the server keeps the real-time factor. """
+    if not audio_seconds or audio_seconds <= 0 or not worker_id:
+        return
+    print(f'Transcribed {audio_seconds:.0f}s of audio in {processing_seconds:.0f}s (rtf {processing_seconds / audio_seconds:.3f})')
+    try:
+        requests.post(f'{server}/{api_version}/report_speed/{secret_api_key}', timeout=30,
+                      json={'worker_id': worker_id, 'audio_seconds': audio_seconds, 'processing_seconds': processing_seconds})
+    except Exception as e:
+        # only a measurement, the next task reports again
+        print('Warning, could not report speed:', e)
+
+def make_worker_id():
+    """ Identifies this worker process in the leases of the server. """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+class Heartbeat:
+    """
+    Extends the server-side lease of work ids from a side thread, while the main thread transcribes.
+    If a worker dies, the heartbeats stop and the server puts the work back into the queue once the lease expires.
+
+    Usage:
+        with Heartbeat(server, secret_api_key, wids, worker_id, api_version):
+            result = transcriber.transcribe(...)
+
+    For chunks of long episodes (see transcribe_chunk) use endpoint='heartbeat_chunks', ids_field='chunk_ids'.
+    """
+    def __init__(self, server, secret_api_key, wids, worker_id, api_version='apiv1', interval=60,
+                 endpoint='heartbeat_batch', ids_field='wids'):
+        self.url = f'{server}/{api_version}/{endpoint}/{secret_api_key}'
+        self.wids = wids
+        self.ids_field = ids_field
+        self.worker_id = worker_id
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='heartbeat', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                resp = requests.post(self.url, json={self.ids_field: self.wids, 'worker_id': self.worker_id}, timeout=30)
+                data = resp.json()
+                if not data['success']:
+                    print('Warning, heartbeat could not extend all leases:', data)
+            except Exception as e:
+                # keep trying, a single missed heartbeat is fine as long as the lease is longer than the interval
+                print('Warning, heartbeat failed:', e)
+
+def cancel_work(server, secret_api_key, wid, api_version='apiv1', reason=None):
+    """
+    Cancels the work in progress for one task on the server.
+    With a reason (the error), the cancel counts as a failed attempt and the server quarantines the task after
+    max_failures of them. Cancels that aren't the task's fault (server overloaded, worker stopped) pass no reason.
+    """
     print(f'Trying to cancel {wid}...')
     try:
         cancel_work = f'{server}/{api_version}/cancel_work/{wid}/{secret_api_key}'
-        resp = requests.get(url=cancel_work)
+        params = {'reason': reason} if reason else None
+        resp = request_with_backoff(lambda: requests.get(url=cancel_work, params=params, timeout=60), attempts=3)
         data = resp.json()
         assert(data['success'] == True)
     except:
         print('Error trying to cancel work id:', wid)
         traceback.print_exc()
 
-def cancel_work_batch(server, api_secret_key, wids, api_version='apiv1'):
-    """ Cancels the work in progress for a batch of tasks on the server. """
+def cancel_work_batch(server, api_secret_key, wids, api_version='apiv1', reason=None):
+    """ Cancels the work in progress for a batch of tasks on the server, see cancel_work for the reason. """
     print(f'Trying to cancel {wids}...')
     cancel_url = f'{server}/{api_version}/cancel_work_batch/{api_secret_key}'
-    resp = requests.post(cancel_url, json={'wids': wids})
+    payload = {'wids': wids, 'reason': reason} if reason else {'wids': wids}
+    resp = request_with_backoff(lambda: requests.post(cancel_url, json=payload, timeout=60), attempts=3)
     data = resp.json()
     print('Cancelled work in progress:', data)
     return data
 
-def transcribe_loop(server, language, secret_api_key, model_name='small', api_version='apiv1', implementation='original', beam_size=5, use_local_url=False, https_user='', https_password=''):
+def make_prompt(language, author, title):
+    """ Initial prompt with author and title, in the language of the podcast (English if there is no template for it). """
+    prompt = podcast_initial_prompts.get(language, podcast_initial_prompts['en']).format(author, title) if author or title else ''
+
+    if prompt and prompt[-1] == '\n':
+        prompt = prompt[:-1]
+
+    if prompt and prompt[-1] not in '.!?':
+        prompt += '.'
+    return prompt + '\n'
+
+def cancel_chunk(server, secret_api_key, chunk_id, api_version='apiv1', reason=None):
+    """ Cancels a chunk in progress, see cancel_work. """
+    print(f'Trying to cancel chunk {chunk_id}...')
+    try:
+        url = f'{server}/{api_version}/cancel_chunk/{chunk_id}/{secret_api_key}'
+        params = {'reason': reason} if reason else None
+        resp = request_with_backoff(lambda: requests.get(url=url, params=params, timeout=60), attempts=3)
+        print('Cancelled chunk:', resp.json())
+    except Exception:
+        print('Error trying to cancel chunk:', chunk_id)
+        traceback.print_exc()
+
+def transcribe_chunk(server, language, secret_api_key, transcriber, model_tag, api_version='apiv1', use_local_url=False,
+                     https_user='', https_password='', worker_id=None, heartbeat_interval=60, upload_encoding='gzip',
+                     max_backoff=300):
+    """
+    Transcribes a chunk of a long episode if the server has one (claim_chunk, see chunk_threshold in config.yaml).
+    Only the audio in [start, end) of the chunk is decoded and transcribed, the server stitches the chunk transcripts
+    of an episode together. Returns False if there is no chunk (or the server doesn't know chunks), the caller then
+    asks for a whole episode.
+    """
+    claim_url = f'{server}/{api_version}/claim_chunk/{language}/{secret_api_key}?worker_id={worker_id}'
+    resp = raise_if_overloaded(requests.get(url=claim_url, timeout=60))
+    if resp.status_code == 404:
+        return False
+    task = resp.json()
+    if not task.get('success'):
+        print('Could not claim a chunk:', task)
+        return False
+
+    chunk_id = task['chunk_id']
+    print(f"New chunk {task['chunk_index'] + 1}/{task['num_chunks']} of {task['wid']} ({chunk_id}): "
+          f"{task['start']}s - {task['end'] if task['end'] is not None else 'end'}")
+    try:
+        url = task['local_cache_audio_url'] if use_local_url else task['cache_audio_url']
+        url = add_auth_to_url(url, https_user, https_password)
+        task_language = task['language']
+        prompt = make_prompt(task_language, task.get('authors') or None, task.get('episode_title') or None)
+
+        transcribe_start = time.time()
+        with Heartbeat(server, secret_api_key, [chunk_id], worker_id, api_version, heartbeat_interval,
+                       endpoint='heartbeat_chunks', ids_field='chunk_ids'):
+            audio = load_audio_range(url, task['start'], task['end'])
+            result = transcriber.transcribe(audio, language=task_language, duration=-1, initial_prompt=prompt)
+        transcribe_seconds = time.time() - transcribe_start
+        assert(result['language'] == task_language)
+
+        fi = io.StringIO('')
+        transcriber.write_vtt(result, file=fi)
+        files = {'file': fi.getvalue()}
+        fi.close()
+
+        upload_url = f'{server}/{api_version}/upload_chunk/{chunk_id}/{secret_api_key}'
+        resp = request_with_backoff(lambda: post_compressed(upload_url, encoding=upload_encoding, files=files,
+                                                            data={'model': model_tag, 'worker_id': worker_id},
+                                                            timeout=300), max_backoff=max_backoff)
+        data = resp.json()
+        if resp.status_code == 409:
+            # the lease expired and the chunk went to another worker, there is nothing left to cancel
+            print('Chunk upload rejected, lease lost:', data)
+            return True
+        print('Uploaded chunk:', data)
+        assert(data['success'] == True)
+    except (KeyboardInterrupt, ServerOverloaded):
+        cancel_chunk(server, secret_api_key, chunk_id, api_version)
+        raise
+    except Exception as e:
+        cancel_chunk(server, secret_api_key, chunk_id, api_version, reason=f'{type(e).__name__}: {e}')
+        raise
+
+    report_speed(server, secret_api_key, worker_id, len(audio) / 16000., transcribe_seconds, api_version)
+    return True
+
+def transcribe_loop(server, language, secret_api_key, model_name='small', api_version='apiv1', implementation='original', beam_size=5, use_local_url=False, https_user='', https_password='', use_claim=False, worker_id=None, heartbeat_interval=60, wait=30, idle_sleep=10, upload_encoding='gzip', max_backoff=300, use_chunks=True, chunk_poll_interval=300):
     print(f'Loading whisper model {model_name} with {implementation} implementation...')
 
     # Initialize the selected transcription implementation
@@ -89,22 +296,57 @@ def transcribe_loop(server, language, secret_api_key, model_name='small', api_ve
     transcriber.load_model()
     print('Done!')
 
-    get_work_url = f'{server}/{api_version}/get_work/{language}/{secret_api_key}'
+    # With use_claim, claim_work samples and registers a job in one request (Step 1 and 2 below)
+    # With wait > 0 the server long-polls, i.e. holds the request for up to wait seconds until new work arrives
+    if use_claim:
+        get_work_url = f'{server}/{api_version}/claim_work/{language}/{secret_api_key}?worker_id={worker_id}&wait={wait}'
+    else:
+        get_work_url = f'{server}/{api_version}/get_work/{language}/{secret_api_key}?worker_id={worker_id}&wait={wait}'
     print(f'{get_work_url=}')
 
+    # Errors and 503s from an overloaded server are retried with jittered exponential backoff, so that many
+    # workers don't hammer a struggling server in lockstep. It is reset after every successful request for work.
+    backoff = Backoff(max_delay=max_backoff)
+
+    # After claim_chunk had no chunk (or the server doesn't split episodes, chunk_threshold 0), it is asked again only
+    # after chunk_poll_interval seconds, so that normal jobs don't pay for an extra round trip every time
+    next_chunk_poll = 0.
+
     while True:
         wip = False
         try:
+            # Step 0) Chunks of long episodes go first, so that their episodes are done as soon as possible
+            if use_chunks and time.monotonic() >= next_chunk_poll:
+                if transcribe_chunk(server, language, secret_api_key, transcriber, f'{implementation}_bs{beam_size}',
+                                    api_version, use_local_url, https_user, https_password, worker_id,
+                                    heartbeat_interval, upload_encoding, max_backoff):
+                    backoff.reset()
+                    continue
+                next_chunk_poll = time.monotonic() + chunk_poll_interval
+
             # Step 1) Get a url to transcribe from the transcription server
-            resp = requests.get(url=get_work_url)
+            request_start = time.time()
+            resp = raise_if_overloaded(requests.get(url=get_work_url, timeout=wait + 60))
             print('server response:', resp)
+            if wait_for_work(resp, time.time() - request_start, idle_sleep):
+                backoff.reset()
+                continue
             data = resp.json()
+            if use_claim:
+                assert(data['success'] == True)
+                data = data['tasks'][0]
+                wid = data['wid']
+                wip = True
             assert(data['transcript_file'] == '')
             assert(data['cache_audio_url'] != '')
             assert(data['success'] == True)
+            backoff.reset()
 
             title = data.get('episode_title') or None
             author = data.get('authors') or None
+            duration = data.get('duration')
+            # with several languages (--language de,fr) every task has its own, the model stays loaded
+            task_language = data['language']
 
             url = data['cache_audio_url']
             if use_local_url:
@@ -119,46 +361,51 @@ def transcribe_loop(server, language, secret_api_key, model_name='small', api_ve
             print('New job:', data)
             print('Work ID:', wid)
 
-            # Step 2) Confirm we are taking the job
-            confirm_work_url = f'{server}/{api_version}/register_wip/{wid}/{secret_api_key}'
-            print(f'{confirm_work_url=}')
-            resp = requests.get(url=confirm_work_url)
-            data = resp.json()
-            print('Confirmed:', data)
-            assert(data['success'] == True)
-            wip = True
-
-            # Generate the prompt based on the language, defaulting to English if the language code is not found
-            prompt = podcast_initial_prompts.get(language, podcast_initial_prompts['en']).format(author, title) if author or title else ''
+            # Step 2) Confirm we are taking the job (claim_work already did that)
+            if not use_claim:
+                confirm_work_url = f'{server}/{api_version}/register_wip/{wid}/{secret_api_key}?worker_id={worker_id}'
+                print(f'{confirm_work_url=}')
+                resp = request_with_backoff(lambda: requests.get(url=confirm_work_url, timeout=60), max_backoff=max_backoff)
+                data = resp.json()
+                print('Confirmed:', data)
+                assert(data['success'] == True)
+                wip = True
 
-            if prompt[-1] == '\n':
-                prompt = prompt[:-1]
-
-            if prompt and prompt[-1] not in '.!?':
-                prompt += '.'
-            prompt += '\n'
+            prompt = make_prompt(task_language, author, title)
 
             # Step 3) Use whisper to transcribe and obtain a vtt.
             # Provide author and title as additional information (prompt).
             print('Transcribing with prompt:', prompt)
-            result = transcriber.transcribe(url, language=language, duration=-1, initial_prompt = prompt)
+            transcribe_start = time.time()
+            with Heartbeat(server, secret_api_key, [wid], worker_id, api_version, heartbeat_interval):
+                result = transcriber.transcribe(url, language=task_language, duration=-1, initial_prompt = prompt)
+            transcribe_seconds = time.time() - transcribe_start
             print('Done!')
 
             print('Model reported language:', result['language'])
-            assert(result['language'] == language)
+            assert(result['language'] == task_language)
 
             fi = io.StringIO('')
             transcriber.write_vtt(result, file=fi)
             fi.seek(0)
 
             # Step 4) Upload vtt and close the memory StringIO file
-            files = {'file': fi}
-            data = {'model': f'{implementation}_bs{beam_size}'}
+            files = {'file': fi.getvalue()}
+            # with worker_id the server only accepts the upload while this worker holds the lease
+            data = {'model': f'{implementation}_bs{beam_size}', 'worker_id': worker_id}
             upload_url = f'{server}/{api_version}/upload_result/{wid}/{secret_api_key}'
             print(f"{upload_url=}")
 
-            resp = requests.post(upload_url, files=files, data=data)
+            # vtt files are very repetitive, they are sent compressed (--upload-encoding)
+            # an hour of GPU time is in there, the upload is retried if the server is overloaded or unreachable
+            resp = request_with_backoff(lambda: post_compressed(upload_url, encoding=upload_encoding, files=files,
+                                                                data=data, timeout=300), max_backoff=max_backoff)
             data = resp.json()
+            if resp.status_code == 409:
+                # the lease expired and the episode went to another worker, there is nothing left to cancel
+                print('Upload rejected, lease lost:', data)
+                wip = False
+                continue
             assert(data['success'] == True)
 
             # Cleanup, just making sure data doesnt get mixed up in the next iteration
@@ -169,11 +416,19 @@ def transcribe_loop(server, language, secret_api_key, model_name='small', api_ve
             del result
 
             print('Done uploading new VTT file!')
+            report_speed(server, secret_api_key, worker_id, duration, transcribe_seconds, api_version)
+
+        except ServerOverloaded as e:
+            print(e)
+            if wip:
+                print('Canceled with work in progress:', wid)
+                cancel_work(server, secret_api_key, wid, api_version)
+            backoff.sleep(e.retry_after)
 
         except JSONDecodeError as e:
             print("Exception encountered trying to parse server response:", e)
             traceback.print_exc()
-            time.sleep(10)
+            backoff.sleep()
             if wip:
                 print('Canceled with work in progress:', wid)
                 cancel_work(server, secret_api_key, wid, api_version)
@@ -188,35 +443,36 @@ def transcribe_loop(server, language, secret_api_key, model_name='small', api_ve
         except Exception as e:
             print("Exception encountered in transcribe_loop:", e)
             traceback.print_exc()
-            time.sleep(10)
+            backoff.sleep()
             if wip:
                 print('Canceled with work in progress:', wid)
-                cancel_work(server, secret_api_key, wid, api_version)
+                cancel_work(server, secret_api_key, wid, api_version, reason=f'{type(e).__name__}: {e}')
 
-def upload_results_batch(server, api_version, secret_api_key, wids, results):
-    """Uploads transcription results for a batch of work items."""
+def upload_results_batch(server, api_version, secret_api_key, wids, results, model_tag=None, encoding='gzip', max_backoff=300, worker_id=None):
+    """
+    Uploads the transcription results (VTT text) of a batch of work items in one multipart request.
+
+    :param wids: List of work item IDs, in the same order as results.
+    :param results: List of VTT strings.
+    :param model_tag: Stored in the model column of the uploaded episodes.
+    :param encoding: Content-Encoding of the request body (gzip, zstd or None).
+    :param max_backoff: Maximum seconds between retries if the server is overloaded or unreachable.
+    :param worker_id: With a worker_id the server rejects the batch if a lease of this worker was lost.
+    :return: JSON response from the server indicating success or failure.
+    """
     upload_url = f"{server}/{api_version}/upload_result_batch/{secret_api_key}"
-    files = []
-    data = []
-
-    # Preparing the multipart/form-data with files and data
-    for wid, result in zip(wids, results):
-        # Creating a virtual file object containing the result (assuming result is VTT text)
-        file_object = io.StringIO(result)
-        # Each file needs a unique key in the 'files' dict for the multipart upload.
-        # ('file', (filename, fileobject, content_type))
-        files.append(('file', (f"{wid}.vtt", file_object.getvalue(), 'text/vtt')))
-        # Including the model name or any additional data as part of the form data
-        data.append(('model', f'whisper_{wid}'))
-
-    # POST request with files and data
-    response = requests.post(upload_url, files=files, data=data)
-    for _, file_tuple in files:
-        file_tuple[1].close()
 
+    # One 'file' part per transcript, the server gets the wid from the filename
+    files = [('file', (f"{wid}.vtt", result.encode('utf-8'), 'text/vtt')) for wid, result in zip(wids, results)]
+    data = {'model': model_tag} if model_tag else {}
+    if worker_id:
+        data['worker_id'] = worker_id
+
+    response = request_with_backoff(lambda: post_compressed(upload_url, encoding=encoding, files=files, data=data, timeout=300),
+                                    max_backoff=max_backoff)
     return response.json()
 
-def register_wip_batch(server, api_version, secret_api_key, wids):
+def register_wip_batch(server, api_version, secret_api_key, wids, worker_id=None):
     """
     Registers a batch of work items as in progress by sending a POST request to the server.
 
@@ -224,12 +480,13 @@ def register_wip_batch(server, api_version, secret_api_key, wids):
     :param api_version: API version to access the correct endpoint.
     :param secret_api_key: Secret key for API access.
     :param wids: List of work item IDs (wids) that are to be registered.
+    :param worker_id: Worker id for the server-side leases, see Heartbeat.
     :return: JSON response from the server indicating success or failure.
     """
 
     url = f"{server}/{api_version}/register_wip_batch/{secret_api_key}"
-    payload = {'wids': wids} # Payload containing the list of work IDs
-    response = requests.post(url, json=payload)
+    payload = {'wids': wids, 'worker_id': worker_id} # Payload containing the list of work IDs
+    response = request_with_backoff(lambda: requests.post(url, json=payload, timeout=60), attempts=3)
 
     if response.status_code == 200:
         return response.json()
@@ -238,24 +495,37 @@ def register_wip_batch(server, api_version, secret_api_key, wids):
         print(f"Failed to register work in progress. Status Code: {response.status_code}, Response: {response.text}")
         return {'success': False, 'error': 'Failed to register work in progress with the server.'}
 
-def transcribe_loop_batch(server, language, secret_api_key, model='small', api_version='apiv1', batch_size=5, beam_size=5, https_user='', https_password=''):
+def transcribe_loop_batch(server, language, secret_api_key, model='small', api_version='apiv1', batch_size=5, beam_size=5, https_user='', https_password='', use_claim=False, worker_id=None, heartbeat_interval=60, wait=30, idle_sleep=10, upload_encoding='gzip', max_backoff=300):
     print(f"Loading Whisper model {model} with batched_transformer implementation")
 
     transcriber = BatchedTransformerWhisper(beam_size=beam_size)
     transcriber.load_model()
-    get_work_url = f'{server}/{api_version}/get_work_batch/{language}/{secret_api_key}/{batch_size}'
+    # get_work_batch doesn't long-poll, without claim_work an empty queue is polled every idle_sleep seconds
+    if use_claim:
+        get_work_url = f'{server}/{api_version}/claim_work/{language}/{secret_api_key}?n={batch_size}&worker_id={worker_id}&wait={wait}'
+    else:
+        get_work_url = f'{server}/{api_version}/get_work_batch/{language}/{secret_api_key}/{batch_size}?worker_id={worker_id}'
     print(f'URL for getting work: {get_work_url}')
 
+    # see transcribe_loop
+    backoff = Backoff(max_delay=max_backoff)
+
     while True:
         wip = False
         try:
             # Step 1: Get a batch of work to transcribe
-            resp = requests.get(url=get_work_url)
+            request_start = time.time()
+            resp = raise_if_overloaded(requests.get(url=get_work_url, timeout=wait + 60))
+            if wait_for_work(resp, time.time() - request_start, idle_sleep):
+                backoff.reset()
+                continue
             work_batch = resp.json()
 
             if not work_batch['success']:
                 print("Failed to fetch work batch:", work_batch)
+                time.sleep(idle_sleep)
                 continue
+            backoff.reset()
 
             urls = [add_auth_to_url(task['episode_audio_url'], https_user, https_password) for task in work_batch['tasks']]
             wids = [task['wid'] for task in work_batch['tasks']]
@@ -263,16 +533,21 @@ def transcribe_loop_batch(server, language, secret_api_key, model='small', api_v
 
             print('Fetched new batch of jobs:', wids)
 
-            # Step 2: Register work in progress for the fetched batch
-            register_response = register_wip_batch(server, api_version, secret_api_key, wids)
-            if not register_response['success']:
-                print("Failed to register work in progress:", register_response)
-                continue
+            # Step 2: Register work in progress for the fetched batch (claim_work already did that)
+            if not use_claim:
+                register_response = register_wip_batch(server, api_version, secret_api_key, wids, worker_id)
+                if not register_response['success']:
+                    print("Failed to register work in progress:", register_response)
+                    continue
 
-            print('Batch registered:', register_response)
+                print('Batch registered:', register_response)
 
             # Step 3: Transcribe batch
-            results = transcriber.transcribe_batch(urls, language=language)
+            transcribe_start = time.time()
+            with Heartbeat(server, secret_api_key, wids, worker_id, api_version, heartbeat_interval):
+                # a batch comes from one language
+                results = transcriber.transcribe_batch(urls, language=work_batch['tasks'][0]['language'])
+            transcribe_seconds = time.time() - transcribe_start
             vtt_results = []
             for result in results:
                 fi = io.StringIO('')
@@ -282,9 +557,29 @@ def transcribe_loop_batch(server, language, secret_api_key, model='small', api_v
                 fi.close()
 
             # Step 4: Upload results
-            upload_results_batch(server, api_version, secret_api_key, wids, vtt_results)
+            upload_response = upload_results_batch(server, api_version, secret_api_key, wids, vtt_results,
+                                                    model_tag=f'batched_transformer_bs{beam_size}', encoding=upload_encoding,
+                                                    max_backoff=max_backoff, worker_id=worker_id)
+            lost = set(upload_response.get('lease_lost') or [])
+            if lost:
+                # the server rejects the whole batch, the episodes whose lease expired went to other workers and
+                # the rest is uploaded again without them
+                print('Leases lost, not uploading:', sorted(lost))
+                vtt_results = [vtt for wid, vtt in zip(wids, vtt_results) if wid not in lost]
+                wids = [wid for wid in wids if wid not in lost]
+                if not wids:
+                    wip = False
+                    continue
+                upload_response = upload_results_batch(server, api_version, secret_api_key, wids, vtt_results,
+                                                        model_tag=f'batched_transformer_bs{beam_size}', encoding=upload_encoding,
+                                                        max_backoff=max_backoff, worker_id=worker_id)
+            assert(upload_response['success'] == True)
             wip = False
 
+            print('Done uploading new VTT files!')
+            audio_seconds = sum(max(task.get('duration') or 0, 0) for task in work_batch['tasks'])
+            report_speed(server, secret_api_key, worker_id, audio_seconds, transcribe_seconds, api_version)
+
         except KeyboardInterrupt:
             print("Keyboard interrupt")
             if wip:
@@ -292,13 +587,20 @@ def transcribe_loop_batch(server, language, secret_api_key, model='small', api_v
                 cancel_work_batch(server, secret_api_key, wids, api_version)
             sys.exit(-10)
 
+        except ServerOverloaded as e:
+            print(e)
+            if wip:
+                print('Canceled with work in progress:', wids)
+                cancel_work_batch(server, secret_api_key, wids, api_version)
+            backoff.sleep(e.retry_after)
+
         except Exception as e:
             print("Exception encountered in transcribe_loop_batch:", e)
             traceback.print_exc()
             if wip:
                 print('Canceled with work in progress:', wids)
-                cancel_work_batch(server, secret_api_key, wids, api_version)
-            time.sleep(30)
+                cancel_work_batch(server, secret_api_key, wids, api_version, reason=f'{type(e).__name__}: {e}')
+            backoff.sleep()
 
 if __name__ == '__main__':
     config = load_config()
@@ -317,21 +619,41 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Worker that uses whisper to transcribe')
     parser.add_argument('-s', '--server-address', default=server_url, dest='server', help=f'Server address to connect to. Default: {server_url}')
-    parser.add_argument('-l', '--language', default=default_lang, dest='language', help=f'Language (used in the queries to the server). Default: {default_lang}')
+    parser.add_argument('-l', '--language', default=default_lang, dest='language', help=f'Language (used in the queries to the server). Several languages in order of priority (de,fr) or with weights (de:3,fr:1) share one loaded model. Default: {default_lang}')
     parser.add_argument('--debug', dest='debug', help='Start with debugging enabled', action='store_true', default=False)
     parser.add_argument('--implementation', choices=['original', 'faster', 'X', 'batched_transformer', 'cpp'], default='original', help='Select the whisper implementation to use. Default: original')
     parser.add_argument('--beam-size', type=int, default=default_beam_size, help=f'Decoding beam size. Default: {default_beam_size}')
     parser.add_argument('--model-name', type=str, default=default_whisper_model, help=f'Whisper model name tag. Default: {default_whisper_model}')
     parser.add_argument('--api-version', default=api_version, help=f'API version to use. Default: {api_version}')
     parser.add_argument('--use_local_url', dest='use_local_url', help='Use local LAN URL instead of global internet URL.', action='store_true', default=False)
+    parser.add_argument('--heartbeat-interval', type=int, default=60, help='Seconds between lease heartbeats sent to the server. Default: 60')
+    parser.add_argument('--claim', dest='use_claim', help='Get and register work with a single claim_work request.', action='store_true', default=False)
+    parser.add_argument('--wait', type=int, default=30, help='Seconds the server may hold a get_work / claim_work request when there is no work (long polling), 0 disables it. Default: 30')
+    parser.add_argument('--idle-sleep', type=int, default=10, help='Seconds to sleep when the server has no work and did not long-poll. Default: 10')
+    parser.add_argument('--upload-encoding', choices=['gzip', 'zstd', 'none'], default='gzip', help='Compression of vtt uploads, zstd needs the zstandard package on both sides, none for older servers. Default: gzip')
+    parser.add_argument('--max-backoff', type=float, default=300, help='Maximum seconds to back off between retries when the server is overloaded (503) or unreachable. Default: 300')
+    parser.add_argument('--max-duration', type=float, default=None, help='Longest episode in seconds this worker accepts, e.g. for GPUs with little memory or CPU workers. Default: no limit')
+    parser.add_argument('--no-chunks', dest='use_chunks', action='store_false', default=True, help='Never transcribe chunks of long episodes (claim_chunk), only whole episodes.')
+    parser.add_argument('--chunk-poll-interval', type=float, default=300, help='Seconds until claim_chunk is asked again after it had no chunk. Default: 300')
+    parser.add_argument('--rtf', type=float, default=None, help='Initial real-time factor (processing seconds per audio second) for the scheduling of the server, it measures it after every task. Default: the last measurement of this host, or slowest')
     args = parser.parse_args()
+    upload_encoding = None if args.upload_encoding == 'none' else args.upload_encoding
+    try:
+        parse_languages(args.language)
+    except ValueError as e:
+        parser.error(f'--language: {e}')
 
     # Load HTTP authentication credentials from config
     https_user = config.get('https_user', '')
     https_password = config.get('https_password', '')
 
+    worker_id = make_worker_id()
+    print('Worker id:', worker_id)
+    register_worker(args.server, config['secret_api_key'], worker_id, args.language, args.implementation, args.model_name,
+                    max_duration=args.max_duration, rtf=args.rtf, api_version=args.api_version)
+
     if args.implementation == 'batched_transformer':
-        transcribe_loop_batch(args.server, args.language, config['secret_api_key'], model_name=args.model_name, api_version=args.api_version, beam_size=args.beam_size, https_user=https_user, https_password=https_password)
+        transcribe_loop_batch(args.server, args.language, config['secret_api_key'], model=args.model_name, api_version=args.api_version, beam_size=args.beam_size, https_user=https_user, https_password=https_password, use_claim=args.use_claim, worker_id=worker_id, heartbeat_interval=args.heartbeat_interval, wait=args.wait, idle_sleep=args.idle_sleep, upload_encoding=upload_encoding, max_backoff=args.max_backoff)
     else:
-        transcribe_loop(args.server, args.language, config['secret_api_key'], model_name=args.model_name, implementation=args.implementation, api_version=args.api_version, beam_size=args.beam_size, use_local_url=args.use_local_url, https_user=https_user, https_password=https_password)
+        transcribe_loop(args.server, args.language, config['secret_api_key'], model_name=args.model_name, implementation=args.implementation, api_version=args.api_version, beam_size=args.beam_size, use_local_url=args.use_local_url, https_user=https_user, https_password=https_password, use_claim=args.use_claim, worker_id=worker_id, heartbeat_interval=args.heartbeat_interval, wait=args.wait, idle_sleep=args.idle_sleep, upload_encoding=upload_encoding, max_backoff=args.max_backoff, use_chunks=args.use_chunks, chunk_poll_interval=args.chunk_poll_interval)
 
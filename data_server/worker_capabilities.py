@@ -0,0 +1,161 @@
+"""
+Capabilities of the transcription workers, for capability-aware dispatch.
+
+Workers register when they start (implementation, model, the longest episode they accept) and report how long they
+took for every task. The server keeps the real-time factor of every worker (rtf, processing seconds per second of
+audio) as an exponential moving average in the workers table. A worker that restarts (and gets a new worker id) starts
+with the rtf of the last worker with the same host, implementation and model.
+
+Dispatch orders the active workers of a language from slow to fast and gives every worker a range of [0, 1] in
+proportion to its speed (1 / rtf), see speed_range. get_work and claim_work sample a quantile of the remaining hours in
+the duration buckets of the sampling index from that range: the fastest workers get the longest episodes and the
+slowest the shortest ones, and every part of the queue is drained in proportion to the capacity assigned to it, so
+that no slow worker is left with a 4 hour episode at the end of the queue. Workers without a measured rtf count as
+the slowest until their first report.
+
+Workers with several languages (worker.py --language de,fr) count as workers of each of them.
+
+Every gunicorn process keeps a snapshot of the active workers (registered or seen within active_seconds, or holding
+a lease) that is reloaded every refresh_interval seconds.
+"""
+import threading
+import time
+
+class WorkerCapabilities:
+    def __init__(self, db_connection, table='workers', queue_table='work_queue', active_seconds=900,
+                 refresh_interval=60, ema_alpha=0.2):
+        self.db_connection = db_connection
+        self.table = table
+        self.active_seconds = active_seconds
+        self.refresh_interval = refresh_interval
+        self.ema_alpha = ema_alpha
+        self.lock = threading.Lock()
+        self.workers = {}    # worker_id -> capabilities dict, None for unknown workers (older worker.py)
+        self.rtfs = {}       # language -> [(worker_id, rtf)] of the active workers with a measured rtf
+        self.loaded_at = 0.
+
+        self.columns = ['worker_id', 'language', 'implementation', 'model', 'max_duration', 'rtf', 'rtf_samples']
+        columns_sql = ', '.join(self.columns)
+        self.active_query = f"""
+            SELECT {columns_sql} FROM {table}
+            WHERE last_seen > now() - %(active_seconds)s * interval '1 second'
+            OR worker_id IN (SELECT lease_owner FROM {queue_table}
+                             WHERE status = 'in_progress' AND lease_expires_at > now())
+        """
+        self.select_query = f'SELECT {columns_sql} FROM {table} WHERE worker_id = %s'
+        # rtf from the worker, else from the latest worker with the same host, implementation and model
+        self.register_query = f"""
+            INSERT INTO {table} (worker_id, host, language, implementation, model, max_duration, rtf, rtf_samples)
+            SELECT %(worker_id)s, %(host)s, %(language)s, %(implementation)s, %(model)s, %(max_duration)s,
+                   coalesce(%(rtf)s::real, previous.rtf),
+                   CASE WHEN %(rtf)s::real IS NULL THEN coalesce(previous.rtf_samples, 0) ELSE 1 END
+            FROM (SELECT 1) AS one
+            LEFT JOIN LATERAL (SELECT rtf, rtf_samples FROM {table}
+                               WHERE host = %(host)s AND implementation = %(implementation)s AND model = %(model)s
+                               AND rtf IS NOT NULL AND worker_id <> %(worker_id)s
+                               ORDER BY last_seen DESC LIMIT 1) AS previous ON true
+            ON CONFLICT (worker_id) DO UPDATE
+            SET host = excluded.host, language = excluded.language, implementation = excluded.implementation,
+                model = excluded.model, max_duration = excluded.max_duration,
+                rtf = coalesce(%(rtf)s::real, {table}.rtf), last_seen = now()
+            RETURNING {columns_sql}
+        """
+        self.report_query = f"""
+            UPDATE {table}
+            SET rtf = CASE WHEN rtf IS NULL THEN %(rtf)s ELSE (1 - %(alpha)s) * rtf + %(alpha)s * %(rtf)s END,
+                rtf_samples = rtf_samples + 1, last_seen = now()
+            WHERE worker_id = %(worker_id)s
+            RETURNING {columns_sql}
+        """
+
+    def _make_worker(self, record):
+        return dict(zip(self.columns, record)) if record is not None else None
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and time.monotonic() - self.loaded_at < self.refresh_interval:
+                return
+            # other threads keep using the old snapshot while this one loads
+            self.loaded_at = time.monotonic()
+
+        with self.db_connection.transaction() as cursor:
+            cursor.execute(self.active_query, {'active_seconds': self.active_seconds})
+            workers = {record[0]: self._make_worker(record) for record in cursor.fetchall()}
+
+        rtfs = {}
+        for worker_id, worker in workers.items():
+            if worker['rtf'] is not None and worker['rtf'] > 0:
+                for language in worker_languages(worker):
+                    rtfs.setdefault(language, []).append((worker_id, worker['rtf']))
+
+        with self.lock:
+            self.workers = workers
+            self.rtfs = rtfs
+
+    def get(self, worker_id):
+        """Capabilities of a worker, None if it never registered."""
+        self.refresh()
+        with self.lock:
+            if worker_id in self.workers:
+                return self.workers[worker_id]
+
+        # registered after the last refresh (or on another gunicorn process), or not registered at all
+        with self.db_connection.transaction() as cursor:
+            cursor.execute(self.select_query, (worker_id,))
+            worker = self._make_worker(cursor.fetchone())
+        with self.lock:
+            self.workers[worker_id] = worker
+        return worker
+
+    def _update(self, worker):
+        with self.lock:
+            self.workers[worker['worker_id']] = worker
+
+    def register(self, worker_id, host=None, language=None, implementation=None, model=None, max_duration=None, rtf=None):
+        with self.db_connection.transaction() as cursor:
+            cursor.execute(self.register_query, {'worker_id': worker_id, 'host': host, 'language': language,
+                                                 'implementation': implementation, 'model': model,
+                                                 'max_duration': max_duration, 'rtf': rtf})
+            worker = self._make_worker(cursor.fetchone())
+        self._update(worker)
+        return worker
+
+    def report(self, worker_id, audio_seconds, processing_seconds):
+        """Adds a measurement to the rtf average of a worker, returns its capabilities or None if it isn't registered."""
+        rtf = processing_seconds / audio_seconds
+        with self.db_connection.transaction() as cursor:
+            cursor.execute(self.report_query, {'worker_id': worker_id, 'rtf': rtf, 'alpha': self.ema_alpha})
+            worker = self._make_worker(cursor.fetchone())
+        if worker is not None:
+            self._update(worker)
+        return worker
+
+    def speed_range(self, worker, language=None):
+        """
+        The range of quantiles of the remaining hours that a worker should take its work from (0 = shortest, 1 = longest
+        episodes): the workers of the language are ordered from slow to fast and every worker gets a share of [0, 1]
+        that is proportional to its speed (1 / rtf). Workers without a measured rtf get (0, 0), the shortest episodes.
+        """
+        if worker['rtf'] is None or worker['rtf'] <= 0:
+            return 0., 0.
+        with self.lock:
+            others = [rtf for worker_id, rtf in self.rtfs.get(language or worker_languages(worker)[0], [])
+                      if worker_id != worker['worker_id']]
+
+        rtf = worker['rtf']
+        total = sum(1. / other for other in others) + 1. / rtf
+        # workers with the same rtf share their ranges
+        slower = sum(1. / other for other in others if other > rtf)
+        same = sum(1. / other for other in others if other == rtf) + 1. / rtf
+        return slower / total, (slower + same) / total
+
+    def stats(self):
+        self.refresh()
+        with self.lock:
+            workers = [worker for worker in self.workers.values() if worker is not None]
+        return {'workers': [dict(worker, speed_range=[round(quantile, 3) for quantile in self.speed_range(worker)])
+                            for worker in sorted(workers, key=lambda worker: (worker['language'] or '', worker['rtf'] or 0.))]}
+
+def worker_languages(worker):
+    """Languages of a worker without priorities or weights, e.g. ['de', 'fr'] for 'de:3,fr:1'."""
+    return [part.partition(':')[0].strip() for part in (worker['language'] or '').split(',')]
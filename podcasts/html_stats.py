@@ -9,6 +9,8 @@ import matplotlib.pyplot as plt
 from utils import load_config, connect_to_db
 
 PODCAST_TABLE = 'podcasts'
+LEASE_RECLAIMS_TABLE = 'lease_reclaims'
+WORK_QUEUE_TABLE = 'work_queue'
 DEFAULT_WEBPAGE = '/srv/pi.speechcatcher.net/stats.html'
 PICKLE_FILE = 'html_stats.pickle'
 
@@ -65,6 +67,18 @@ def get_corrupted_hours(cursor):
     condition = "transcript_file LIKE '%/corrupted/%'"
     return get_hours(cursor, condition)
 
+def get_queue_hours(cursor, status):
+    query = f"SELECT sum(duration) FROM {WORK_QUEUE_TABLE} WHERE status = %s;"
+    cursor.execute(query, (status,))
+    result = cursor.fetchone()[0]
+    return float(result) / 3600. if result else 0.
+
+def get_reclaimed_hours(cursor, condition):
+    query = f"SELECT sum(duration) FROM {LEASE_RECLAIMS_TABLE} WHERE {condition};"
+    cursor.execute(query)
+    result = cursor.fetchone()[0]
+    return float(result) / 3600. if result else 0.
+
 def load_previous_stats():
     try:
         with open(PICKLE_FILE, "rb") as f:
@@ -99,7 +113,7 @@ def generate_duration_histogram(cursor, condition, output_file):
 
 def generate_html(transcribed_hours, untranscribed_hours, inprogress_hours, transcribed_ratio, transcription_speed,
                   total_files, total_size, distinct_authors, transcribed_files, transcribed_size, transcribed_authors,
-                  corrupted_files, corrupted_hours):
+                  corrupted_files, corrupted_hours, reclaimed_hours, reclaimed_hours_24h):
     current_datetime = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
     return f'''
 <html>
@@ -154,6 +168,7 @@ def generate_html(transcribed_hours, untranscribed_hours, inprogress_hours, tran
         <br/>
         <p>Current transcription speed: <strong>{transcription_speed:.2f}</strong> hours per hour</p>
         <p>Currently in progress: <strong>{inprogress_hours:.2f}</strong> hours</p>
+        <p>Reclaimed from expired leases: <strong>{reclaimed_hours:.2f}</strong> hours (<strong>{reclaimed_hours_24h:.2f}</strong> hours in the last 24h)</p>
         <p>Total files: <strong>{total_files}</strong></p>
         <p>Total size: <strong>{total_size/(1024.*1024.*1024.):.2f}</strong> GB</p>
         <p>Distinct authors: <strong>{distinct_authors}</strong></p>
@@ -176,7 +191,7 @@ def main():
 
         transcribed_hours = get_hours(cursor, "transcript_file <> '' AND transcript_file <> 'in_progress'")
         untranscribed_hours = get_hours(cursor, "transcript_file = '' OR transcript_file = 'in_progress'")
-        inprogress_hours = get_hours(cursor, "transcript_file = 'in_progress'")
+        inprogress_hours = get_queue_hours(cursor, 'in_progress')
 
         transcribed_ratio = transcribed_hours / (transcribed_hours + untranscribed_hours) if (transcribed_hours + untranscribed_hours) else 0
 
@@ -194,9 +209,12 @@ def main():
         corrupted_files = get_corrupted_file_count(cursor)
         corrupted_hours = get_corrupted_hours(cursor)
 
+        reclaimed_hours = get_reclaimed_hours(cursor, "1=1")
+        reclaimed_hours_24h = get_reclaimed_hours(cursor, "reclaimed_at > now() - interval '24 hours'")
+
         html_content = generate_html(transcribed_hours, untranscribed_hours, inprogress_hours, transcribed_ratio, transcription_speed,
                                      total_files, total_size, distinct_authors, transcribed_files, transcribed_size, transcribed_authors,
-                                     corrupted_files, corrupted_hours)
+                                     corrupted_files, corrupted_hours, reclaimed_hours, reclaimed_hours_24h)
 
         print('Time:', time.time())
 